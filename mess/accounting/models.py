@@ -1,10 +1,14 @@
-from datetime import date
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 
-from django.db import models
-from django.db.transaction import commit_on_success
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import F
+from django.db.models.aggregates import Count, Sum
+from django.db.transaction import commit_on_success, set_dirty
 from django.core import exceptions
 from django.contrib.auth.models import User
 
+from mess.core import dataversion
 from mess.settings import LOCATION
 from mess.membership.models import Account, Member
 from mess.membership import models as m_models
@@ -67,9 +71,12 @@ class Transaction(models.Model):
     entered_by = models.ForeignKey(User, blank=True, null=True)  # IS4C.emp_no
 
     # NEW FIELDS FOR IS4C
+    # (register_no, trans_no, trans_id, is4c_cashier_id, is4c_date) 
+    # identifies an IS4C line item, since IS4C numbers transactions per lane,
+    # cashier and day
     register_no = models.IntegerField(blank=True, null=True)
     trans_id = models.IntegerField(blank=True, null=True)  #this is foreign pk for IS4C
-    trans_no = models.IntegerField(blank=True, null=True)
+    trans_no = models.IntegerField(blank=True, null=True, db_index=True)
     upc = models.CharField(max_length=13, blank=True)
     # TODO: trans_type : this needs a mapping, but let's also keep the original IS4C value
     trans_type = models.CharField(max_length=5, blank=True)
@@ -83,12 +90,33 @@ class Transaction(models.Model):
     taxable = models.NullBooleanField(blank=True, null=True)
     is4c_timestamp = models.DateTimeField(blank=True, null=True)
     is4c_cashier_id = models.IntegerField(blank=True, null=True)
+    # the date of is4c_timestamp, for the line item key
+    is4c_date = models.DateField(blank=True, null=True, editable=False)
+    # corrections say which transaction they fix with a note like "@123 ...";
+    # save() links them here so fixers don't have to search the notes
+    fixes = models.ForeignKey('self', null=True, blank=True, editable=False,
+                              related_name='fixer_set')
 
     def __unicode__(self):
         return u'%s %s' % (self.account, 
                           self.timestamp.strftime('%Y-%m-%d %H:%M:%S'))
 
     def save(self, *args, **kwargs):
+        changed = self.update_balances()
+        self.link_fixes()
+        # put account and member save after transaction save so balance isn't
+        # changed on transaction save error
+        super(Transaction, self).save(*args, **kwargs)
+        for obj in changed:
+            obj.save()
+        self.add_to_daily_totals()
+
+    def update_balances(self):
+        '''
+        Applies this new transaction to its account balance and member 
+        equity, in memory only.  Returns the account and member if they
+        changed, for save() and save_transactions() to save.
+        '''
         if not self.member:
             raise Exception('all new transactions must have member')
         # purchase_amount and purchase_type must appear together
@@ -99,8 +127,9 @@ class Transaction(models.Model):
             self.payment_amount = 0
             self.payment_type = ''
 
+        changed = []
         if self.purchase_type == 'O':  
-            print self.purchase_amount
+            changed.append(self.member)
             self.member.equity_held += self.purchase_amount
 
             # Per Dan's instructions, only update equity_due if the transaction is for a 
@@ -113,11 +142,9 @@ class Transaction(models.Model):
         balance = self.account.balance
         new_balance = balance + self.purchase_amount - self.payment_amount
         self.account.balance = self.account_balance = new_balance
-        # put account and member save after transaction save so balance isn't
-        # changed on transaction save error
-        super(Transaction, self).save(*args, **kwargs)
-        self.account.save()
-        self.member.save()
+        if new_balance != balance:
+            changed.insert(0, self.account)
+        return changed
 
     def save_for_equity_transfer(self, *args, **kwargs):
         # purchase_amount and purchase_type must appear together
@@ -142,12 +169,29 @@ class Transaction(models.Model):
         balance = self.account.balance
         new_balance = balance + self.purchase_amount - self.payment_amount
         self.account.balance = self.account_balance = new_balance
+        self.link_fixes()
         # put account save after transaction save so balance isn't
         # changed on transaction save error
         super(Transaction, self).save(*args, **kwargs)
         self.account.save()
-
-    def fixes_target(self):
+        self.add_to_daily_totals()
+
+    def add_to_daily_totals(self):
+        ''' counts this new transaction in its DailyTotals '''
+        for kind, type, amount in (
+                ('purchase', self.purchase_type, self.purchase_amount),
+                ('payment', self.payment_type, self.payment_amount)):
+            if not type:
+                continue
+            add_to_daily_total({'account': self.account, 
+                                'day': self.timestamp.date(), 
+                                'kind': kind, 'type': type}, amount)
+
+    def link_fixes(self):
+        ''' sets fixes from the note, before saving '''
+        self.fixes = self.find_fixes_target() or None
+
+    def find_fixes_target(self):
         '''
         If this transaction is a correction, returns the target of the fix.
         Determined based on note starting with "@id "
@@ -162,18 +206,26 @@ class Transaction(models.Model):
         except:
             return [] # transaction was not a correction.
 
+    def fixes_target(self):
+        if self.fixes_id:
+            return self.fixes
+
     def fixers(self):
-        if self.note and self.note[0] == '@':
-            return []  # disregard recursive fixers
-        return Transaction.objects.filter(note__startswith='@%s ' % self.id)
+        if getattr(self, '_fixed', None) and not self._fixed['count']:
+            return []
+        return self.fixer_set.all()
         
     def fixed_payment_amount(self):
+        if hasattr(self, '_fixed'):
+            return self.payment_amount + self._fixed['payment']
         payment = self.payment_amount
         for fixer in self.fixers():
             payment += fixer.payment_amount
         return payment
 
     def fixed_purchase_amount(self):
+        if hasattr(self, '_fixed'):
+            return self.purchase_amount + self._fixed['purchase']
         purchase = self.purchase_amount
         for fixer in self.fixers():
             purchase += fixer.purchase_amount
@@ -202,6 +254,9 @@ class Transaction(models.Model):
 
     class Meta:
         ordering = ['timestamp']
+        # recordtransactions relies on this to never double-post a batch
+        unique_together = ('register_no', 'trans_no', 'trans_id',
+                'is4c_cashier_id', 'is4c_date')
         
 
 class EBTBulkOrderManager(models.Manager):
@@ -240,6 +295,8 @@ class EBTBulkOrder(models.Model):
             if oldself.paid_by_transaction:
                 raise AssertionError, "cannot edit EBT bulk order already paid"
         super(EBTBulkOrder, self).save(*args, **kwargs)
+        # the registers show unpaid bulk orders with the account flags
+        m_models.touch_accounts(Account.objects.filter(id=self.account_id))
 
 
 class StoreDay(models.Model):
@@ -255,9 +312,80 @@ class StoreDay(models.Model):
             return later[0].start
     #end = property(get_end)
 
+    def save(self, *args, **kwargs):
+        # the start may have moved, so the snapshot is retaken nightly
+        if self.id:
+            self.balancesnapshot_set.all().delete()
+        super(StoreDay, self).save(*args, **kwargs)
+
     class Meta:
         ordering = ['start']
 
+class BalanceSnapshot(models.Model):
+    '''
+    An account's balance at the start of a StoreDay, so total_balances_on
+    only needs the transactions since then.  Accounts with a zero (or no)
+    balance get no row.  Taken nightly by cron_nightly --maintenance.  last_transaction
+    is the newest transaction id when it was taken: later ones dated before
+    the StoreDay were back-dated, and their accounts' balances are looked 
+    up again.
+    '''
+    store_day = models.ForeignKey(StoreDay)
+    account = models.ForeignKey(Account)
+    balance = models.DecimalField(max_digits=8, decimal_places=2)
+    last_transaction = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('store_day', 'account')
+
+class DailyTotal(models.Model):
+    '''
+    Sum and count of an account's purchase or payment amounts of one type 
+    on one day, so reports over whole days needn't scan the transactions.
+    Transaction saves keep them current; rebuild_daily_totals() recomputes 
+    them in bulk and marks the days it did in TotaledDay.
+    '''
+    account = models.ForeignKey(Account)
+    day = models.DateField()
+    kind = models.CharField(max_length=8, 
+                            choices=(('purchase', 'Purchase'), 
+                                     ('payment', 'Payment')))
+    type = models.CharField(max_length=1)
+    total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('account', 'day', 'kind', 'type')
+
+def add_to_daily_total(key, amount):
+    '''
+    Adds one amount to the DailyTotal with key (account, day, kind and 
+    type), creating it if need be.  When two registers create the same one
+    at once, the unique key stops the second, which adds to the first's.
+    '''
+    daily = DailyTotal.objects.filter(**key)
+    change = {'total': F('total') + amount, 'count': F('count') + 1}
+    if daily.update(**change):
+        return
+    managed = transaction.is_managed()
+    if managed:
+        sid = transaction.savepoint()
+    try:
+        DailyTotal.objects.create(total=amount, count=1, **key)
+    except IntegrityError:
+        if managed:
+            transaction.savepoint_rollback(sid)
+        else:
+            transaction.rollback_unless_managed()
+        daily.update(**change)
+    else:
+        if managed:
+            transaction.savepoint_commit(sid)
+
+class TotaledDay(models.Model):
+    ''' a day whose DailyTotals are complete '''
+    day = models.DateField(unique=True)
+
 class Reconciliation(models.Model):
     # reconciled_by provides a record of who did the reconciling, and could 
     # relate to Member or User, and overlaps with 
@@ -272,20 +400,201 @@ class Reconciliation(models.Model):
     def __unicode__(self):
         return unicode(self.date)
 
+# Picks each account's newest transaction t before a time: no later 
+# transaction of the account comes before it.  Ties on timestamp go to the 
+# later id, which is the one saved with the resulting balance.
+NEWEST_BEFORE_SQL = '''t.timestamp < %s AND NOT EXISTS (
+            SELECT 1 FROM accounting_transaction later
+            WHERE later.account_id = t.account_id AND later.timestamp < %s
+            AND (later.timestamp > t.timestamp OR 
+                 (later.timestamp = t.timestamp AND later.id > t.id)))'''
+
+def db_timestamp(time):
+    ''' time (a date or datetime) as the ORM would pass it to the database '''
+    return Transaction._meta.get_field('timestamp').get_db_prep_value(time,
+            connection=connection)
+
+def db_decimal(value):
+    ''' sqlite sums decimals as floats '''
+    if value is None:
+        return Decimal(0)
+    return Decimal(str(value)).quantize(Decimal('.01'))
+
 def total_balances_on(time):
-    ''' I want to do something more like...
-        select sum(account_balance) from accounting_transaction t
-        where t.timestamp < %s
-        and not exists (
-            select 1 from accounting_transaction
-            where account_id=t.account_id and timestamp > t.timestamp
-            and timestamp < %s )
-        But I can't figure how to translate that kind of SQL into Django...
     '''
-    total = 0
-    for account in m_models.Account.objects.all():
-        total += account.balance_on(time) or 0
-    return total
+    Sum of every account's balance_on(time), in one query.  With a 
+    BalanceSnapshot before time, that's the snapshot total, adjusted for the 
+    accounts with transactions since, or back-dated to before it.
+    '''
+    snapshots = StoreDay.objects.filter(start__lte=time, 
+            balancesnapshot__isnull=False).order_by('-start')[:1]
+    cursor = connection.cursor()
+    time = db_timestamp(time)
+    if not snapshots:
+        cursor.execute('''
+            SELECT SUM(t.account_balance) FROM accounting_transaction t
+            WHERE ''' + NEWEST_BEFORE_SQL, [time, time])
+        return db_decimal(cursor.fetchone()[0])
+    since = snapshots[0]
+    cursor.execute('''
+        SELECT (SELECT SUM(balance) FROM accounting_balancesnapshot
+                WHERE store_day_id = %s),
+               SUM(t.account_balance), SUM(s.balance)
+        FROM accounting_transaction t
+        LEFT JOIN accounting_balancesnapshot s 
+        ON s.account_id = t.account_id AND s.store_day_id = %s
+        WHERE (t.timestamp >= %s OR t.account_id IN (
+            SELECT account_id FROM accounting_transaction
+            WHERE timestamp < %s AND id > (
+                SELECT MAX(last_transaction) FROM accounting_balancesnapshot
+                WHERE store_day_id = %s)))
+        AND ''' + NEWEST_BEFORE_SQL,
+        [since.id, since.id, db_timestamp(since.start), 
+         db_timestamp(since.start), since.id, time, time])
+    snapshot_total, newest_total, replaced_total = cursor.fetchone()
+    return (db_decimal(snapshot_total) + db_decimal(newest_total) - 
+            db_decimal(replaced_total))
+
+@commit_on_success
+def take_balance_snapshot(store_day):
+    ''' (re)takes the BalanceSnapshot of every account for store_day '''
+    store_day.balancesnapshot_set.all().delete()
+    start = db_timestamp(store_day.start)
+    cursor = connection.cursor()
+    cursor.execute('''
+        INSERT INTO accounting_balancesnapshot (store_day_id, account_id, 
+                                                balance, last_transaction)
+        SELECT %s, t.account_id, t.account_balance, 
+               (SELECT MAX(id) FROM accounting_transaction)
+        FROM accounting_transaction t
+        WHERE t.account_balance <> 0 AND ''' + NEWEST_BEFORE_SQL,
+        [store_day.id, start, start])
+    set_dirty()
+
+def totals_by_key(rows, fields, group_by):
+    totals = {}
+    for row in rows:
+        key = tuple([row[field] for field in fields])
+        if not group_by:
+            key = key[0]
+        totals[key] = (row['sum_total'], row['sum_count'])
+    return totals
+
+def type_totals(transactions, kind, *group_by):
+    '''
+    Sums and counts of the kind ('purchase' or 'payment') amounts in a
+    Transaction queryset, by kind type, in one grouped query.  Returns
+    {type: (total, count)}, or {(group_by values..., type): (total, count)}.
+    Untyped amounts aren't counted, e.g. the purchase side of a payment.
+    '''
+    type_field, amount_field = '%s_type' % kind, '%s_amount' % kind
+    fields = group_by + (type_field,)
+    rows = transactions.exclude(**{type_field: ''}).order_by().values(
+            *fields).annotate(sum_total=Sum(amount_field), 
+                              sum_count=Count('id'))
+    return totals_by_key(rows, fields, group_by)
+
+def daily_type_totals(kind, start, end, *group_by, **filters):
+    '''
+    Like type_totals, for all transactions from day start until (not 
+    including) day end, read from DailyTotals; check daily_totals_cover 
+    first.  filters apply to DailyTotal.
+    '''
+    fields = group_by + ('type',)
+    rows = DailyTotal.objects.filter(kind=kind, day__gte=start, day__lt=end,
+            **filters).order_by().values(*fields).annotate(
+            sum_total=Sum('total'), sum_count=Sum('count'))
+    return totals_by_key(rows, fields, group_by)
+
+def is_midnight(time):
+    return not isinstance(time, datetime) or time.time() == datetime.min.time()
+
+def daily_totals_cover(start, end):
+    '''
+    Whether DailyTotals can stand in for the transactions from start until 
+    end: both at midnight, and every day until today totaled.
+    '''
+    if not (is_midnight(start) and is_midnight(end)):
+        return False
+    start, end = date(start.year, start.month, start.day), min(
+            date(end.year, end.month, end.day), date.today() + timedelta(1))
+    days = (end - start).days
+    return days <= 0 or TotaledDay.objects.filter(day__gte=start, 
+                                                  day__lt=end).count() == days
+
+@commit_on_success
+def rebuild_daily_totals(start, end):
+    ''' recomputes the DailyTotals of the days from start until end '''
+    DailyTotal.objects.filter(day__gte=start, day__lt=end).delete()
+    TotaledDay.objects.filter(day__gte=start, day__lt=end).delete()
+    cursor = connection.cursor()
+    for kind in ('purchase', 'payment'):
+        cursor.execute('''
+            INSERT INTO accounting_dailytotal (account_id, day, kind, type,
+                                               total, count)
+            SELECT account_id, date(timestamp), %%s, %(kind)s_type, 
+                   SUM(%(kind)s_amount), COUNT(*)
+            FROM accounting_transaction
+            WHERE timestamp >= %%s AND timestamp < %%s AND %(kind)s_type <> ''
+            GROUP BY account_id, date(timestamp), %(kind)s_type
+            ''' % {'kind': kind}, [kind, db_timestamp(start), 
+                                    db_timestamp(end)])
+    set_dirty()
+    day = start
+    while day < end:
+        TotaledDay.objects.create(day=day)
+        day += timedelta(1)
+
+def with_fixes(transactions):
+    '''
+    Returns the transactions as a list, with the sums of their fixers 
+    loaded in a grouped query per 500 transactions, so fixers(), 
+    fixed_payment_amount() and fixed_purchase_amount() don't query per 
+    transaction.
+    '''
+    transactions = list(transactions)
+    ids = [trans.id for trans in transactions]
+    fixes = {}
+    # chunks keep under sqlite's limit of 999 query parameters
+    for i in range(0, len(ids), 500):
+        for row in Transaction.objects.filter(fixes__in=ids[i:i + 500]
+                ).order_by().values('fixes').annotate(
+                payment=Sum('payment_amount'), 
+                purchase=Sum('purchase_amount'), count=Count('id')):
+            fixes[row['fixes']] = row
+    for trans in transactions:
+        trans._fixed = fixes.get(trans.id, {'payment': 0, 'purchase': 0,
+                                            'count': 0})
+    return transactions
+
+class TransactionSummary(object):
+    '''
+    Purchase and payment totals and counts by type for a Transaction 
+    queryset, in two queries.  Or pass days=(start, end) to read them from
+    DailyTotals (see daily_totals_cover).
+    '''
+    def __init__(self, transactions=None, days=None):
+        if days:
+            self.purchases = daily_type_totals('purchase', *days)
+            self.payments = daily_type_totals('payment', *days)
+        else:
+            self.purchases = type_totals(transactions, 'purchase')
+            self.payments = type_totals(transactions, 'payment')
+        self.purchases_total = sum([self.purchases.get(code, (0, 0))[0] 
+                                    for code, type in PURCHASE_CHOICES])
+        self.payments_total = sum([self.payments.get(code, (0, 0))[0] 
+                                   for code, type in PAYMENT_CHOICES])
+
+    def _by_type(self, totals, choices):
+        return [{'type': type, 'total': totals.get(code, (None, 0))[0], 
+                 'count': totals.get(code, (None, 0))[1]}
+                for code, type in choices]
+
+    def purchases_by_type(self):
+        return self._by_type(self.purchases, PURCHASE_CHOICES)
+
+    def payments_by_type(self):
+        return self._by_type(self.payments, PAYMENT_CHOICES)
 
 @commit_on_success
 def commit_potential_bills(accounts, bill_type, entered_by):
@@ -295,3 +604,30 @@ def commit_potential_bills(accounts, bill_type, entered_by):
                            purchase_amount=account.potential_bill,
                            entered_by=entered_by)
         bill.save()
+
+@commit_on_success
+def save_transactions(transactions):
+    '''
+    Saves a list of new transactions in one database transaction.  Balances
+    and equity run in memory, so each account and member they change is 
+    saved once at the end rather than once per transaction.
+    '''
+    accounts = {}
+    members = {}
+    changed = []
+    for trans in transactions:
+        # share one instance per account/member so the balances accumulate
+        trans.account = accounts.setdefault(trans.account.id, trans.account)
+        if trans.member:
+            trans.member = members.setdefault(trans.member.id, trans.member)
+        for obj in trans.update_balances():
+            if obj not in changed:
+                changed.append(obj)
+        trans.link_fixes()
+        super(Transaction, trans).save()
+        trans.add_to_daily_totals()
+    for obj in changed:
+        obj.save()
+
+# the tables cached reports read, see mess.core.dataversion
+dataversion.track(HoursTransaction, Transaction, EBTBulkOrder, Reconciliation)
@@ -0,0 +1,206 @@
+'''
+Bulk account snapshots.
+
+Account.frozen_flags(), max_allowed_to_owe(), discount and friends each run
+several queries, which adds up to thousands of queries when we need them for
+every account (the IS4C accounts feed, the cash sheet).  account_snapshots()
+computes the same values for any number of accounts in a fixed number of
+grouped queries, using the shared rules in mess.membership.models.
+'''
+import datetime
+
+from django.db.models.aggregates import Count
+from django.template import Context
+from django.template.loader import get_template
+
+from mess.accounting.models import EBTBulkOrder
+from mess.membership import models as m_models
+from mess.scheduling import models as s_models
+
+
+class AccountSnapshot(object):
+    '''
+    Read-only copy of the account values the registers and cash sheets use.
+    Built by account_snapshots(); don't construct directly.
+    '''
+    def __init__(self, account):
+        self.account = account
+        self.id = account.id
+        self.name = account.name
+        self.balance = account.balance
+        self.hours_balance = account.hours_balance
+        self.can_shop = account.can_shop
+        self.ebt_only = account.ebt_only
+        self.sync_version = account.sync_version
+        self.active_member_count = 0
+        self.billable_member_count = 0
+        self.billable_work_statuses = []
+        self.days_old = -1
+        self.satisfactions = 0
+        self.temporary_limit = None
+        self.has_unpaid_ebt_bulk_order = False
+
+    def finish(self):
+        ''' derive the computed values once all the counts are in '''
+        self.discount = m_models.account_discount(self.billable_work_statuses)
+        self.max_allowed_to_owe = m_models.account_max_allowed_to_owe(
+                self.temporary_limit, self.days_old, self.active_member_count)
+        self.frozen_flags = m_models.account_frozen_flags(self,
+                self.max_allowed_to_owe, self.billable_member_count,
+                self.active_member_count, self.satisfactions, self.days_old)
+
+    def __unicode__(self):
+        return self.name
+
+
+class MembershipView(object):
+    '''
+    One pass over the AccountMember links of a set of accounts, with the
+    member facts needed to tell active, present and billable memberships
+    apart, plus current LOAs and shift counts.  Shared by everything that
+    needs per-account member counts in bulk.
+    '''
+    def __init__(self, accounts):
+        today = datetime.date.today()
+        members = m_models.Member.objects.filter(
+                accountmember__account__in=accounts)
+        self.links = {}
+        for link in m_models.AccountMember.objects.filter(
+                account__in=accounts).values('account', 'member', 'shopper',
+                'member__work_status', 'member__date_joined',
+                'member__date_missing', 'member__date_departed',
+                'member__user__username'):
+            self.links.setdefault(link['account'], []).append(link)
+        self.on_leave = set(m_models.LeaveOfAbsence.objects.current(
+                ).filter(member__in=members).values_list('member', flat=True))
+        # order_by() keeps Task's default ordering out of the GROUP BY
+        tasks = s_models.Task.objects.filter(member__in=members).order_by()
+        self.task_counts = dict(tasks.values_list('member').annotate(
+                Count('id')))
+        self.future_task_counts = dict(tasks.filter(time__gte=today
+                ).values_list('member').annotate(Count('id')))
+
+    def is_active(self, link):
+        return not (link['member__date_missing'] or
+                    link['member__date_departed'])
+
+    def is_present(self, link):
+        return self.is_active(link) and link['member'] not in self.on_leave
+
+    def satisfies(self, link):
+        '''
+        How many rows this link adds to the satisfactions count in
+        Account.frozen_flags.  That query ORs a condition on the member
+        with a join on member__task, so it counts one row per joined task.
+        '''
+        if link['member__work_status'] in 'ecn' and not link['shopper']:
+            return max(self.task_counts.get(link['member'], 0), 1)
+        return self.future_task_counts.get(link['member'], 0)
+
+    def fill(self, snapshot):
+        links = self.links.get(snapshot.id, [])
+        billable = []
+        joined = []
+        for link in links:
+            snapshot.satisfactions += self.satisfies(link)
+            if not self.is_active(link):
+                continue
+            joined.append(link['member__date_joined'])
+            if link['shopper']:
+                continue
+            snapshot.active_member_count += 1
+            if self.is_present(link):
+                billable.append(link)
+        billable.sort(key=lambda link: link['member__user__username'])
+        snapshot.billable_member_count = len(billable)
+        snapshot.billable_work_statuses = [link['member__work_status']
+                                           for link in billable]
+        if joined:
+            snapshot.days_old = (datetime.date.today() - min(joined)).days
+
+
+def account_snapshots(accounts=None):
+    '''
+    Returns an AccountSnapshot for each account in the given Account
+    queryset (all accounts by default), in queryset order.  The number of
+    queries doesn't depend on the number of accounts.
+    '''
+    if accounts is None:
+        accounts = m_models.Account.objects.all()
+    snapshots = [AccountSnapshot(account) for account in accounts]
+    memberships = MembershipView(accounts)
+    # like temporarybalancelimit_set.current()[0], the first limit wins
+    limits = {}
+    for account_id, limit in m_models.TemporaryBalanceLimit.objects.current(
+            ).filter(account__in=accounts).order_by('-id').values_list(
+            'account', 'limit'):
+        limits[account_id] = limit
+    unpaid = set(EBTBulkOrder.objects.unpaid().filter(account__in=accounts
+            ).values_list('account', flat=True))
+    for snapshot in snapshots:
+        memberships.fill(snapshot)
+        snapshot.temporary_limit = limits.get(snapshot.id)
+        snapshot.has_unpaid_ebt_bulk_order = snapshot.id in unpaid
+        snapshot.finish()
+    return snapshots
+
+def render_acct_flags(snapshots):
+    '''
+    Sets html_flags on each snapshot to the accounting/snippets/acct_flags.html
+    snippet.  The snippet only depends on the flags and unpaid EBT bulk
+    orders, so each distinct combination is rendered once.
+    '''
+    template = get_template('accounting/snippets/acct_flags.html')
+    rendered = {}
+    for snapshot in snapshots:
+        flags = snapshot.frozen_flags
+        key = (flags is not None and tuple(flags),
+               snapshot.has_unpaid_ebt_bulk_order)
+        if key not in rendered:
+            rendered[key] = template.render(Context({'account': {
+                'frozen_flags': flags,
+                'ebtbulkorder_set':
+                    {'unpaid': snapshot.has_unpaid_ebt_bulk_order},
+            }}))
+        snapshot.html_flags = rendered[key]
+
+
+class CashSheetRow(object):
+    ''' One line of the printed cash sheet, see cashsheet_rows(). '''
+    __slots__ = ('name', 'url', 'recent_cashier', 'max_allowed_to_owe',
+                 'hours_balance', 'balance', 'frozen_flags')
+
+    def __init__(self, snapshot, member_count, recent_cashier):
+        self.name = snapshot.name
+        self.url = snapshot.account.get_absolute_url()
+        self.recent_cashier = recent_cashier
+        self.max_allowed_to_owe = snapshot.max_allowed_to_owe
+        self.hours_balance = snapshot.hours_balance
+        self.balance = snapshot.balance
+        # accounts without members are special accounts like !Mariposa
+        self.frozen_flags = member_count and snapshot.frozen_flags or None
+
+def cashsheet_rows():
+    '''
+    Returns the CashSheetRows for the cash sheet: the ! accounts ("Mariposa"
+    and "UNCLAIMED") at the top, then every present account, in a fixed 
+    number of queries.
+    '''
+    today = datetime.date.today()
+    account_ids = (list(m_models.Account.objects.filter(name__startswith='!'
+                        ).values_list('id', flat=True)) +
+                   list(m_models.Account.objects.present(
+                        ).values_list('id', flat=True)))
+    accounts = m_models.Account.objects.filter(id__in=account_ids)
+    snapshots = account_snapshots(accounts)
+    m_models.cache_frozen_flags(snapshots)
+    member_counts = dict(m_models.AccountMember.objects.filter(
+            account__in=accounts).order_by().values_list('account'
+            ).annotate(Count('id')))
+    recent_cashiers = set(s_models.Task.objects.filter(account__in=accounts,
+            job__name='Cashier', time__range=(today - datetime.timedelta(120),
+            today)).values_list('account', flat=True))
+    by_id = dict([(snapshot.id, snapshot) for snapshot in snapshots])
+    return [CashSheetRow(by_id[account_id], member_counts.get(account_id, 0),
+                         account_id in recent_cashiers)
+            for account_id in account_ids]
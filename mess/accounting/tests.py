@@ -0,0 +1,120 @@
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from mess.accounting import models
+from mess.is4c.views import record
+from mess.membership import models as m_models
+
+class AccountingTestCase(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='shopper', first_name='Pat',
+                                   last_name='Shopper')
+        self.member = m_models.Member.objects.create(user=user)
+        self.account = m_models.Account.objects.create(name='Shopper')
+
+    def purchase(self, account, amount, timestamp):
+        ''' saves a purchase, then dates it timestamp '''
+        trans = models.Transaction(account=account, member=self.member,
+                purchase_type='P', purchase_amount=Decimal(amount))
+        trans.save()
+        models.Transaction.objects.filter(id=trans.id).update(
+                timestamp=timestamp)
+        return trans
+
+class RecordBatchTest(AccountingTestCase):
+    def item(self, trans_id, amount):
+        ''' a line item as IS4C posts it '''
+        return {'account': self.account.id, 'member': self.member.id,
+                'register_no': 1, 'trans_no': 7, 'trans_id': trans_id,
+                'is4c_cashier_id': 3, 'date': '2012-03-01 10:15:00',
+                'purchase_type': 'P', 'purchase_amount': amount}
+
+    def test_repeated_batch_writes_nothing(self):
+        batch = [self.item(1, '10.00'), self.item(2, '2.50')]
+        results, missing = record(batch)
+        self.assertEqual(['recorded', 'recorded'],
+                         [result['status'] for result in results])
+        ids = [result['id'] for result in results]
+        count = models.Transaction.objects.count()
+
+        results, missing = record(batch)
+        self.assertEqual(['duplicate', 'duplicate'],
+                         [result['status'] for result in results])
+        self.assertEqual(ids, [result['id'] for result in results])
+        self.assertEqual(count, models.Transaction.objects.count())
+        self.assertEqual(Decimal('12.50'),
+                m_models.Account.objects.get(id=self.account.id).balance)
+
+    def test_duplicate_within_batch(self):
+        results, missing = record([self.item(1, '10.00'),
+                                   self.item(1, '10.00')])
+        self.assertEqual(['recorded', 'duplicate'],
+                         [result['status'] for result in results])
+        self.assertEqual(results[0]['id'], results[1]['id'])
+        self.assertEqual(1, models.Transaction.objects.count())
+
+class TotalBalancesTest(AccountingTestCase):
+    def setUp(self):
+        super(TotalBalancesTest, self).setUp()
+        self.other = m_models.Account.objects.create(name='Other')
+        self.store_day = models.StoreDay.objects.create(
+                start=datetime(2012, 3, 2, 6))
+
+    def assertTotal(self, expected, time):
+        ''' checks total_balances_on(time) with the snapshot and without '''
+        self.assertTrue(models.BalanceSnapshot.objects.exists())
+        self.assertEqual(Decimal(expected), models.total_balances_on(time))
+        snapshots = list(models.BalanceSnapshot.objects.all())
+        models.BalanceSnapshot.objects.all().delete()
+        self.assertEqual(Decimal(expected), models.total_balances_on(time))
+        for snapshot in snapshots:
+            snapshot.save()
+
+    def test_snapshot_matches_transactions(self):
+        self.purchase(self.account, '10.00', datetime(2012, 3, 1, 10))
+        self.purchase(self.other, '5.00', datetime(2012, 3, 1, 11))
+        models.take_balance_snapshot(self.store_day)
+        self.purchase(self.account, '7.00', datetime(2012, 3, 3, 10))
+        self.assertTotal('15.00', datetime(2012, 3, 2, 12))
+        self.assertTotal('22.00', datetime(2012, 3, 4))
+
+    def test_backdated_before_snapshot(self):
+        self.purchase(self.account, '10.00', datetime(2012, 3, 1, 10))
+        models.take_balance_snapshot(self.store_day)
+        self.purchase(self.other, '4.00', datetime(2012, 3, 1, 12))
+        self.purchase(self.account, '1.00', datetime(2012, 3, 1, 13))
+        self.assertTotal('15.00', datetime(2012, 3, 4))
+
+class TransactionSummaryTest(AccountingTestCase):
+    def summary(self, summary):
+        return ([(row['type'], models.db_decimal(row['total']), row['count'])
+                 for row in summary.purchases_by_type()],
+                [(row['type'], models.db_decimal(row['total']), row['count'])
+                 for row in summary.payments_by_type()],
+                models.db_decimal(summary.purchases_total),
+                models.db_decimal(summary.payments_total))
+
+    def assertSummariesMatch(self):
+        today = date.today()
+        days = (today, today + timedelta(1))
+        scanned = models.TransactionSummary(models.Transaction.objects.filter(
+                timestamp__gte=days[0], timestamp__lt=days[1]))
+        self.assertEqual(self.summary(scanned), 
+                         self.summary(models.TransactionSummary(days=days)))
+
+    def test_daily_totals_match_transactions(self):
+        for purchase_type, amount in (('P', '10.00'), ('P', '2.25'),
+                                      ('B', '30.00'), ('O', '25.00')):
+            models.Transaction(account=self.account, member=self.member, 
+                    purchase_type=purchase_type, 
+                    purchase_amount=Decimal(amount)).save()
+        models.Transaction(account=self.account, member=self.member,
+                payment_type='C', payment_amount=Decimal('40.00')).save()
+        self.assertSummariesMatch()
+        # and once recomputed in bulk
+        today = date.today()
+        models.rebuild_daily_totals(today, today + timedelta(1))
+        self.assertSummariesMatch()
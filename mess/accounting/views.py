@@ -9,14 +9,16 @@ from django.db.models import Q
 from django.db.models.aggregates import Sum
 from django.http import HttpResponseRedirect, HttpResponse, Http404
 from django.shortcuts import render_to_response, get_object_or_404
-from django.template import RequestContext
+from django.template import Context, RequestContext
 from django.template.loader import get_template
 from django.utils import simplejson
+from django.utils.safestring import mark_safe
 from django.views.decorators.csrf import csrf_exempt
 from django.forms.formsets import formset_factory
 
 from mess.accounting import forms, models
 from mess.accounting.forms import TransactionForm, CloseOutForm
+from mess.accounting.snapshot import cashsheet_rows
 from mess.membership import models as m_models
 from mess.core.permissions import has_elevated_perm
 from mess.core.context_processors import cashier_permission
@@ -207,21 +209,25 @@ def close_out(request, date=None):
         date = datetime.date.today()
 
     trans = models.Transaction.objects.filter(
-                   timestamp__range=(date, date+datetime.timedelta(1)))
-
-    columns = [{'type': 'Credit / Debit', 'total': 0,
-                'transactions': trans.filter(payment_type__in=('C','D'))},
-               {'type': 'Check / Money Order', 'total': 0,
-                'transactions': trans.filter(payment_type__in=('K','M'))},
-               {'type': 'EBT', 'total': 0,
-                'transactions': trans.filter(payment_type='E')}]
+                   timestamp__range=(date, date+datetime.timedelta(1))
+                   ).select_related('account')
+    if 'order_by' in request.GET:
+        order_by = request.GET['order_by']
+        trans = trans.order_by(order_by)
+    trans = models.with_fixes(trans)
+
+    columns = [{'type': 'Credit / Debit', 'total': 0, 'payment_types': 'CD'},
+               {'type': 'Check / Money Order', 'total': 0, 
+                'payment_types': 'KM'},
+               {'type': 'EBT', 'total': 0, 'payment_types': 'E'}]
     for column in columns:
-        if 'order_by' in request.GET:
-            order_by = request.GET['order_by']
-            column['transactions'] = column['transactions'].order_by(order_by)
-        for trans in column['transactions']:
-            if not trans.fixes_target():
-                column['total'] += trans.fixed_payment_amount()
+        column['transactions'] = [t for t in trans 
+                                  if t.payment_type 
+                                  and t.payment_type in column['payment_types']]
+        # corrections are counted with the transactions they fix
+        for t in column['transactions']:
+            if not t.fixes_id:
+                column['total'] += t.fixed_payment_amount()
 
     return render_to_response('accounting/close_out.html', locals(),
             context_instance=RequestContext(request))
@@ -238,11 +244,30 @@ def cashsheet(request):
     else:
         row_height = 2.5
         rows_per_page = 25
-    # include ! accounts at top ("Mariposa" and "UNCLAIMED")
-    accounts = (list(m_models.Account.objects.filter(name__startswith='!')) +
-                list(m_models.Account.objects.present()))
-    return render_to_response('accounting/cashsheet.html', locals(),
-            context_instance=RequestContext(request))
+    return HttpResponse(render_cashsheet('accounting/cashsheet.html',
+            RequestContext(request, {'form': form, 'row_height': row_height}),
+            rows_per_page))
+
+CASHSHEET_PAGES = mark_safe('<!-- cash sheet pages -->')
+
+def render_cashsheet(template_name, context, rows_per_page):
+    '''
+    Yields the cash sheet in chunks: the page around the sheet is rendered
+    once, then each sheet page from the accounting/snippets/cashsheet_page.html
+    snippet, so big sheets stream instead of piling up in memory.
+    template_name is accounting/cashsheet.html or a template extending it.
+    '''
+    rows = cashsheet_rows()
+    context['pages'] = CASHSHEET_PAGES
+    head, tail = get_template(template_name).render(context).split(
+            CASHSHEET_PAGES)
+    yield head
+    page_template = get_template('accounting/snippets/cashsheet_page.html')
+    rows_per_page = max(rows_per_page, 1)
+    for start in range(0, len(rows), rows_per_page):
+        yield page_template.render(Context({
+                'rows': rows[start:start + rows_per_page]}))
+    yield tail
 
 def frozen(request):
     # list of accounts that are frozen on the cash sheets
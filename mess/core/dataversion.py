@@ -0,0 +1,97 @@
+'''
+Per-table data versions, for caches of results read from whole tables (the
+list report, see mess.reporting.results, and the rotation board).
+
+Only the tables cached pages read have a version.  Each app passes its
+models to track(), which marks a model's table changed whenever one of
+its rows is saved or deleted; code that writes with QuerySet.update() or
+raw SQL calls changed() itself.  Bookkeeping tables (SyncVersion,
+DailyTotal, OpenSlot, the search index...) are never tracked.  A cache
+that only reads part of a table can also keep versions of its own, under
+names it passes to changed_names() and name_versions(), so changes to the
+rest of the table leave it be (scheduling keeps one per day of tasks).
+
+Marking a table costs no query.  The marked tables' counters in
+DataVersion are moved on by flush(), once each, after the writes have
+committed: DataVersionMiddleware does it at the end of every request, and
+code that writes outside a request (cron_nightly --maintenance) calls it itself.  A
+reader that caches what it read before the commit does so under the old
+version, which the flush leaves behind, so a result cached under the
+versions of the tables it read is good until any of them moves on.
+Writers never wait on one another for the counters, since a flush holds
+them only for its own short UPDATEs.
+'''
+import threading
+
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+
+_local = threading.local()
+
+def pending():
+    ''' the tables marked changed in this thread since the last flush() '''
+    if not hasattr(_local, 'tables'):
+        _local.tables = set()
+    return _local.tables
+
+def changed(*models):
+    ''' marks the tables of models changed, for the next flush() '''
+    pending().update([model._meta.db_table for model in models])
+
+def changed_names(*names):
+    ''' marks the counters names changed, for the next flush() '''
+    pending().update(names)
+
+def model_changed(sender, **kwargs):
+    changed(sender)
+
+def track(*models):
+    ''' marks the tables of models changed whenever a row is saved or deleted '''
+    for model in models:
+        post_save.connect(model_changed, sender=model,
+                dispatch_uid='mess.core.dataversion.save.%s' %
+                model._meta.db_table)
+        post_delete.connect(model_changed, sender=model,
+                dispatch_uid='mess.core.dataversion.delete.%s' %
+                model._meta.db_table)
+
+def flush():
+    '''
+    Moves the version of each table marked changed on by one.  Call once
+    the writes are committed, outside any managed transaction.
+    '''
+    tables = pending()
+    while tables:
+        bump(tables.pop())
+
+def bump(table_name):
+    ''' moves the version of table_name (or a changed_names() name) on '''
+    # imported here, so the apps' models can import this module
+    from mess.core.models import DataVersion
+    counter = DataVersion.objects.filter(table_name=table_name)
+    if counter.update(version=F('version') + 1):
+        return
+    try:
+        DataVersion.objects.create(table_name=table_name, version=1)
+    except IntegrityError:
+        # another process made the counter first
+        transaction.rollback_unless_managed()
+        counter.update(version=F('version') + 1)
+
+def versions(models):
+    ''' sorted (table, version) pairs for the tables of models '''
+    return sorted(name_versions([model._meta.db_table 
+                                 for model in models]).items())
+
+def name_versions(names):
+    ''' {name: version} for the counters names, tables or changed_names() '''
+    from mess.core.models import DataVersion
+    names = list(set(names))
+    found = dict([(name, 0) for name in names])
+    # chunks keep under sqlite's limit of 999 query parameters
+    for i in range(0, len(names), 500):
+        found.update(DataVersion.objects.filter(
+                table_name__in=names[i:i + 500]
+                ).values_list('table_name', 'version'))
+    return found
@@ -1,7 +1,17 @@
+import datetime
+import logging
+import logging.handlers
+import os
 import re
+import sys
+import time
+from collections import deque
 
 import django.conf as conf
 import django.contrib.auth.decorators as ad 
+from django.db import connections
+
+from mess.core import dataversion
 
 
 class UserPassesTestMiddleware(object):
@@ -66,3 +76,163 @@ class UserPassesTestMiddleware(object):
                 else:  # no test, don't wrap
                     return 
 
+
+
+# the last PERF_RING_SIZE requests profiled by ProfilingMiddleware, newest 
+# last, for reporting.views.perf.  Each is a dict, see process_response.
+recent_requests = deque(maxlen=getattr(conf.settings, 'PERF_RING_SIZE', 1000))
+
+perf_log = logging.getLogger('mess.perf')
+
+MESS_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+THIS_MODULE = os.path.splitext(os.path.abspath(__file__))[0]
+
+def sql_template(sql):
+    ''' sql with IN lists of any length made alike '''
+    return re.sub(r'\(%s(, %s)*\)', '(%s, ...)', sql)
+
+_mess_files = {}
+
+def mess_file(filename):
+    ''' filename relative to MESS_ROOT if it's mess code, else None '''
+    if filename not in _mess_files:
+        path = os.path.abspath(filename)
+        if (path.startswith(MESS_ROOT + os.sep) and 
+            os.path.splitext(path)[0] != THIS_MODULE):
+            _mess_files[filename] = path[len(MESS_ROOT) + 1:]
+        else:
+            _mess_files[filename] = None
+    return _mess_files[filename]
+
+def call_site():
+    ''' file:line of the innermost mess code running a query '''
+    frame = sys._getframe(2)
+    while frame:
+        filename = mess_file(frame.f_code.co_filename)
+        if filename:
+            return '%s:%s %s' % (filename, frame.f_lineno, 
+                                 frame.f_code.co_name)
+        frame = frame.f_back
+    return '?'
+
+
+class ProfilingCursor(object):
+    ''' Times each query into a list of (sql template, seconds, call site). '''
+    def __init__(self, cursor, queries):
+        self.cursor = cursor
+        self.queries = queries
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.queries.append((sql_template(sql), time.time() - start, 
+                                 call_site()))
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.queries.append((sql_template(sql), time.time() - start, 
+                                 call_site()))
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+class ProfilingMiddleware(object):
+    """
+    Records each request's wall time, query count, SQL time and most 
+    repeated SQL in recent_requests and the PERF_LOG_FILE log.  Requests 
+    running more than PERF_QUERY_THRESHOLD queries are logged as warnings 
+    with the lines of code running the queries.
+
+    Put it first in MIDDLEWARE_CLASSES so it times the other middleware too.
+    """
+    def __init__(self):
+        self.threshold = getattr(conf.settings, 'PERF_QUERY_THRESHOLD', 100)
+        log_file = getattr(conf.settings, 'PERF_LOG_FILE', None)
+        if log_file and not perf_log.handlers:
+            handler = logging.handlers.RotatingFileHandler(log_file, 
+                    maxBytes=1024 * 1024, backupCount=5)
+            handler.setFormatter(logging.Formatter(
+                    '%(asctime)s %(levelname)s %(message)s'))
+            perf_log.addHandler(handler)
+            perf_log.setLevel(logging.INFO)
+
+    def process_request(self, request):
+        request._profile = {'start': time.time(), 'queries': [], 
+                            'view': None}
+        for connection in connections.all():
+            # an instance attribute over BaseDatabaseWrapper.cursor; 
+            # connections are thread-local, so this only sees this request
+            connection.cursor = self._cursor_factory(connection, 
+                                                     request._profile)
+
+    def _cursor_factory(self, connection, profile):
+        def cursor():
+            return ProfilingCursor(type(connection).cursor(connection), 
+                                   profile['queries'])
+        return cursor
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, '_profile'):
+            request._profile['view'] = '%s.%s' % (view_func.__module__, 
+                                                  view_func.__name__)
+
+    def process_response(self, request, response):
+        for connection in connections.all():
+            connection.__dict__.pop('cursor', None)
+        profile = getattr(request, '_profile', None)
+        if profile is None:
+            return response
+        queries = profile['queries']
+        repeats = {}
+        for sql, seconds, site in queries:
+            repeats[sql] = repeats.get(sql, 0) + 1
+        repeated = sorted([(count, sql) for sql, count in repeats.items() 
+                           if count > 1], reverse=True)[:3]
+        record = {
+            'time': datetime.datetime.now(),
+            'path': request.path,
+            'view': profile['view'] or request.path,
+            'status': response.status_code,
+            'seconds': time.time() - profile['start'],
+            'queries': len(queries),
+            'sql_seconds': sum([seconds for sql, seconds, site in queries]),
+            'repeated': repeated,
+        }
+        recent_requests.append(record)
+        perf_log.info('%(view)s %(path)s %(status)s %(seconds).3fs '
+                '%(queries)s queries %(sql_seconds).3fs sql' % record)
+        if len(queries) > self.threshold:
+            sites = {}
+            for sql, seconds, site in queries:
+                sites[site] = sites.get(site, 0) + 1
+            perf_log.warning('%s ran %s queries.  Busiest call sites:\n%s\n'
+                    'Most repeated:\n%s' % (request.path, len(queries), 
+                    '\n'.join(['  %5d %s' % (count, site) for count, site in 
+                        sorted([(c, s) for s, c in sites.items()], 
+                               reverse=True)[:10]]),
+                    '\n'.join(['  %5d %s' % (count, sql[:300]) 
+                                for count, sql in repeated])))
+        return response
+
+
+class DataVersionMiddleware(object):
+    """
+    Moves on the data versions of the tables the request changed, once its
+    writes have committed; see mess.core.dataversion.
+    """
+    def process_request(self, request):
+        # changes left over from code run outside a request
+        dataversion.flush()
+
+    def process_response(self, request, response):
+        dataversion.flush()
+        return response
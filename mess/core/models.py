@@ -1,3 +1,12 @@
 from django.db import models
 
-# Create your models here.
+class DataVersion(models.Model):
+    '''
+    A table's data version, or a named part of one's, see 
+    mess.core.dataversion.  Bumped once the changes have committed.
+    '''
+    table_name = models.CharField(max_length=100, unique=True)
+    version = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.table_name, self.version)
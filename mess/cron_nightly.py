@@ -1,7 +1,10 @@
 #!/usr/bin/python
 import datetime
+import itertools
+import optparse
 import smtplib
 import sys
+import time
 
 from os.path import dirname, abspath
 sys.path.append(dirname(dirname(abspath(__file__))))
@@ -13,61 +16,99 @@ setup_environ(settings)
 from django.shortcuts import render_to_response
 from mess.scheduling import models
 from mess.scheduling.views import generate_reminder
-from mess.accounting.views import cashsheet
+from mess.accounting.views import render_cashsheet
 from mess.accounting import forms as a_forms
+from mess.accounting import models as a_models
+from mess.accounting.snapshot import account_snapshots
+from mess.core import dataversion
 from mess.membership import models as m_models
+from mess.membership import searchindex
+from mess.reporting import jobs
 from django.template import loader, Context
 from django.core import mail
 
-def reminder_emails():
+def reminder_messages(day):
+    '''
+    yields the reminder EmailMessage for each task on day's reminder list 
+    whose member has an email address.  The tasks come with their job, 
+    member, user and account in one query; each template is loaded once.
+    '''
+    templates = {}
+    for variant in ['dancer', 'excused', 'scheduled']:
+        templates[variant] = (
+                loader.get_template('scheduling/emails/%s.html' % variant),
+                loader.get_template('scheduling/emails/%s_subject.html' % 
+                                    variant))
+    reminder_tasks = generate_reminder(day).exclude(
+            member__user__email='').distinct().select_related(
+            'job', 'member__user', 'account')
+    for task in reminder_tasks:
+        if task.excused:
+            variant = 'excused'
+        elif task.job.is_dancer():
+            variant = 'dancer'
+        else:
+            variant = 'scheduled'
+        message, subject = [template.render(Context({'task':task}))
+                            for template in templates[variant]]
+        subject = ''.join(subject.splitlines())
+        yield mail.EmailMessage(subject, message, None, 
+                                [task.member.user.email])
+
+def reminder_emails(dry_run=False, batch_size=None):
     '''
     there is no later, paul, there is only now.
     here is some code to send REMINDER EMAILS!
+
+    All of them go over one SMTP connection, batch_size (default 
+    settings.REMINDER_BATCH_SIZE) at a time, timing each batch.  dry_run 
+    only lists them.  To watch them arrive, run a debugging server with
+    python -m smtpd -n -c DebuggingServer localhost:1025
+    and set EMAIL_HOST = 'localhost', EMAIL_PORT = 1025 in settings_local.
     '''
     print "***********************************"
     print "sending email reminders on %s" % datetime.date.today()
     print "***********************************"
 
-    dancer = loader.get_template('scheduling/emails/dancer.html')
-    dancer_subject = loader.get_template(
-            'scheduling/emails/dancer_subject.html')
-    excused = loader.get_template('scheduling/emails/excused.html')
-    excused_subject = loader.get_template(
-            'scheduling/emails/excused_subject.html')
-    scheduled = loader.get_template('scheduling/emails/scheduled.html')
-    scheduled_subject = loader.get_template(
-            'scheduling/emails/scheduled_subject.html')
-
-    reminder_tasks = generate_reminder(datetime.date.today()).exclude(
-            member__user__email='').distinct()
-    for task in reminder_tasks:
-        if task.excused:
-            message = excused.render(Context({'task':task}))
-            subject = excused_subject.render(Context({'task':task}))
-        elif task.job.is_dancer():
-            message = dancer.render(Context({'task':task}))
-            subject = dancer_subject.render(Context({'task':task}))
-        else:
-            message = scheduled.render(Context({'task':task}))
-            subject = scheduled_subject.render(Context({'task':task}))
-        subject = ''.join(subject.splitlines())
-        try:
-            mail.send_mail(subject, message, None, [task.member.user.email])
-        except smtplib.SMTPRecipientsRefused, e:
-            print "SMTP Error: %s" % e
+    batch_size = batch_size or settings.REMINDER_BATCH_SIZE
+    messages = reminder_messages(datetime.date.today())
+    connection = None
+    if not dry_run:
+        connection = mail.get_connection()
+        connection.open()
+    try:
+        batch_number = 0
+        while True:
+            batch = list(itertools.islice(messages, batch_size))
+            if not batch:
+                break
+            batch_number += 1
+            started = time.time()
+            sent = 0
+            for message in batch:
+                if dry_run:
+                    print "would send %s: %s" % (message.to[0], 
+                                                 message.subject)
+                    continue
+                # one at a time, so a refused address only loses its own
+                try:
+                    sent += connection.send_messages([message]) or 0
+                except smtplib.SMTPRecipientsRefused, e:
+                    print "SMTP Error: %s" % e
+            print "batch %s: %s of %s sent in %.2fs" % (batch_number, sent,
+                    len(batch), time.time() - started)
+    finally:
+        if connection:
+            connection.close()
 
 def cashsheet_email():
     '''
     bundles cash sheet report with its print css, then emails it to all staff.
     '''
-    # some code copied from accounting views
-    form = a_forms.CashSheetFormatForm()
-    row_height = 2.5
-    rows_per_page = 22
-    # include ! accounts at top ("Mariposa" and "UNCLAIMED")
-    accounts = (list(m_models.Account.objects.filter(name__startswith='!')) +
-                list(m_models.Account.objects.present()))
-    outfile = render_to_response('accounting/cashsheet_email.html', locals())
+    context = Context({'form': a_forms.CashSheetFormatForm(),
+                       'row_height': 2.5})
+    outfile = ''.join(render_cashsheet('accounting/cashsheet_email.html',
+                                       context, 22))
 
     # get staff email addresses.
     send_to = m_models.Member.objects.filter(user__is_staff=True).values_list('user__email', flat=True)
@@ -84,10 +125,113 @@ def cashsheet_email():
     except smtplib.SMTPRecipientsRefused, e:
         print "SMTP Error: %s" % e
 
-def main():
-    reminder_emails()
+def rebuild_frozen_flags():
+    '''
+    precomputes every account's frozen_flags for the new day, in bulk.
+    '''
+    stats = m_models.frozen_flags_cache_stats(reset=True)
+    print "frozen_flags cache since last rebuild: %(hits)s hits, %(misses)s misses" % stats
+    snapshots = account_snapshots()
+    m_models.cache_frozen_flags(snapshots)
+    print "cached frozen_flags for %s accounts" % len(snapshots)
+
+def take_balance_snapshots():
+    '''
+    snapshots account balances at the start of each past store day that 
+    doesn't have one yet, for reporting's total_balances_on.
+    '''
+    store_days = a_models.StoreDay.objects.filter(
+            start__lte=datetime.datetime.now()).exclude(
+            id__in=a_models.BalanceSnapshot.objects.values('store_day'))
+    for store_day in store_days:
+        a_models.take_balance_snapshot(store_day)
+    print "took balance snapshots for %s store days" % len(store_days)
+
+def retotal_days():
+    '''
+    recomputes the DailyTotals of yesterday and today, in case transactions 
+    changed without save(); or of every day, the first time.
+    '''
+    today = datetime.date.today()
+    start = today - datetime.timedelta(1)
+    if not a_models.TotaledDay.objects.exists():
+        first = a_models.Transaction.objects.order_by('timestamp')[:1]
+        if first:
+            start = first[0].timestamp.date()
+    a_models.rebuild_daily_totals(start, today + datetime.timedelta(1))
+    print "totaled transactions by day since %s" % start
+
+def extend_recur_rules():
+    '''
+    stores every recurring shift up to settings.RECUR_HORIZON_DAYS ahead.
+    '''
+    print "created %s recurring tasks" % models.extend_recur_rules()
+
+def rebuild_open_slots():
+    '''
+    drops yesterday's shifts from the open slots index.
+    '''
+    models.rebuild_open_slots()
+    print "rebuilt open slots"
+
+def delete_old_report_jobs():
+    '''
+    deletes background report jobs older than settings.REPORT_JOB_DAYS, 
+    and their result files.
+    '''
+    count = jobs.delete_old_jobs(settings.REPORT_JOB_DAYS)
+    print "deleted %s old report jobs" % count
+
+def prune_sync_versions():
+    '''
+    deletes the IS4C change log rows older than settings.SYNC_VERSION_DAYS,
+    except tombstones.
+    '''
+    count = m_models.prune_sync_versions(settings.SYNC_VERSION_DAYS)
+    print "pruned %s sync versions" % count
+
+def rebuild_search_index():
+    '''
+    recreates the member and account search index, in case anything 
+    changed without save().
+    '''
+    print "indexed %s search terms" % searchindex.rebuild_index()
+
+def maintenance():
+    '''
+    the nightly upkeep of the stored shifts, indexes, flags, snapshots and 
+    totals.  Run on its own, with --maintenance.
+    '''
+    extend_recur_rules()
+    rebuild_open_slots()
+    rebuild_frozen_flags()
+    rebuild_search_index()
+    take_balance_snapshots()
+    retotal_days()
+    delete_old_report_jobs()
+    prune_sync_versions()
+    # no middleware out here to move on the versions of what changed
+    dataversion.flush()
+
+def main(dry_run=False, batch_size=None):
+    reminder_emails(dry_run, batch_size)
     #cashsheet_email()
 
 if __name__ == "__main__":
-    main()
-
+    parser = optparse.OptionParser()
+    parser.add_option('--dry-run', action='store_true', default=False,
+                      help="only list the reminder emails, sending nothing")
+    parser.add_option('--batch-size', type='int', 
+                      help="reminder emails per batch (default %s)" % 
+                           settings.REMINDER_BATCH_SIZE)
+    parser.add_option('--maintenance', action='store_true', default=False,
+                      help="do the nightly upkeep instead of the reminder "
+                           "emails")
+    options, args = parser.parse_args()
+    if options.maintenance:
+        if options.dry_run:
+            parser.error("--maintenance writes to the database: "
+                         "it has no dry run")
+        maintenance()
+    else:
+        main(options.dry_run, options.batch_size)
@@ -0,0 +1,4 @@
+alter table accounting_balancesnapshot add column "last_transaction" integer NOT NULL DEFAULT 0;
+-- older snapshots don't know which transactions they saw; cron_nightly 
+-- --maintenance takes them again
+delete from accounting_balancesnapshot;
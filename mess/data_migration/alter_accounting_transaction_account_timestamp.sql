@@ -0,0 +1,2 @@
+-- for total_balances_on; the new accounting_balancesnapshot table comes from syncdb
+create index "accounting_transaction_account_timestamp" on "accounting_transaction" ("account_id", "timestamp");
@@ -0,0 +1,3 @@
+-- corrections link to the transaction they fix; run link_transaction_fixes.py after
+alter table "accounting_transaction" add column "fixes_id" integer NULL REFERENCES "accounting_transaction" ("id");
+create index "accounting_transaction_fixes_id" on "accounting_transaction" ("fixes_id");
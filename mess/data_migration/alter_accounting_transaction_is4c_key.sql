@@ -0,0 +1,14 @@
+alter table accounting_transaction add column "is4c_date" date;
+update accounting_transaction set is4c_date = date(is4c_timestamp) where is4c_timestamp is not null;
+create index "accounting_transaction_trans_no" on "accounting_transaction" ("trans_no");
+-- syncdb makes this unique key on new databases.  Before adding it here,
+-- list any IS4C line item recorded twice, with its lowest and highest id,
+-- and delete all but one of each:
+select register_no, trans_no, trans_id, is4c_cashier_id, is4c_date, 
+    count(*), min(id), max(id) from accounting_transaction 
+    where register_no is not null and trans_no is not null 
+        and trans_id is not null and is4c_date is not null
+    group by register_no, trans_no, trans_id, is4c_cashier_id, is4c_date
+    having count(*) > 1;
+drop index if exists "accounting_transaction_is4c_key";
+create unique index "accounting_transaction_is4c_key" on "accounting_transaction" ("register_no", "trans_no", "trans_id", "is4c_cashier_id", "is4c_date");
@@ -0,0 +1,5 @@
+-- run manage.py syncdb as well, to create the membership_syncversion table
+alter table membership_account add column "sync_version" integer NOT NULL DEFAULT 0;
+alter table membership_member add column "sync_version" integer NOT NULL DEFAULT 0;
+create index "membership_account_sync_version" on "membership_account" ("sync_version");
+create index "membership_member_sync_version" on "membership_member" ("sync_version");
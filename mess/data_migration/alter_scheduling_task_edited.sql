@@ -0,0 +1,2 @@
+alter table scheduling_task add column "edited" bool NOT NULL DEFAULT '0';
+-- then run trim_recurring_tasks.py, which marks the stored changed tasks
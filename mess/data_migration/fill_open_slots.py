@@ -0,0 +1,21 @@
+'''
+Fills the scheduling_openslot index (created by syncdb) from the tasks 
+already scheduled.  Run once after syncdb; 'cron_nightly.py 
+--maintenance' rebuilds it every night after that.  Safe to run again.
+'''
+
+import sys
+from os.path import dirname, abspath
+sys.path.append(dirname(dirname(abspath(__file__))))
+import settings
+from django.core.management import setup_environ
+setup_environ(settings)
+
+from mess.scheduling import models
+
+def main():
+    models.rebuild_open_slots()
+    print "indexed %s open slots" % models.OpenSlot.objects.count()
+
+if __name__ == "__main__":
+    main()
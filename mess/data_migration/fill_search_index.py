@@ -0,0 +1,21 @@
+'''
+Fills the member and account search index (membership_searchterm and 
+membership_searchgram, created by syncdb) from the existing members and
+accounts.  Run once after syncdb; saves keep it current after that, and
+'cron_nightly.py --maintenance' rebuilds it every night.  Safe to run again.
+'''
+
+import sys
+from os.path import dirname, abspath
+sys.path.append(dirname(dirname(abspath(__file__))))
+import settings
+from django.core.management import setup_environ
+setup_environ(settings)
+
+from mess.membership import searchindex
+
+def main():
+    print "indexed %s search terms" % searchindex.rebuild_index()
+
+if __name__ == "__main__":
+    main()
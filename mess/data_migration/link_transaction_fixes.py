@@ -0,0 +1,29 @@
+'''
+Fills in Transaction.fixes for corrections saved before it existed, from
+their "@id ..." notes.  Run once after alter_accounting_transaction_fixes.sql.
+Safe to run again.
+'''
+
+import sys
+from os.path import dirname, abspath
+sys.path.append(dirname(dirname(abspath(__file__))))
+import settings
+from django.core.management import setup_environ
+setup_environ(settings)
+
+from django.db.transaction import commit_on_success
+from mess.accounting import models
+
+@commit_on_success
+def main():
+    linked = 0
+    for trans in models.Transaction.objects.filter(note__startswith='@'):
+        target = trans.find_fixes_target()
+        if target:
+            # update() rather than save(), which would redo the balances
+            models.Transaction.objects.filter(id=trans.id).update(fixes=target)
+            linked += 1
+    print "linked %s corrections" % linked
+
+if __name__ == "__main__":
+    main()
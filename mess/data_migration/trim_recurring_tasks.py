@@ -0,0 +1,48 @@
+'''
+Deletes the recurring tasks stored past the recur_horizon() that are plain
+copies of their rule's last task before the horizon, from when recurring
+shifts were stored two years ahead.  The schedule pages work them out from
+the rules instead.  Tasks someone changed are kept, and marked edited so
+their rules' later occurrences aren't copied from them.  Safe to run again.
+'''
+
+import sys
+from os.path import dirname, abspath
+sys.path.append(dirname(dirname(abspath(__file__))))
+import settings
+from django.core.management import setup_environ
+setup_environ(settings)
+
+from django.db.transaction import commit_on_success
+from mess.membership import models as m_models
+from mess.scheduling import models
+
+def is_copy(task, last_task):
+    return (task.job_id == last_task.job_id and 
+            task.hours == last_task.hours and
+            task.member_id == last_task.member_id and 
+            task.account_id == last_task.account_id and
+            not task.note and task.hours_worked is None and 
+            not (task.excused or task.makeup or task.banked))
+
+@commit_on_success
+def main():
+    last_tasks = dict([(task.recur_rule_id, task) 
+                       for task in models.last_recur_tasks()])
+    stored = models.Task.objects.filter(recur_rule__in=last_tasks.keys(), 
+            time__gt=models.recur_horizon()).exclude(
+            id__in=[task.id for task in last_tasks.values()])
+    copies = [task for task in stored
+              if is_copy(task, last_tasks[task.recur_rule_id])]
+    ids = [task.id for task in copies]
+    # delete() in chunks, sqlite limits query parameters
+    for start in range(0, len(ids), 500):
+        models.Task.objects.filter(id__in=ids[start:start + 500]).delete()
+    stored.update(edited=True)
+    member_ids = set([task.member_id for task in copies]) - set([None])
+    m_models.touch_accounts(m_models.Account.objects.filter(
+            accountmember__member__in=member_ids))
+    print "deleted %s stored occurrences" % len(copies)
+
+if __name__ == "__main__":
+    main()
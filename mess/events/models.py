@@ -3,6 +3,7 @@ from django.db import models
 from datetime import datetime
 
 import mess.membership.models as m_models
+from mess.core import dataversion
 
 class Location(models.Model):
     name = models.CharField(unique=True, max_length=50)
@@ -36,3 +37,6 @@ class Orientation(Event):
     facilitator = models.ForeignKey('membership.Member', related_name='facilitators', null=True)
     cofacilitator = models.ForeignKey('membership.Member', related_name='cofacilitators', null=True)
 
+
+# the tables cached reports read, see mess.core.dataversion
+dataversion.track(Location, Event, Orientation)
@@ -6,6 +6,8 @@ urlpatterns = patterns('mess.is4c.views',
     url(r'^accounts/$', 'accounts', name='is4c-accounts'),
     url(r'^member/(\d+)/$', 'member', name='is4c-member'),
     url(r'^members/$', 'members', name='is4c-members'),
+    url(r'^changes/$', 'changes', name='is4c-changes'),
     url(r'^recordtransaction/$', 'recordtransaction', name='is4c-recordtransaction'),
+    url(r'^recordtransactions/$', 'recordtransactions', name='is4c-recordtransactions'),
     url(r'^gotois4c$', 'gotois4c', name='is4c-login'),
 )
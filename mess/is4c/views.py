@@ -5,15 +5,19 @@ from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseServerError
 from django.shortcuts import render_to_response, get_object_or_404
+from django.db import IntegrityError
 from django.db.models import Q
 from django.utils.safestring import mark_safe
 from django.core.mail import mail_admins
+from django.core.exceptions import ValidationError
 
 import django.conf as conf
 
 from mess.membership import models as m_models
 from mess.accounting import models as a_models
+from mess.accounting.snapshot import account_snapshots, render_acct_flags
 
+import copy
 import datetime
 import urllib2
 import time
@@ -44,7 +48,8 @@ def account(request, account_id):
         return wrong_secret(request)
 
     account = get_object_or_404(m_models.Account, id=account_id)
-    result = simplejson.dumps(getacctdict(account))
+    result = simplejson.dumps(getacctdicts(
+            m_models.Account.objects.filter(id=account.id))[0])
     return HttpResponse(result, mimetype='application/json')
 
 def accounts(request):
@@ -53,12 +58,12 @@ def accounts(request):
     if not request.GET.has_key('secret') or request.GET['secret'] != conf.settings.IS4C_SECRET or conf.settings.IS4C_SECRET == 'fakesecret':
         return wrong_secret(request)
 
-    accounts = [getacctdict(account) for account in m_models.Account.objects.all()]
+    accounts = getacctdicts(m_models.Account.objects.all())
     result = simplejson.dumps(accounts)
     return HttpResponse(result, mimetype='application/json')
 
 # helper method
-def getacctdict(account):
+def getacctdicts(accounts):
     """
     stuff is4c needs:
     * account id
@@ -70,17 +75,26 @@ def getacctdict(account):
     * account cashier notes #calculated field, account flags
     * account receipt notes  #future calculated fields
     * account active members
+
+    accounts is an Account queryset.  Everything is computed in bulk by
+    account_snapshots, so this costs the same few queries for one account 
+    or all of them.
     """
-    template = get_template('accounting/snippets/acct_flags.html')
-    acct_flags = template.render(Context({'account':account}))
-    
+    snapshots = account_snapshots(accounts)
+    # warm the cashier pages' frozen_flags while we're at it
+    m_models.cache_frozen_flags(snapshots)
+    render_acct_flags(snapshots)
+    return [getacctdict(snapshot) for snapshot in snapshots]
+
+def getacctdict(account):
+    """ account is an AccountSnapshot with html_flags rendered """
     return {'id':account.id,
         'name':account.name,
-        'balance_limit':str(account.max_allowed_to_owe()),
+        'balance_limit':str(account.max_allowed_to_owe),
         'balance':str(account.balance),
         'discount':str(account.discount), 
-        'json_flags':account.frozen_flags(),
-        'html_flags':acct_flags,
+        'json_flags':account.frozen_flags,
+        'html_flags':account.html_flags,
         'receipt_notes':'Thank you for shopping!',
 	'active_member_count': account.active_member_count}
 
@@ -119,6 +133,47 @@ def getmemberdict(member):
         'equity_due':'%f' % member.equity_due
     }
 
+def changes(request):
+    """
+    Delta feed for the registers: everything that changed after the version
+    given as ?changed_since= (0 means everything).  Returns the accounts 
+    and members whose sync_version is newer, tombstones for removed 
+    account-member links (and removed accounts or members, with the other
+    id null), and the version to pass as changed_since next time.
+
+    A member's names come from their User, whose saves bump the member 
+    too (see membership.models.user_saved).
+
+    Flags that change only with the date (LOAs starting or ending, expired
+    temporary limits, account age) don't bump versions, so registers should 
+    still do a full /accounts/ and /members/ sync once a day.
+    """
+    if not request.GET.has_key('secret') or request.GET['secret'] != conf.settings.IS4C_SECRET or conf.settings.IS4C_SECRET == 'fakesecret':
+        return wrong_secret(request)
+    try:
+        since = int(request.GET.get('changed_since', 0))
+    except ValueError:
+        return HttpResponseServerError('Invalid changed_since')
+
+    # read the version first, so anything changing while we work gets
+    # picked up by the next poll.  It trails the newest by IS4C_SYNC_LAG
+    # seconds, so versions still being committed aren't skipped; rows 
+    # newer than it are sent again, which is harmless.
+    version = max(since, m_models.committed_sync_version(
+            conf.settings.IS4C_SYNC_LAG))
+    removed = m_models.SyncVersion.objects.filter(id__gt=since, removed=True)
+    result = {
+        'version': version or 0,
+        'accounts': getacctdicts(m_models.Account.objects.filter(
+                sync_version__gt=since)),
+        'members': [getmemberdict(member) for member in 
+                m_models.Member.objects.filter(sync_version__gt=since
+                ).select_related('user')],
+        'removed': [{'account': tombstone.account, 
+                     'member': tombstone.member} for tombstone in removed],
+    }
+    return HttpResponse(simplejson.dumps(result), mimetype='application/json')
+
 @csrf_exempt
 def recordtransaction(request):
     # all requests will have some get variables, at the very least the secret is a get variable.
@@ -126,34 +181,164 @@ def recordtransaction(request):
     if not request.GET.has_key('secret') or request.GET['secret'] != conf.settings.IS4C_SECRET or conf.settings.IS4C_SECRET == 'fakesecret':
         return wrong_secret(request)
 
-    # get the transaction and sanitize it
-    json = request.POST['transaction'] 
-    t = simplejson.loads(json)
-    t['account'] = m_models.Account.objects.get(id=t['account'])
-    if 'member' in t: 
+    try:
+        t = simplejson.loads(request.POST['transaction'])
+    except (KeyError, ValueError):
+        return HttpResponseServerError('Invalid transaction')
+    if not isinstance(t, dict):
+        return HttpResponseServerError('Invalid transaction')
+
+    # a retried post of a recorded item reads as a duplicate, not an error
+    results, missing_members = record([t])
+    if missing_members:
+        mail_admins('Member %s not found in record transaction' % 
+                missing_members[0].get('member'), repr(missing_members[0]))
+    status_code = (500, 200)[results[0]['status'] in ('recorded', 'duplicate')]
+    return HttpResponse(status=status_code)
+
+# IS4C numbers transactions per lane, cashier and day, so a line item is
+# only known by all of these
+IS4C_KEY = ('register_no', 'trans_no', 'trans_id', 'is4c_cashier_id', 
+        'is4c_date')
+
+def is4c_date(timestamp):
+    """ the date of an IS4C timestamp, as is4c_timestamp reads it, or None """
+    timestamp = a_models.Transaction._meta.get_field(
+            'is4c_timestamp').to_python(timestamp)
+    return timestamp and timestamp.date()
+
+def is4c_key(t):
+    """ the IS4C_KEY of a transaction dict as IS4C sends it, or None """
+    try:
+        date = is4c_date(t.get('date'))
+        if date is None:
+            return None
+        return (int(t['register_no']), int(t['trans_no']), int(t['trans_id']),
+                int(t.get('is4c_cashier_id', 0)), date)
+    except (KeyError, TypeError, ValueError, ValidationError):
+        return None
+
+# a batch racing a concurrent retry of itself is tried again this many 
+# times; by then the retry has committed and its items read as duplicates
+BATCH_ATTEMPTS = 3
+
+def record(batch):
+    """ record_batch, tried again if it races a retry of itself """
+    for attempt in range(BATCH_ATTEMPTS):
+        try:
+            # record_batch changes the items, so each attempt gets copies
+            return record_batch([copy.copy(t) for t in batch])
+        except IntegrityError:
+            # the unique IS4C_KEY index caught an item recorded since we 
+            # looked; save_transactions rolled back
+            if attempt == BATCH_ATTEMPTS - 1:
+                raise
+
+@csrf_exempt
+def recordtransactions(request):
+    """
+    Batch version of recordtransaction.  POST 'transactions' is a JSON list
+    of transactions in the same format.  Valid ones are saved in a single
+    database transaction, skipping any whose IS4C_KEY was already recorded,
+    so a retried batch never double-posts.
+    Returns a JSON list with a result for each item, in order:
+    {"status": "recorded", "id": ...}, {"status": "duplicate", "id": ...} 
+    or {"status": "error", "error": ...}.
+    """
+    # all requests will have some get variables, at the very least the secret is a get variable.
+    # verify secret
+    if not request.GET.has_key('secret') or request.GET['secret'] != conf.settings.IS4C_SECRET or conf.settings.IS4C_SECRET == 'fakesecret':
+        return wrong_secret(request)
+
+    try:
+        batch = simplejson.loads(request.POST['transactions'])
+    except (KeyError, ValueError):
+        return HttpResponseServerError('Invalid transactions')
+    if not isinstance(batch, list):
+        return HttpResponseServerError('Invalid transactions')
+
+    results, missing_members = record(batch)
+    if missing_members:
+        mail_admins('%s members not found in record transactions' % 
+                len(missing_members), repr(missing_members))
+    return HttpResponse(simplejson.dumps(results), mimetype='application/json')
+
+def record_batch(batch):
+    """
+    Saves the new transactions of a recordtransactions batch.  Returns its
+    results and the items whose member wasn't found.
+    """
+    def ids(field):
+        result = set()
+        for t in batch:
+            try:
+                result.add(int(t[field]))
+            except (KeyError, TypeError, ValueError):
+                pass
+        return result
+    accounts = m_models.Account.objects.in_bulk(list(ids('account')))
+    members = m_models.Member.objects.in_bulk(list(ids('member')))
+    keys = [is4c_key(t) for t in batch]
+    recorded = {}
+    known = [key for key in keys if key]
+    if known:
+        for trans in a_models.Transaction.objects.filter(
+                register_no__in=set(key[0] for key in known),
+                trans_no__in=set(key[1] for key in known),
+                is4c_date__in=set(key[4] for key in known)).values(
+                'id', *IS4C_KEY):
+            recorded[tuple(trans[field] for field in IS4C_KEY)] = trans['id']
+
+    results = []
+    new_transactions = []
+    missing_members = []
+    for t, key in zip(batch, keys):
+        if key in recorded:
+            results.append({'status': 'duplicate', 'id': recorded[key]})
+            continue
         try:
-            t['member'] = m_models.Member.objects.get(id=t['member'])
-        except m_models.Member.DoesNotExist:
-            mail_admins('Member %s not found in record transaction' % t['member'],
-                    repr(t))
-            del t['member']
-        except ValueError:
-            mail_admins('Member for record transaction weren\'t no integer',
-                    repr(t))
-            del t['member']
+            t['account'] = accounts[int(t['account'])]
+        except (KeyError, TypeError, ValueError):
+            results.append({'status': 'error', 'error': 'unknown account'})
+            continue
+        if 'member' in t:
+            try:
+                t['member'] = members[int(t['member'])]
+            except (KeyError, TypeError, ValueError):
+                missing_members.append(dict(t))
+                del t['member']
+        if 'member' not in t:
+            results.append({'status': 'error', 'error': 'unknown member'})
+            continue
+        try:
+            tnew = a_models.Transaction(**sanitize_transaction(t))
+        except (TypeError, ValueError, ArithmeticError, ValidationError), e:
+            results.append({'status': 'error', 'error': str(e)})
+            continue
+        if key:
+            # a duplicate later in the same batch refers back to this one
+            recorded[key] = tnew
+        results.append({'status': 'recorded', 'id': tnew})
+        new_transactions.append(tnew)
+
+    a_models.save_transactions(new_transactions)
+    for result in results:
+        if isinstance(result.get('id'), a_models.Transaction):
+            result['id'] = result['id'].pk
+    return results, missing_members
+
+def sanitize_transaction(t):
+    """ fill in and convert the fields of an IS4C transaction dict """
     t['payment_amount'] = Decimal(str(t.get('payment_amount', 0)))
     t['purchase_amount'] = Decimal(str(t.get('purchase_amount', 0)))
     t['payment_type'] = t.get('payment_type', '')
     t['purchase_type'] = t.get('purchase_type', '')
     t['is4c_cashier_id'] = t.get('is4c_cashier_id', 0)
     t['is4c_timestamp'] = t.get('date')
+    t['is4c_date'] = is4c_date(t['is4c_timestamp'])
     if 'date' in t: 
         del t['date']
-
-    tnew = a_models.Transaction(**t)
-    tnew.save()
-    status_code = (500, 200)[tnew.pk and a_models.Transaction.objects.filter(pk=tnew.pk).exists()]
-    return HttpResponse(status=status_code)
+    return t
 
 @login_required
 def gotois4c(request):
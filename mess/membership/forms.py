@@ -79,6 +79,7 @@ MEMBER_SORT_CHOICES = (
     ('alpha', 'Alphabetical'),
     ('newjoin', 'Date joined (newest first)'),
     ('oldjoin', 'Date joined (oldest first)'),
+    ('match', 'Best match (when searching)'),
 )
 
 ACCOUNT_SORT_CHOICES = (
@@ -86,6 +87,7 @@ ACCOUNT_SORT_CHOICES = (
     ('recent', 'Most recently added'),
     ('hours', 'Hours balance (high to low)'),
     ('balance', 'Account balance (high to low)'),
+    ('match', 'Best match (when searching)'),
 )
 
 class MemberListFilterForm(forms.Form):
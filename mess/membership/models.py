@@ -3,11 +3,16 @@ import string
 from decimal import Decimal
 
 from django.conf import settings
-from django.db import models
+from django.core.cache import cache
+from django.db import connection, models
+from django.db.transaction import commit_on_success, set_dirty
 from django.db.models import Q
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.db.models.aggregates import Min
+from django.db.models.signals import post_init, post_save
+
+from mess.core import dataversion
 
 # import scheduling models to figure what tasks a member has
 from mess.scheduling import models as s_models
@@ -76,6 +81,10 @@ EQUITY_PAID_OPTIONS = (
 
 today = datetime.date.today()
 
+def todaytime():
+    ''' midnight today, for comparing with Task times '''
+    return datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+
 class MemberManager(models.Manager):
     'Custom manager to add extra methods'
     def active(self):
@@ -90,6 +99,13 @@ class MemberManager(models.Manager):
         return self.active().exclude(leaveofabsence__in=
                                      LeaveOfAbsence.objects.current())
 
+# the Member fields the IS4C feed shows, of the member or through their
+# accounts' flags, discount and balance limit; see Member.save()
+MEMBER_FEED_FIELDS = ('status', 'work_status', 'date_joined', 'date_missing',
+                      'date_departed', 'equity_held', 'equity_due')
+# the User fields it shows, see user_saved()
+USER_FEED_FIELDS = ('username', 'first_name', 'last_name')
+
 class Member(models.Model):
     user = models.ForeignKey(User, unique=True)
     status = models.CharField(max_length=1, choices=MEMBER_STATUS,
@@ -115,6 +131,9 @@ class Member(models.Model):
     referral_source = models.CharField(max_length=20, choices=REFERRAL_SOURCES, blank=True, null=True)
     referring_member = models.ForeignKey('self', blank=True, null=True)
     orientation = models.ForeignKey('events.Orientation', blank=True, null=True)
+    # version of the last change the IS4C registers need to hear about
+    sync_version = models.IntegerField(default=0, db_index=True, 
+            editable=False)
 
     objects = MemberManager()
 
@@ -167,7 +186,8 @@ class Member(models.Model):
     def qualified_tasks(self, possible=None):
         if possible is None:
             possible = s_models.Task.objects.unassigned_future()
-        return possible.exclude(job__skills_required__in=self.untrained())
+        return possible.filter(job__in=s_models.qualified_job_ids(
+                trained_skill_ids([self.id]).get(self.id, ())))
         
     @property
     def current_loa(self):
@@ -208,55 +228,18 @@ class Member(models.Model):
         return ('member', [self.user.username])
 
     def next_shift(self):
-        tasks = self.task_set.filter(time__gte=datetime.date.today())
-        if tasks.count():
-            return tasks[0]
+        return s_models.next_occurrence(todaytime(), member=self)
 
     def regular_shift(self):
-        tasks = self.task_set.filter(time__gte=datetime.date.today(),
-                recur_rule__isnull=False)
-        if tasks.count():
-            return tasks[0]
+        return s_models.next_occurrence(todaytime(), member=self, 
+                                        recur_rule__isnull=False)
 
-    def remove_from_shifts(self, start, end=None):
+    def remove_from_shifts(self, start, end=None, preview=False):
         '''
         Removes member from workshifts that haven't happened yet.
-        End date is optional.
+        End date is optional.  See scheduling.models.release_shifts.
         '''
-
-        # handle start and end dates in the past
-        if start < datetime.date.today():
-            start = datetime.date.today()
-        if end and end < datetime.date.today():
-            return          # end date in past; don't mess with shifts.
-
-        # switch all post-start tasks to new recur rule; 
-        # set old recur_rule.until as our start date.
-        tasks = self.task_set.filter(time__gte=start)
-        r_rule_switch = {}
-        for task in tasks:
-            if task.recur_rule:
-                if task.recur_rule in r_rule_switch:
-                    new_rule = r_rule_switch[task.recur_rule]
-                else:
-                    new_rule = task.duplicate_recur_rule()
-                    task.recur_rule.until = start
-                    task.recur_rule.save()
-                    r_rule_switch[task.recur_rule] = new_rule
-                task.recur_rule = new_rule
-
-            # task is inside LOA and should be released for one-time fill.
-            # i.e. no longer point to any recur rule
-            if end:
-                if task.time.date() <= end:
-                    task.recur_rule = None
-                    task.member = task.account = None
-                    
-            # permanently remove from workshift (no end date)
-            else:
-                task.member = task.account = None
-
-            task.save()
+        return s_models.release_shifts([self.id], start, end, preview)
 
     def get_primary_account(self):
         try:
@@ -297,11 +280,38 @@ class Member(models.Model):
         if orientations.count():
             return orientations[0].time.date()
 
+    def __init__(self, *args, **kwargs):
+        super(Member, self).__init__(*args, **kwargs)
+        # the values the registers have, see save()
+        self._synced = self.feed_values()
+
+    def feed_values(self):
+        return tuple([getattr(self, field) for field in MEMBER_FEED_FIELDS])
+
     def save(self, *args, **kwargs):
         if self.date_departed:
             self.equity_due = Decimal(0)
-
+        created = self.id is None
+        # only tell the registers about changes they show
+        changed = self.feed_values() != self._synced
+        if created or changed:
+            self.sync_version = new_sync_version(member=self.id)
         super(Member, self).save(*args, **kwargs)
+        if changed and not created:
+            # member status changes the flags and counts of their accounts
+            touch_accounts(Account.objects.filter(accountmember__member=self),
+                           self.sync_version)
+        self._synced = self.feed_values()
+        if created:
+            # later changes come through User, Phone and Address saves
+            from mess.membership import searchindex
+            searchindex.index_member(self)
+
+    def delete(self, *args, **kwargs):
+        from mess.membership import searchindex
+        new_sync_version(member=self.id, removed=True)
+        searchindex.unindex(searchindex.MEMBER, self.id)
+        super(Member, self).delete(*args, **kwargs)
 
     class Meta:
         ordering = ['user__username']
@@ -316,6 +326,15 @@ class LeaveOfAbsence(models.Model):
     start = models.DateField()
     end = models.DateField(help_text="Remember!: Editing a Leave of absense directly does not affect member's workshifts.  Please remove them manually from any workshifts that fall within the leave.")
     objects = LeaveOfAbsenceManager()
+
+    def save(self, *args, **kwargs):
+        super(LeaveOfAbsence, self).save(*args, **kwargs)
+        touch_member(self.member_id)
+
+    def delete(self, *args, **kwargs):
+        member_id = self.member_id
+        super(LeaveOfAbsence, self).delete(*args, **kwargs)
+        touch_member(member_id)
     
 
 
@@ -355,6 +374,9 @@ class Account(models.Model):
     balance = models.DecimalField(max_digits=8, decimal_places=2, default=0)
     note = models.TextField(blank=True)
     shared_address = models.BooleanField(default=False)
+    # version of the last change the IS4C registers need to hear about
+    sync_version = models.IntegerField(default=0, db_index=True, 
+            editable=False)
 
     objects = AccountManager()
 
@@ -380,24 +402,8 @@ class Account(models.Model):
 
     @property
     def discount(self):
-        # active working members at 10%
-        # active nonworking members at 5%
-        # LOA members and proxy shoppers not included
-        totaldiscount = 0.0
-        memberset = self.billable_members()
-        if memberset.count() == 0:
-            return 0
-        for m in memberset:
-            if m.work_status == 'x':
-                totaldiscount = 0
-            elif m.work_status != 'n':
-                totaldiscount += 10
-            else: 
-                totaldiscount += 5
-        rounded = round(totaldiscount / memberset.count(), 2)
-        # no decimals if can be displayed as integer
-        return rounded if int(rounded) != rounded else int(rounded)
-
+        return account_discount([m.work_status 
+                                 for m in self.billable_members()])
 
     def autocomplete_label(self):
         if self.active_member_count:
@@ -425,64 +431,22 @@ class Account(models.Model):
     
     def workhist(self):
         '''
-        Generates the work history object used to produce the workhistory calendar on account page.
-        complex data structures here:
-        workhist[] is an array of weeks
-        each week is a {} dictionary of {'days':[array], 'tasks':[array], 
-           'newmonth' and 'newyear'} (newmonth and newyear flags show month 
-           alongside the calendar)
-        each day is a {} dictionary of {'week':(parent-pointer), 'date':(number),
-           'workflag':(flag for highlighting), 'task':last-task}
+        The WorkHistory behind the workhistory calendar on the account page.
+        Cached per account, sync_version (which LOA and member changes 
+        bump), the version of its tasks (see s_models.account_version()) 
+        and day.
         '''
-        workhist = []
-        dayindex = {}
-        today = datetime.date.today()
-        lastsunday = today - datetime.timedelta(days=today.weekday()+1)
-        try:
-            oldesttime = self.task_set.all().order_by('time')[0].time
-            oldestweeks = ((today - oldesttime.date()).days / 7) + 2
-            oldestweeks = max(oldestweeks, 16)
-        except IndexError:
-            oldestweeks = 16
-        for weeksaway in range(-oldestweeks,52):
-            week = {'tasks':[]}
-            if weeksaway == -12:
-                week['flagcurrent'] = True
-            elif weeksaway == 7:
-                week['flagfuture'] = True
-            firstday = lastsunday + datetime.timedelta(days=7*weeksaway)
-            week['days'] = [{'week':week} for i in range(7)]
-            for i in range(7):
-                week['days'][i]['date'] = firstday + datetime.timedelta(days=i)
-                dayindex[week['days'][i]['date']] = week['days'][i]
-            if 7 <= week['days'][6]['date'].day < 14:
-                week['newmonth'] = week['days'][6]['date']
-            elif 14 <= week['days'][6]['date'].day < 21:
-                week['newyear'] = week['days'][6]['date'].year
-            workhist.append(week)
-        for task in self.task_set.all():
-            if task.time.date() in dayindex:
-                day = dayindex[task.time.date()]
-                if 'workflag' in day:
-                    day['workflag'] = 'complex-workflag'
-                else:
-                    day['workflag'] = task.simple_workflag
-                day['task'] = task
-                day['week']['tasks'].append(task)
-        for leave in self.members_leaveofabsence_set():
-            for dayofleave in daterange(leave.start, leave.end):
-                if dayofleave not in dayindex: 
-                    continue
-                day = dayindex[dayofleave]
-                if 'workflag' not in day:
-                    day['workflag'] = 'LOA'
-        dayindex[today]['istoday'] = True
-        return workhist        
+        if not hasattr(self, '_workhist'):
+            key = 'workhist:%s:%s:%s:%s' % (self.id, self.sync_version, 
+                    s_models.account_version(self.id), datetime.date.today())
+            self._workhist = cache.get(key)
+            if self._workhist is None:
+                self._workhist = WorkHistory(self)
+                cache.set(key, self._workhist, WORKHIST_TIMEOUT)
+        return self._workhist
 
     def next_shift(self):
-        tasks = self.task_set.filter(time__gte=datetime.date.today())
-        if tasks.count():
-            return tasks[0]
+        return s_models.next_occurrence(todaytime(), account=self)
 
     def verbose_balance(self):
         if self.balance > 0:
@@ -523,12 +487,13 @@ class Account(models.Model):
         return self.days_old() / 30
         
     def max_allowed_to_owe(self):
-        if self.temporarybalancelimit_set.current():
-            return self.temporarybalancelimit_set.current()[0].limit
-        if self.days_old() >= 180:
-            return self.active_member_count * Decimal('25.00')
+        current_limits = self.temporarybalancelimit_set.current()
+        if current_limits:
+            temporary_limit = current_limits[0].limit
         else:
-            return self.active_member_count * Decimal('5.00')
+            temporary_limit = None
+        return account_max_allowed_to_owe(temporary_limit, self.days_old(),
+                                          self.active_member_count)
     max_allowed_balance = property(max_allowed_to_owe)
 
     def must_pay(self):
@@ -559,29 +524,59 @@ class Account(models.Model):
             return 'NEEDS SHIFT'
 
     def frozen_flags(self):
+        '''
+        Cached version of compute_frozen_flags.  The cache key includes 
+        sync_version, which every change the flags depend on bumps, so 
+        stale flags are never served.
+        '''
+        if self.id is None:
+            return self.compute_frozen_flags()
+        key = frozen_flags_key(self.id, self.sync_version)
+        # templates ask several times per render, so remember it here too
+        if getattr(self, '_frozen_flags', (None,))[0] == key:
+            return self._frozen_flags[1]
+        cached = cache.get(key)
+        if cached is None:
+            count_frozen_flags_cache('misses')
+            cached = (self.compute_frozen_flags(),)
+            cache.set(key, cached, FROZEN_FLAGS_TIMEOUT)
+        else:
+            count_frozen_flags_cache('hits')
+        self._frozen_flags = (key, cached[0])
+        return cached[0]
+
+    def compute_frozen_flags(self):
         if self.name == 'One-Time Shopper':
             return
-        flags = []
-        if self.balance > self.max_allowed_to_owe():
-            flags.append('Owes Balance')
-        if self.hours_balance > Decimal('0.03'):
-            flags.append('Owes Hours')
-        if not self.can_shop:
-            flags.append('CANNOT SHOP')
-        obligations = self.billable_member_count
-        if not obligations:
-            if self.active_member_count:
-                flags.append('ON LEAVE')
-            else:
-                flags.append('ACCOUNT CLOSED')
         satisfactions = self.accountmember_set.filter(
             Q(member__work_status__in='ecn', shopper=False) |
             Q(member__task__time__gte=datetime.date.today())).count()
-        if obligations > satisfactions and self.days_old() > 7:
-            flags.append('NEEDS SHIFT')
-        if self.ebt_only:
-            flags.append('EBT Only')
-        return flags
+        return account_frozen_flags(self, self.max_allowed_to_owe(),
+                self.billable_member_count, self.active_member_count,
+                satisfactions, self.days_old())
+
+    def __init__(self, *args, **kwargs):
+        super(Account, self).__init__(*args, **kwargs)
+        # the values in the search index, see save()
+        self._indexed = (self.name, self.note)
+
+    def save(self, *args, **kwargs):
+        # balance changes come through here via Transaction.save and 
+        # HoursTransaction.save
+        created = self.id is None
+        self.sync_version = new_sync_version(account=self.id)
+        super(Account, self).save(*args, **kwargs)
+        # only reindex when the indexed values change, not on every balance
+        if created or (self.name, self.note) != self._indexed:
+            from mess.membership import searchindex
+            searchindex.index_account(self)
+            self._indexed = (self.name, self.note)
+
+    def delete(self, *args, **kwargs):
+        from mess.membership import searchindex
+        new_sync_version(account=self.id, removed=True)
+        searchindex.unindex(searchindex.ACCOUNT, self.id)
+        super(Account, self).delete(*args, **kwargs)
 
     def __unicode__(self):
         return self.name
@@ -589,6 +584,236 @@ class Account(models.Model):
     class Meta:
         ordering = ['name']
 
+# The helpers below hold the account rules shared by the Account methods
+# above and the bulk snapshots in mess.accounting.snapshot, so both always
+# agree.  They take precomputed values instead of running queries.
+
+def account_discount(work_statuses):
+    '''
+    Discount for an account, given the work statuses of its billable 
+    members in username order.
+    '''
+    # active working members at 10%
+    # active nonworking members at 5%
+    # LOA members and proxy shoppers not included
+    totaldiscount = 0.0
+    if len(work_statuses) == 0:
+        return 0
+    for work_status in work_statuses:
+        if work_status == 'x':
+            totaldiscount = 0
+        elif work_status != 'n':
+            totaldiscount += 10
+        else: 
+            totaldiscount += 5
+    rounded = round(totaldiscount / len(work_statuses), 2)
+    # no decimals if can be displayed as integer
+    return rounded if int(rounded) != rounded else int(rounded)
+
+def account_max_allowed_to_owe(temporary_limit, days_old, active_member_count):
+    if temporary_limit is not None:
+        return temporary_limit
+    if days_old >= 180:
+        return active_member_count * Decimal('25.00')
+    else:
+        return active_member_count * Decimal('5.00')
+
+def account_frozen_flags(account, max_allowed_to_owe, billable_member_count,
+                         active_member_count, satisfactions, days_old):
+    '''
+    Cashier flags for an account.  account only needs name, balance, 
+    hours_balance, can_shop and ebt_only.  satisfactions counts the 
+    account's members who don't need a shift (see Account.frozen_flags).
+    '''
+    if account.name == 'One-Time Shopper':
+        return
+    flags = []
+    if account.balance > max_allowed_to_owe:
+        flags.append('Owes Balance')
+    if account.hours_balance > Decimal('0.03'):
+        flags.append('Owes Hours')
+    if not account.can_shop:
+        flags.append('CANNOT SHOP')
+    obligations = billable_member_count
+    if not obligations:
+        if active_member_count:
+            flags.append('ON LEAVE')
+        else:
+            flags.append('ACCOUNT CLOSED')
+    if obligations > satisfactions and days_old > 7:
+        flags.append('NEEDS SHIFT')
+    if account.ebt_only:
+        flags.append('EBT Only')
+    return flags
+
+WORKHIST_TIMEOUT = 60 * 60 * 24
+
+class WorkTask(object):
+    ''' the parts of a Task the workhistory calendar shows '''
+    def __init__(self, id, time, hours, hours_worked, excused, makeup, 
+                 banked, job, first_name, last_name):
+        self.id = id
+        self.time = time
+        self.hours = hours
+        self.hours_worked = hours_worked
+        self.job = job
+        # like Member.__unicode__
+        self.member = first_name is not None and (
+                u'%s %s' % (first_name, last_name)).strip() or None
+        self.workflag = s_models.workflag(hours_worked, excused, makeup, 
+                                          banked)
+        self.simple_workflag = s_models.simple_workflag(self.workflag, 
+                                                        hours_worked)
+
+class WorkDay(object):
+    __slots__ = ('date', 'workflag', 'task', 'istoday')
+
+class WorkWeek(object):
+    '''
+    A week of a WorkHistory: days, tasks, and the newmonth and newyear 
+    labels shown alongside the calendar.
+    '''
+    __slots__ = ('history', 'index')
+
+    def __init__(self, history, index):
+        self.history = history
+        self.index = index
+
+    @property
+    def flagcurrent(self):
+        return self.index - self.history.oldestweeks == -12
+
+    @property
+    def flagfuture(self):
+        return self.index - self.history.oldestweeks == 7
+
+    @property
+    def days(self):
+        return [self.history.day(self.index * 7 + i) for i in range(7)]
+
+    @property
+    def tasks(self):
+        return self.history.week_tasks[self.index]
+
+    @property
+    def newmonth(self):
+        sunday = self.history.date(self.index * 7 + 6)
+        if 7 <= sunday.day < 14:
+            return sunday
+        return ''
+
+    @property
+    def newyear(self):
+        sunday = self.history.date(self.index * 7 + 6)
+        if 14 <= sunday.day < 21:
+            return sunday.year
+        return ''
+
+class WorkHistory(object):
+    '''
+    An account's shifts and leaves, week by week, from the oldest task (16
+    weeks at least) until a year ahead.  Each day's flag (for highlighting)
+    and last task are kept in flat lists indexed by days since the first
+    day; iterating gives WorkWeeks, which make the WorkDays as needed.
+    '''
+    def __init__(self, account):
+        self.today = datetime.date.today()
+        lastsunday = self.today - datetime.timedelta(days=self.today.weekday()+1)
+        tasks = [WorkTask(*values) for values in account.task_set.values_list(
+                'id', 'time', 'hours', 'hours_worked', 'excused', 'makeup', 
+                'banked', 'job__name', 'member__user__first_name', 
+                'member__user__last_name')]
+        if tasks:
+            oldesttime = min([task.time for task in tasks])
+            self.oldestweeks = max(((self.today - oldesttime.date()).days / 7)
+                                   + 2, 16)
+        else:
+            self.oldestweeks = 16
+        self.first = lastsunday - datetime.timedelta(days=7*self.oldestweeks)
+        weeks = self.oldestweeks + 52
+        # recurring shifts past the stored horizon, worked out from the rules
+        for task in s_models.load_related(s_models.unstored_occurrences(
+                s_models.recur_horizon(), datetime.datetime.combine(
+                self.first + datetime.timedelta(weeks * 7), datetime.time.min),
+                account=account)):
+            user = task.member_id and task.member.user
+            tasks.append(WorkTask(None, task.time, task.hours, None, False, 
+                    False, False, task.job.name, user and user.first_name, 
+                    user and user.last_name))
+        self.flags = [None] * (weeks * 7)
+        self.tasks = [None] * (weeks * 7)
+        self.week_tasks = [[] for i in range(weeks)]
+        for task in tasks:
+            index = (task.time.date() - self.first).days
+            if not 0 <= index < len(self.flags):
+                continue
+            if self.flags[index]:
+                self.flags[index] = 'complex-workflag'
+            else:
+                self.flags[index] = task.simple_workflag
+            self.tasks[index] = task
+            self.week_tasks[index / 7].append(task)
+        for start, end in account.members_leaveofabsence_set().values_list(
+                'start', 'end'):
+            # the leave's days, end excluded, that are on the calendar
+            start = max((start - self.first).days, 0)
+            end = min((end - self.first).days, len(self.flags))
+            for index in range(start, end):
+                if not self.flags[index]:
+                    self.flags[index] = 'LOA'
+
+    def date(self, index):
+        return self.first + datetime.timedelta(days=index)
+
+    def day(self, index):
+        day = WorkDay()
+        day.date = self.date(index)
+        day.workflag = self.flags[index]
+        day.task = self.tasks[index]
+        day.istoday = day.date == self.today
+        return day
+
+    def __len__(self):
+        return len(self.week_tasks)
+
+    def __iter__(self):
+        for index in range(len(self.week_tasks)):
+            yield WorkWeek(self, index)
+
+
+# frozen_flags cache.  Entries are keyed by account, sync_version and date
+# (flags also change with the date: LOAs, account age, future shifts), so 
+# they never need deleting.  The nightly cron rebuilds them for every 
+# account; that only warms the web server with a shared CACHE_BACKEND.
+
+FROZEN_FLAGS_TIMEOUT = 60 * 60 * 24
+
+def frozen_flags_key(account_id, sync_version):
+    return 'frozen_flags:%s:%s:%s' % (datetime.date.today(), account_id, 
+                                      sync_version)
+
+def cache_frozen_flags(accounts):
+    ''' store precomputed frozen_flags of accounts or account snapshots '''
+    cache.set_many(dict([(frozen_flags_key(account.id, account.sync_version),
+                          (account.frozen_flags,)) for account in accounts]),
+                   FROZEN_FLAGS_TIMEOUT)
+
+def count_frozen_flags_cache(outcome):
+    key = 'frozen_flags:%s' % outcome
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, FROZEN_FLAGS_TIMEOUT * 7)
+
+def frozen_flags_cache_stats(reset=False):
+    ''' hits and misses since the last reset '''
+    stats = cache.get_many(['frozen_flags:hits', 'frozen_flags:misses'])
+    if reset:
+        cache.delete('frozen_flags:hits')
+        cache.delete('frozen_flags:misses')
+    return {'hits': stats.get('frozen_flags:hits', 0),
+            'misses': stats.get('frozen_flags:misses', 0)}
+
 class AccountMemberManager(models.Manager):
     def active_depositor(self):
         return self.filter(shopper=False, member__in=Member.objects.active())
@@ -624,6 +849,22 @@ class AccountMember(models.Model):
     def __unicode__(self):
         return u'%s: %s' % (self.account, self.member)
 
+    def save(self, *args, **kwargs):
+        super(AccountMember, self).save(*args, **kwargs)
+        version = new_sync_version(account=self.account_id, 
+                                   member=self.member_id)
+        touch_accounts(Account.objects.filter(id=self.account_id), version)
+        touch_members(Member.objects.filter(id=self.member_id), version)
+
+    def delete(self, *args, **kwargs):
+        account_id, member_id = self.account_id, self.member_id
+        super(AccountMember, self).delete(*args, **kwargs)
+        # tombstone, so registers drop the link
+        version = new_sync_version(account=account_id, member=member_id, 
+                                   removed=True)
+        touch_accounts(Account.objects.filter(id=account_id), version)
+        touch_members(Member.objects.filter(id=member_id), version)
+
     class Meta:
         ordering = ['account', 'id']
     
@@ -646,6 +887,90 @@ class TemporaryBalanceLimit(models.Model):
         return u'%s may owe %s until %s/%s/%s' % (self.account, self.limit, 
             self.until.month, self.until.day, self.until.year)
 
+    def save(self, *args, **kwargs):
+        super(TemporaryBalanceLimit, self).save(*args, **kwargs)
+        touch_accounts(Account.objects.filter(id=self.account_id))
+
+    def delete(self, *args, **kwargs):
+        account_id = self.account_id
+        super(TemporaryBalanceLimit, self).delete(*args, **kwargs)
+        touch_accounts(Account.objects.filter(id=account_id))
+
+class SyncVersion(models.Model):
+    '''
+    Change log behind the IS4C changed_since feed.  Each row's id is a 
+    monotonic version; accounts and members store the version of their 
+    latest change in sync_version.  Rows marked removed are tombstones for 
+    deleted account-member links, accounts (no member) and members (no 
+    account).  Ids rather than foreign keys, so tombstones outlive the rows.
+    '''
+    timestamp = models.DateTimeField(auto_now_add=True)
+    account = models.IntegerField(blank=True, null=True)
+    member = models.IntegerField(blank=True, null=True)
+    removed = models.BooleanField(default=False)
+
+    def __unicode__(self):
+        return u'%s: account %s member %s' % (self.id, self.account, 
+                                              self.member)
+
+def new_sync_version(account=None, member=None, removed=False):
+    ''' log a change for the registers and return its version '''
+    return SyncVersion.objects.create(account=account, member=member,
+                                      removed=removed).id
+
+def committed_sync_version(lag):
+    '''
+    The newest version logged more than lag seconds ago.  Versions are 
+    handed out when a change is made but seen when it commits, so a 
+    longer transaction can commit a version below one already seen; 
+    anything younger than lag may still be waiting behind one.
+    '''
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=lag)
+    versions = SyncVersion.objects.filter(timestamp__lt=cutoff
+            ).order_by('-id').values_list('id', flat=True)[:1]
+    return versions and versions[0] or 0
+
+@commit_on_success
+def prune_sync_versions(days):
+    '''
+    Deletes the change log rows older than days, except tombstones and the 
+    newest row.  Only the ids of the others are ever read, and the feed 
+    reads accounts' and members' sync_version, not the log, so no cursor 
+    needs them.  The newest row stays so its id isn't handed out again.
+    '''
+    newest = SyncVersion.objects.order_by('-id').values_list('id', 
+                                                             flat=True)[:1]
+    if not newest:
+        return 0
+    qn = connection.ops.quote_name
+    # raw SQL, since QuerySet.delete() loads and signals every row
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s WHERE %s = %%s AND %s < %%s AND %s < %%s'
+            % (qn(SyncVersion._meta.db_table), qn('removed'), qn('id'), 
+               qn('timestamp')), [False, newest[0], 
+               datetime.datetime.now() - datetime.timedelta(days)])
+    set_dirty()
+    return cursor.rowcount
+
+def touch_accounts(accounts, version=None):
+    ''' bump sync_version on an Account queryset without calling save() '''
+    if version is None:
+        version = new_sync_version()
+    accounts.update(sync_version=version)
+
+def touch_members(members, version=None):
+    ''' bump sync_version on a Member queryset without calling save() '''
+    if version is None:
+        version = new_sync_version()
+    members.update(sync_version=version)
+
+def touch_member(member_id):
+    ''' bump a member and their accounts, e.g. after an LOA change '''
+    version = new_sync_version(member=member_id)
+    touch_members(Member.objects.filter(id=member_id), version)
+    touch_accounts(Account.objects.filter(accountmember__member=member_id),
+                   version)
+
 
 # possibly include IM and URL classes at some point
 
@@ -667,6 +992,17 @@ class Address(models.Model):
         else:
             return self.address1
 
+    def save(self, *args, **kwargs):
+        from mess.membership import searchindex
+        super(Address, self).save(*args, **kwargs)
+        searchindex.index_addresses(self.member_id)
+
+    def delete(self, *args, **kwargs):
+        from mess.membership import searchindex
+        member_id = self.member_id
+        super(Address, self).delete(*args, **kwargs)
+        searchindex.index_addresses(member_id)
+
     def fullmailing(self):
         ''' return full mailing address, including name and country if not USA '''
         ret = '%s\n%s' % (self.member, self.address1)
@@ -689,12 +1025,86 @@ class Phone(models.Model):
     def __unicode__(self):
         return self.number
 
+    def save(self, *args, **kwargs):
+        from mess.membership import searchindex
+        super(Phone, self).save(*args, **kwargs)
+        searchindex.index_phones(self.member_id)
+
+    def delete(self, *args, **kwargs):
+        from mess.membership import searchindex
+        member_id = self.member_id
+        super(Phone, self).delete(*args, **kwargs)
+        searchindex.index_phones(member_id)
+
+
+class SearchTerm(models.Model):
+    '''
+    A normalized token of a member's or account's names, email, phones,
+    addresses or note, for mess.membership.searchindex.  kind is 'm' for
+    members and 'a' for accounts.
+    '''
+    kind = models.CharField(max_length=1)
+    object_id = models.IntegerField(db_index=True)
+    field = models.CharField(max_length=10)
+    token = models.CharField(max_length=50, db_index=True)
+
+class SearchGram(models.Model):
+    ''' a trigram of a distinct SearchTerm token, for substring search '''
+    gram = models.CharField(max_length=3, db_index=True)
+    token = models.CharField(max_length=50)
+
+def user_feed_values(user):
+    return tuple([getattr(user, field) for field in USER_FEED_FIELDS])
+
+def user_loaded(sender, instance, **kwargs):
+    ''' the values the registers have, see user_saved() '''
+    instance._synced = user_feed_values(instance)
+
+def user_saved(sender, instance, created, **kwargs):
+    '''
+    Keeps the member names and emails in the search index current, and 
+    tells the registers about a change to the names they show.
+    '''
+    from mess.membership import searchindex
+    searchindex.index_user(instance)
+    synced = getattr(instance, '_synced', None)
+    instance._synced = user_feed_values(instance)
+    if not created and synced != instance._synced:
+        for member_id in Member.objects.filter(user=instance).values_list(
+                'id', flat=True):
+            touch_members(Member.objects.filter(id=member_id), 
+                          new_sync_version(member=member_id))
+            # for caches that show member names but don't key on User, 
+            # whose version moves on every login
+            dataversion.changed(Member)
+
+post_init.connect(user_loaded, sender=User, 
+                  dispatch_uid='mess.membership.models.user_loaded')
+post_save.connect(user_saved, sender=User, 
+                  dispatch_uid='mess.membership.models.user_saved')
+
 # this is duplicated in scheduling/models.  duplicated to avoid circular imports.
 def daterange(start, end):
     while start < end:
         yield start
         start += datetime.timedelta(1)
 
+def trained_skill_ids(member_ids):
+    '''
+    {member id: set of the ids of the Skills they've been trained in by 
+    working a shift}, like Member.skills(), for many members in one query.
+    '''
+    trains = {}
+    through = s_models.Job.skills_trained.through
+    for job_id, skill_id in through.objects.values_list('job', 'skill'):
+        trains.setdefault(job_id, set()).add(skill_id)
+    skills = {}
+    for member_id, job_id in s_models.Task.objects.worked().filter(
+            member__in=member_ids).order_by().values_list('member', 'job'
+            ).distinct():
+        skills.setdefault(member_id, set()).update(trains.get(job_id, ()))
+    return skills
+
 # this should be a method on Skill, but it can't be due to circular imports
 def members_with_skill(skill):
     return Member.objects.present().filter(
@@ -723,3 +1133,8 @@ class MemberSignUp(models.Model):
     spam = models.BooleanField(default=False)
     active = models.BooleanField(default=True)
     timestamp = models.DateTimeField(auto_now_add=True)
+
+# the tables cached reports read, see mess.core.dataversion
+dataversion.track(Member, LeaveOfAbsence, WorkExemption, Account, 
+                  AccountMember, TemporaryBalanceLimit, Address, Phone, 
+                  MemberSignUp, User)
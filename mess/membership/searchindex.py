@@ -0,0 +1,292 @@
+'''
+Search index for members and accounts.
+
+Searching with __icontains is a LIKE '%x%' that scans every row.  Instead,
+each member's name, email, phones and addresses and each account's name
+and note are split into normalized tokens (lowercase, accents dropped) in
+SearchTerm, and each distinct token into its trigrams in SearchGram.  A
+search word matches tokens it's a prefix of, found with a range on the
+token index, and tokens it's a substring of, found through the trigrams.
+Results are ranked by how well and where the words matched.
+
+The index is kept current by the saves of Member, Account, Phone and
+Address and of auth Users; rebuild_index() recreates it, nightly from
+'cron_nightly.py --maintenance' and by data_migration/fill_search_index.py.
+'''
+import re
+import unicodedata
+
+from django.db import connection
+from django.db.models.aggregates import Count
+from django.db.transaction import commit_on_success, set_dirty
+
+from mess.membership import models as m_models
+
+MEMBER, ACCOUNT = 'm', 'a'
+
+# how much a match in each field counts toward the rank...
+FIELD_WEIGHTS = {
+    'name': 4,
+    'email': 3,
+    'phone': 2,
+    'address': 1,
+    'note': 1,
+}
+
+# ...times how well it matched
+EXACT, PREFIX, SUBSTRING = 3, 2, 1
+
+# fields whose values are also indexed as one token, so "5550199" finds
+# "555-0199"
+JOINED_FIELDS = ('phone',)
+
+TOKEN_LENGTH = 50
+
+# keeps IN lists under SQLite's limit on query parameters
+CHUNK_SIZE = 500
+
+def chunks(items):
+    return [items[i:i + CHUNK_SIZE] for i in range(0, len(items), CHUNK_SIZE)]
+
+def normalize(text):
+    ''' lowercase ASCII, accents dropped '''
+    return unicodedata.normalize('NFKD', unicode(text or '')).encode(
+            'ascii', 'ignore').lower()
+
+def words(text):
+    return re.findall(r'[a-z0-9]+', normalize(text))
+
+def tokens(field, values):
+    ''' the set of index tokens for a field's values '''
+    found = set()
+    for value in values:
+        parts = words(value)
+        found.update(parts)
+        if field in JOINED_FIELDS and len(parts) > 1:
+            found.add(''.join(parts))
+    return set([token[:TOKEN_LENGTH] for token in found])
+
+def trigrams(token):
+    return set([token[i:i + 3] for i in range(len(token) - 2)])
+
+def member_fields(first_name, last_name, email):
+    return {'name': [first_name, last_name], 'email': [email]}
+
+def address_values(address1, address2, city, postal_code):
+    return [address1, address2, city, postal_code]
+
+def account_fields(name, note):
+    return {'name': [name], 'note': [note]}
+
+
+def insert_terms(rows):
+    '''
+    Inserts (kind, object id, field, token) rows into SearchTerm, and the
+    trigrams of tokens SearchGram doesn't have yet, with an executemany
+    each.
+    '''
+    if not rows:
+        return
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+    cursor.executemany('INSERT INTO %s (%s, %s, %s, %s) VALUES '
+            '(%%s, %%s, %%s, %%s)' % (qn(m_models.SearchTerm._meta.db_table),
+            qn('kind'), qn('object_id'), qn('field'), qn('token')), rows)
+    new = set([row[3] for row in rows])
+    for chunk in chunks(list(new)):
+        new.difference_update(m_models.SearchGram.objects.filter(
+                token__in=chunk).values_list('token', flat=True))
+    cursor.executemany('INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % (
+            qn(m_models.SearchGram._meta.db_table), qn('gram'), qn('token')),
+            [(gram, token) for token in new for gram in trigrams(token)])
+    set_dirty()
+
+def update(kind, object_id, fields):
+    '''
+    Reindexes the given fields ({field: values}) of one object, writing
+    only the tokens that changed.
+    '''
+    wanted = set([(field, token) for field, values in fields.items()
+                  for token in tokens(field, values)])
+    gone = []
+    for term_id, field, token in m_models.SearchTerm.objects.filter(
+            kind=kind, object_id=object_id, field__in=fields.keys()
+            ).values_list('id', 'field', 'token'):
+        if (field, token) in wanted:
+            wanted.discard((field, token))
+        else:
+            gone.append(term_id)
+    if gone:
+        m_models.SearchTerm.objects.filter(id__in=gone).delete()
+    insert_terms([(kind, object_id, field, token)
+                  for field, token in wanted])
+
+def unindex(kind, object_id):
+    m_models.SearchTerm.objects.filter(kind=kind, object_id=object_id
+                                       ).delete()
+
+def index_user(user):
+    ''' reindexes the names and email of user's member, if any '''
+    for member_id in m_models.Member.objects.filter(user=user
+            ).values_list('id', flat=True):
+        update(MEMBER, member_id, member_fields(user.first_name,
+                                                user.last_name, user.email))
+
+def index_phones(member_id):
+    update(MEMBER, member_id, {'phone': m_models.Phone.objects.filter(
+            member=member_id).values_list('number', flat=True)})
+
+def index_addresses(member_id):
+    values = []
+    for address in m_models.Address.objects.filter(member=member_id
+            ).values_list('address1', 'address2', 'city', 'postal_code'):
+        values.extend(address_values(*address))
+    update(MEMBER, member_id, {'address': values})
+
+def index_member(member):
+    user = member.user
+    update(MEMBER, member.id, member_fields(user.first_name,
+                                            user.last_name, user.email))
+    index_phones(member.id)
+    index_addresses(member.id)
+
+def index_account(account):
+    update(ACCOUNT, account.id, account_fields(account.name, account.note))
+
+@commit_on_success
+def rebuild_index():
+    '''
+    Recreates the whole index from the members and accounts, in a fixed
+    number of queries.  Returns the number of terms.
+    '''
+    cursor = connection.cursor()
+    for model in (m_models.SearchTerm, m_models.SearchGram):
+        cursor.execute('DELETE FROM %s' % connection.ops.quote_name(
+                model._meta.db_table))
+    fields = {}
+    def add(kind, object_id, values):
+        for field, value in values.items():
+            fields.setdefault((kind, object_id, field), []).extend(value)
+    for member in m_models.Member.objects.values_list('id',
+            'user__first_name', 'user__last_name', 'user__email'):
+        add(MEMBER, member[0], member_fields(*member[1:]))
+    for member_id, number in m_models.Phone.objects.values_list('member',
+                                                                'number'):
+        add(MEMBER, member_id, {'phone': [number]})
+    for address in m_models.Address.objects.values_list('member',
+            'address1', 'address2', 'city', 'postal_code'):
+        add(MEMBER, address[0], {'address': address_values(*address[1:])})
+    for account in m_models.Account.objects.values_list('id', 'name',
+                                                        'note'):
+        add(ACCOUNT, account[0], account_fields(*account[1:]))
+    rows = [(kind, object_id, field, token) for (kind, object_id, field),
+            values in fields.items() for token in tokens(field, values)]
+    insert_terms(rows)
+    set_dirty()
+    return len(rows)
+
+
+def next_string(text):
+    ''' the first string after every string text is a prefix of '''
+    return text[:-1] + chr(ord(text[-1]) + 1)
+
+def substring_tokens(word):
+    ''' the indexed tokens word is a substring of, for words of 3 or more '''
+    grams = trigrams(word)
+    candidates = m_models.SearchGram.objects.filter(gram__in=grams).values(
+            'token').annotate(grams=Count('id')).filter(grams=len(grams))
+    return [row['token'] for row in candidates if word in row['token']]
+
+def search(kind, query, fields=None):
+    '''
+    The ids of the objects of kind (MEMBER or ACCOUNT) with an indexed
+    token starting with or containing each word of query, in fields (all
+    by default), best matches first.
+    '''
+    scores = None
+    for word in set(words(query)):
+        terms = m_models.SearchTerm.objects.filter(kind=kind)
+        if fields:
+            terms = terms.filter(field__in=fields)
+        found = list(terms.filter(token__gte=word, token__lt=next_string(word)
+                ).values_list('object_id', 'field', 'token'))
+        if len(word) >= 3:
+            for chunk in chunks(substring_tokens(word)):
+                found.extend(terms.filter(token__in=chunk).values_list(
+                        'object_id', 'field', 'token'))
+        word_scores = {}
+        for object_id, field, token in found:
+            if token == word:
+                score = EXACT
+            elif token.startswith(word):
+                score = PREFIX
+            else:
+                score = SUBSTRING
+            score *= FIELD_WEIGHTS[field]
+            word_scores[object_id] = max(word_scores.get(object_id, 0), score)
+        if scores is None:
+            scores = word_scores
+        else:
+            # every word has to match
+            scores = dict([(object_id, score + word_scores[object_id])
+                           for object_id, score in scores.items()
+                           if object_id in word_scores])
+    if not scores:
+        return []
+    return sorted(scores, key=lambda object_id: (-scores[object_id],
+                                                 object_id))
+
+def matches(field, values, query):
+    ''' whether every word of query is in a token of values, as search has it '''
+    found = tokens(field, values)
+    for word in words(query):
+        if not [token for token in found if word in token]:
+            return False
+    return True
+
+
+class SearchResults(object):
+    '''
+    Objects by id, in the given order, loaded a slice at a time: hand it
+    to a Paginator and only the page shown is loaded.
+    '''
+    def __init__(self, objects, ids):
+        self.objects = objects
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self.objects.get(id=self.ids[index])
+        ids = self.ids[index]
+        found = self.objects.in_bulk(ids)
+        return [found[object_id] for object_id in ids if object_id in found]
+
+    def __iter__(self):
+        for start in range(0, len(self.ids), CHUNK_SIZE):
+            for obj in self[start:start + CHUNK_SIZE]:
+                yield obj
+
+def search_objects(objects, query, fields=None, rank=False):
+    '''
+    SearchResults for the objects of a Member or Account queryset matching
+    query in fields: in the queryset's order, or best matches first with
+    rank.
+    '''
+    kind = objects.model is m_models.Account and ACCOUNT or MEMBER
+    matched = search(kind, query, fields)
+    if not matched:
+        return SearchResults(objects, [])
+    ranks = dict([(object_id, i) for i, object_id in enumerate(matched)])
+    ids = []
+    seen = set()
+    for object_id in objects.values_list('id', flat=True):
+        # joins can list an object more than once
+        if object_id in ranks and object_id not in seen:
+            seen.add(object_id)
+            ids.append(object_id)
+    if rank:
+        ids.sort(key=ranks.get)
+    return SearchResults(objects.model._default_manager.all(), ids)
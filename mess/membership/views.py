@@ -16,8 +16,9 @@ from django.utils.datastructures import MultiValueDictKeyError
 
 #from mess.accounting import models as a_models
 from mess.utils.logging import log
-from mess.membership import forms, models
+from mess.membership import forms, models, searchindex
 from mess.events import models as e_models
+from mess.scheduling import models as s_models
 from mess.accounting import models as a_models
 from mess.core.permissions import has_elevated_perm
 
@@ -48,10 +49,6 @@ def members(request):
         form = forms.MemberListFilterForm(request.GET)
         if form.is_valid():
             search = form.cleaned_data.get('search')
-            if search:
-                members = members.filter(
-                        Q(user__first_name__icontains=search) |
-                        Q(user__last_name__icontains=search))
             sort = form.cleaned_data['sort_by']
             if sort == 'alpha':
                 members = members.order_by('user__username')
@@ -66,6 +63,9 @@ def members(request):
                 members = members.exclude(date_missing__isnull=False)
             if not form.cleaned_data['departed']:
                 members = members.exclude(date_departed__isnull=False)
+            if search:
+                members = searchindex.search_objects(members, search,
+                                                     rank=(sort == 'match'))
     else:
         form = forms.MemberListFilterForm()
         members = members.filter(date_missing__isnull=True,
@@ -231,10 +231,6 @@ def accounts(request):
             else:
                 accounts = models.Account.objects.none()
             search = form.cleaned_data.get('search')
-            if search:
-                accounts = accounts.filter(
-                        Q(name__icontains=search) |
-                        Q(note__icontains=search))
             sort = form.cleaned_data['sort_by']
             if sort == 'alpha':
                 accounts = accounts.order_by('name')
@@ -244,6 +240,9 @@ def accounts(request):
                 accounts = accounts.order_by('-hours_balance')
             elif sort == 'balance':
                 accounts = accounts.order_by('-balance')
+            if search:
+                accounts = searchindex.search_objects(accounts, search,
+                        fields=['name', 'note'], rank=(sort == 'match'))
         else:
             accounts = models.Account.objects.active()
         context['form'] = form
@@ -392,14 +391,19 @@ def depart_account(request, id):
         if 'cancel' in request.POST:   # cancel button
             return HttpResponseRedirect(account.get_absolute_url())
         form = forms.DateForm(request.POST)
-        if form.is_valid():            # save button
-            # for each member, enter the date departed and get them off of their workshifts.
-            for mem in account.members.all():
-                if not mem.date_departed:
-                    mem.date_departed = form.cleaned_data['day']
-                    mem.save()
-                mem.remove_from_shifts(form.cleaned_data['day'])
-            return HttpResponseRedirect(account.get_absolute_url())
+        if form.is_valid():
+            member_ids = [mem.id for mem in account.members.all()]
+            if 'preview' in request.POST:
+                context['preview'] = s_models.release_shifts(member_ids,
+                        form.cleaned_data['day'], preview=True)
+            else:                      # save button
+                # for each member, enter the date departed and get them off of their workshifts.
+                for mem in account.members.all():
+                    if not mem.date_departed:
+                        mem.date_departed = form.cleaned_data['day']
+                        mem.save()
+                s_models.release_shifts(member_ids, form.cleaned_data['day'])
+                return HttpResponseRedirect(account.get_absolute_url())
     else:                         # show prompt with default form values.
         form = forms.DateForm()
     context['account']=account
@@ -419,16 +423,24 @@ def loa_account(request, id):
         if 'cancel' in request.POST:   # cancel button
             return HttpResponseRedirect(account.get_absolute_url())
         form = forms.LoaForm(request.POST)
-        if form.is_valid():            # save button,
-            for mem in account.members.active():
-                s = form.cleaned_data['start']
-                e = form.cleaned_data['end']
-                new_loa = models.LeaveOfAbsence(member=mem, start=s, end=e)
-                new_loa.save()
-                if form.cleaned_data['shifts_during_LOA'] == 'long':
-                    e = None   # members shd be removed from all workshifts
-                mem.remove_from_shifts(s, e)
-            return HttpResponseRedirect(account.get_absolute_url())
+        if form.is_valid():
+            s = form.cleaned_data['start']
+            e = form.cleaned_data['end']
+            members = account.members.active()
+            member_ids = [mem.id for mem in members]
+            if form.cleaned_data['shifts_during_LOA'] == 'long':
+                shifts_end = None   # members shd be removed from all workshifts
+            else:
+                shifts_end = e
+            if 'preview' in request.POST:
+                context['preview'] = s_models.release_shifts(member_ids, s,
+                        shifts_end, preview=True)
+            else:                      # save button,
+                for mem in members:
+                    new_loa = models.LeaveOfAbsence(member=mem, start=s, end=e)
+                    new_loa.save()
+                s_models.release_shifts(member_ids, s, shifts_end)
+                return HttpResponseRedirect(account.get_absolute_url())
     else:                         # show prompt with default form values.
         form = forms.LoaForm()
     context['account']=account
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+'''
+Runs the background report jobs (see mess.reporting.jobs) in
+settings.REPORT_WORKERS processes, niced so they don't slow the registers.
+Only one report_worker.py runs at a time, so it's safe to start from cron
+every few minutes:
+
+*/5 * * * * /path/to/mess/report_worker.py
+
+It waits for new jobs until stopped; --once exits when the queue is empty.
+'''
+import fcntl
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+
+from os.path import dirname, abspath
+sys.path.append(dirname(dirname(abspath(__file__))))
+import settings
+from django.core.management import setup_environ
+setup_environ(settings)
+
+# these imports raise errors if placed before setup_environ(settings)
+from django.db import connection, reset_queries
+from mess.reporting import jobs
+
+# seconds between looks at the queue when it's empty
+POLL_SECONDS = 2
+
+def work(once=False):
+    ''' runs queued jobs one at a time, in one worker process '''
+    os.nice(settings.REPORT_WORKER_NICE)
+    while True:
+        job = jobs.claim_job()
+        if job is None:
+            if once:
+                return
+            time.sleep(POLL_SECONDS)
+            continue
+        print "running report job %s: %s" % (job.id, job.url)
+        jobs.run_job(job)
+        reset_queries()
+
+def main(processes=None, once=False):
+    if not os.path.isdir(settings.REPORT_JOB_DIR):
+        os.makedirs(settings.REPORT_JOB_DIR)
+    lock = open(os.path.join(settings.REPORT_JOB_DIR, 'worker.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        return      # another report_worker.py is running
+    failed = jobs.fail_abandoned_jobs()
+    if failed:
+        print "failed %s jobs left running" % failed
+    # each process opens its own database connection
+    connection.close()
+    workers = [multiprocessing.Process(target=work, args=(once,))
+               for i in range(processes or settings.REPORT_WORKERS)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option('--processes', type='int',
+                      help="worker processes (default %s)" %
+                           settings.REPORT_WORKERS)
+    parser.add_option('--once', action='store_true', default=False,
+                      help="exit when there are no more queued jobs")
+    options, args = parser.parse_args()
+    main(options.processes, options.once)
@@ -0,0 +1,485 @@
+'''
+Query plans for the ad-hoc list report (reporting.views.list).
+
+Rendered one object at a time, an output line like "phones" or
+"{% for y in x.members.active %}{{ y.user.email }}{% endfor %}" costs a
+query or more per object.  ReportPlan reads the attribute paths the output
+lines use before any object is rendered, follows them through the model
+relations, and loads what they need up front: foreign keys with
+select_related, and each to-many relation (phones, addresses, accounts...)
+with one query per chunk of objects.  Objects come back wrapped in Rows,
+which answer those attributes from memory and pass everything else on to
+the object itself.
+'''
+import itertools
+
+from django.contrib.auth.models import User
+from django.db.models.fields.related import OneToOneRel
+from django.db.models.query import QuerySet
+from django.template import FilterExpression, NodeList, Variable
+
+from mess.accounting.snapshot import account_snapshots
+from mess.membership import models as m_models
+from mess.scheduling import models as s_models
+
+# objects per batch of relation queries; keeps IN lists under SQLite's
+# limit on query parameters
+CHUNK_SIZE = 500
+
+# relations each model's __unicode__ and get_absolute_url follow
+DISPLAY_PATHS = {
+    m_models.Member: [('user',)],
+    m_models.AccountMember: [('account',), ('member', 'user')],
+    s_models.Task: [('job',), ('account',), ('member', 'user')],
+}
+
+# Account properties that account_snapshots() computes for many accounts
+SNAPSHOT_ATTRS = ('active_member_count', 'billable_member_count',
+                  'discount')
+
+# the tables the methods and properties (manager methods included) that
+# reports use read besides their model's own, for the tables a report
+# depends on (ReportPlan.models).  A report using any other method isn't
+# cached.  all, count and get_FOO_display read nothing more anywhere.
+SHIFT_READS = (s_models.Task, s_models.RecurRule, s_models.Exclusion, 
+               s_models.Job, m_models.Member, m_models.Account)
+COMPUTED_READS = {
+    m_models.Member: {
+        'active': (),
+        'inactive': (),
+        'present': (m_models.LeaveOfAbsence,),
+        'is_active': (),
+        'current_loa': (m_models.LeaveOfAbsence,),
+        'is_on_loa': (m_models.LeaveOfAbsence,),
+        'verbose_status': (m_models.LeaveOfAbsence,),
+        'name': (User,),
+        'get_absolute_url': (User,),
+        'date_joined_is_realistic': (),
+        'equity_target': (m_models.Account, m_models.AccountMember),
+        'potential_new_equity_due': (m_models.Account, 
+                m_models.AccountMember, m_models.LeaveOfAbsence),
+        'skills': (s_models.Skill, s_models.Job, s_models.Task),
+        'untrained': (s_models.Skill, s_models.Job, s_models.Task),
+        'is_cashier_recently': (s_models.Task, s_models.Job),
+        'is_cashier_today': (s_models.Task, s_models.Job),
+        'date_orientation': (s_models.Task, s_models.Job),
+        'next_shift': SHIFT_READS,
+        'regular_shift': SHIFT_READS,
+        'get_primary_account': (m_models.Account, m_models.AccountMember),
+    },
+    m_models.Account: {
+        'active': (m_models.AccountMember, m_models.Member),
+        'inactive': (m_models.AccountMember, m_models.Member),
+        'present': (m_models.AccountMember, m_models.Member, 
+                    m_models.LeaveOfAbsence),
+        'alphanumericname': (),
+        'get_absolute_url': (),
+        'active_members': (m_models.AccountMember, m_models.Member),
+        'active_member_count': (m_models.AccountMember, m_models.Member),
+        'billable_members': (m_models.AccountMember, m_models.Member,
+                             m_models.LeaveOfAbsence),
+        'billable_member_count': (m_models.AccountMember, m_models.Member,
+                                  m_models.LeaveOfAbsence),
+        'discount': (m_models.AccountMember, m_models.Member, 
+                     m_models.LeaveOfAbsence),
+        'autocomplete_label': (m_models.AccountMember, m_models.Member),
+        'members_leaveofabsence_set': (m_models.AccountMember, 
+                                       m_models.LeaveOfAbsence),
+        'recent_cashier': (s_models.Task, s_models.Job),
+        'next_shift': SHIFT_READS,
+        'verbose_balance': (),
+        'owes_money': (),
+        'excused_hours_owed': (),
+        'unexcused_hours_owed': (),
+        'must_work': (),
+        'days_old': (m_models.AccountMember, m_models.Member),
+        'months_old': (m_models.AccountMember, m_models.Member),
+        'max_allowed_to_owe': (m_models.TemporaryBalanceLimit,
+                               m_models.AccountMember, m_models.Member),
+        'max_allowed_balance': (m_models.TemporaryBalanceLimit,
+                                m_models.AccountMember, m_models.Member),
+        'must_pay': (m_models.TemporaryBalanceLimit, m_models.AccountMember,
+                     m_models.Member),
+        'way_over_limit': (m_models.TemporaryBalanceLimit, 
+                           m_models.AccountMember, m_models.Member),
+        'obligations': (m_models.AccountMember, m_models.LeaveOfAbsence
+                        ) + SHIFT_READS,
+        'frozen_flags': (m_models.AccountMember, m_models.LeaveOfAbsence,
+                         m_models.TemporaryBalanceLimit) + SHIFT_READS,
+    },
+    m_models.AccountMember: {
+        'active_depositor': (m_models.Member,),
+        'present_depositor': (m_models.Member, m_models.LeaveOfAbsence),
+        'active_shopper': (m_models.Member,),
+        'inactive': (m_models.Member,),
+    },
+    m_models.LeaveOfAbsence: {
+        'current': (),
+    },
+    m_models.TemporaryBalanceLimit: {
+        'current': (),
+    },
+    m_models.Address: {
+        'fullmailing': (m_models.Member, User),
+    },
+    s_models.Task: {
+        'unassigned': (),
+        'worked': (),
+        'dancer': (s_models.Job,),
+        'not_dancer': (s_models.Job,),
+        'assigned': (),
+        'unexcused': (),
+        'workflag': (),
+        'simple_workflag': (),
+        'abbr_workflag': (),
+        'timecard_submitted': (),
+        'get_end': (),
+        'time_minus_six_days': (),
+        'get_absolute_url': (),
+        'new_date': (s_models.Job, m_models.Member),
+        'get_next_shift': SHIFT_READS,
+    },
+}
+
+
+def chunks(items, size=CHUNK_SIZE):
+    ''' yields lists of up to size items at a time from any iterable '''
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+def expression_paths(expression, scope):
+    '''
+    The attribute paths a template FilterExpression looks up, as tuples of
+    names starting from the report object.  scope maps template variable
+    names to the path they stand for.
+    '''
+    variables = [expression.var] + [arg for func, args in expression.filters
+                                    for lookup, arg in args if lookup]
+    paths = []
+    for variable in variables:
+        if isinstance(variable, Variable) and variable.lookups and \
+                variable.lookups[0] in scope:
+            paths.append(scope[variable.lookups[0]] +
+                         tuple(variable.lookups[1:]))
+    return paths
+
+def node_expressions(value, depth=0):
+    ''' the FilterExpressions in a template node's arguments '''
+    if isinstance(value, FilterExpression):
+        yield value
+    elif isinstance(value, (list, tuple)) and not isinstance(value, NodeList):
+        for item in value:
+            for expression in node_expressions(item, depth + 1):
+                yield expression
+    elif depth < 4 and hasattr(value, '__dict__') and not hasattr(value,
+            'child_nodelists'):
+        # {% if %} conditions are trees of operators and literals
+        for item in value.__dict__.values():
+            for expression in node_expressions(item, depth + 1):
+                yield expression
+
+def template_paths(template, name='x'):
+    ''' the attribute paths of name that a compiled Template looks up '''
+    paths = []
+    def walk(nodelist, scope):
+        for node in nodelist:
+            for attr, value in node.__dict__.items():
+                if not isinstance(value, NodeList):
+                    for expression in node_expressions(value):
+                        paths.extend(expression_paths(expression, scope))
+            inner = dict(scope)
+            # {% for y in x.members.all %} and {% with x.phones.all as y %}
+            sequence = getattr(node, 'sequence', getattr(node, 'var', None))
+            if isinstance(sequence, FilterExpression):
+                found = expression_paths(sequence, scope)
+                for var in getattr(node, 'loopvars', [getattr(node, 'name',
+                                                              None)]):
+                    if var and found:
+                        inner[var] = found[0]
+                    else:
+                        inner.pop(var, None)
+            for attr in getattr(node, 'child_nodelists', ('nodelist',)):
+                walk(getattr(node, attr, None) or [], inner)
+    walk(template.nodelist, {name: ()})
+    return paths
+
+
+def find_relation(model, name):
+    '''
+    (kind, related model, field) for the relation model.name, or None.
+    kind is 'fk', 'reverse' (a reverse foreign key) or 'm2m'; for 'm2m'
+    field is (through model, owner field name, related field name).
+    '''
+    opts = model._meta
+    for field in opts.fields:
+        if field.name == name and field.rel:
+            return 'fk', field.rel.to, field
+    for field in opts.many_to_many:
+        if field.name == name:
+            return 'm2m', field.rel.to, (field.rel.through,
+                    field.m2m_field_name(), field.m2m_reverse_field_name())
+    for related in opts.get_all_related_objects():
+        if related.get_accessor_name() == name and not isinstance(
+                related.field.rel, OneToOneRel):
+            return 'reverse', related.model, related.field
+    for related in opts.get_all_related_many_to_many_objects():
+        if related.get_accessor_name() == name:
+            field = related.field
+            return 'm2m', related.model, (field.rel.through,
+                    field.m2m_reverse_field_name(), field.m2m_field_name())
+
+def computed_reads(model, name):
+    '''
+    The models the method or property model.name reads besides model, or
+    None if they aren't known.  See COMPUTED_READS.
+    '''
+    if name in ('all', 'count') or (name.startswith('get_') and 
+                                    name.endswith('_display')):
+        return ()
+    return COMPUTED_READS.get(model, {}).get(name)
+
+
+class PlanNode(object):
+    ''' the relations and attributes used on objects of one model '''
+    def __init__(self, model, kind=None, field=None, display=False):
+        self.model = model
+        self.kind = kind
+        self.field = field
+        self.children = {}
+        self.attrs = set()
+        # the methods and properties rows use, not just fields
+        self.computed = set()
+        # whether only needed to display objects, not for an output line
+        self.display = display
+        for path in DISPLAY_PATHS.get(model, []):
+            self.add(path, display=True)
+
+    def add(self, path, after_many=False, display=False):
+        if not path:
+            return
+        name, rest = path[0], path[1:]
+        if name in self.children:
+            child = self.children[name]
+            child.display = child.display and display
+        else:
+            relation = find_relation(self.model, name)
+            if relation is None:
+                manager = self.model._default_manager
+                if after_many and hasattr(manager, name):
+                    # x.members.active.phones: skip the manager method
+                    self.computed.add(name)
+                    self.add(rest, after_many, display)
+                else:
+                    self.attrs.add(name)
+                    if name != 'pk' and name not in [attr for field in 
+                            self.model._meta.fields for attr in 
+                            (field.name, field.attname)]:
+                        self.computed.add(name)
+                return
+            kind, model, field = relation
+            child = self.children[name] = PlanNode(model, kind, field, 
+                                                   display)
+        child.add(rest, child.kind != 'fk', display)
+
+    def select_related(self, prefix=''):
+        ''' select_related names for the foreign key chains from here '''
+        names = []
+        for name, child in self.children.items():
+            if child.kind == 'fk':
+                names.append(prefix + name)
+                names.extend(child.select_related(prefix + name + '__'))
+        return names
+
+    def models(self):
+        '''
+        The models whose tables this node's rows are read from: its own,
+        and those its methods and properties read, or None if one of them
+        isn't in COMPUTED_READS.  Users only needed to display members
+        are left out: they're saved on every login, and a changed name 
+        shows once the cached report times out.
+        '''
+        if self.display and self.model is User:
+            return set()
+        found = set([self.model])
+        for name in self.computed:
+            reads = computed_reads(self.model, name)
+            if reads is None:
+                return None
+            found.update(reads)
+        if self.kind == 'm2m':
+            found.add(self.field[0])
+        for child in self.children.values():
+            models = child.models()
+            if models is None:
+                return None
+            found.update(models)
+        return found
+
+    def ordering(self, prefix=''):
+        ordering = self.model._meta.ordering or ['pk']
+        return [(field[:1] == '-' and '-' or '') + prefix +
+                field.lstrip('-') for field in ordering]
+
+    def load(self, owners):
+        '''
+        {owner id: [related objects]} for this to-many relation, in the
+        order the related manager would return them.
+        '''
+        related = dict([(owner.pk, []) for owner in owners])
+        for ids in chunks(related.keys()):
+            if self.kind == 'reverse':
+                objects = self.model._default_manager.filter(**{
+                        self.field.name + '__in': ids}).select_related(
+                        *self.select_related()).order_by(*self.ordering())
+                for obj in objects:
+                    related[getattr(obj, self.field.attname)].append(obj)
+            else:
+                through, owner_field, related_field = self.field
+                links = through._default_manager.filter(**{
+                        owner_field + '__in': ids}).select_related(
+                        related_field, *self.select_related(
+                        related_field + '__')).order_by(
+                        *self.ordering(related_field + '__'))
+                owner_attname = through._meta.get_field(owner_field).attname
+                for link in links:
+                    related[getattr(link, owner_attname)].append(
+                            getattr(link, related_field))
+        return related
+
+    def wrap(self, objects):
+        '''
+        Rows for objects of this node's model, with this node's relations
+        loaded, in a fixed number of queries per chunk of objects.
+        '''
+        rows = [obj is not None and Row(obj) or None for obj in objects]
+        present = [row for row in rows if row is not None]
+        for name, child in self.children.items():
+            if child.kind == 'fk':
+                related = child.wrap([getattr(row._obj, name)
+                                      for row in present])
+                for row, value in zip(present, related):
+                    row._related[name] = value
+            else:
+                loaded = child.load([row._obj for row in present])
+                objects = [obj for row in present 
+                           for obj in loaded[row._obj.pk]]
+                related = iter(child.wrap(objects))
+                ids = [obj.pk for obj in objects]
+                queries = {}
+                for row in present:
+                    row._related[name] = RelatedRows(row._obj, name,
+                            child.model, [related.next()
+                            for obj in loaded[row._obj.pk]], ids, queries)
+        if self.model is m_models.Account and self.attrs.intersection(
+                SNAPSHOT_ATTRS):
+            for ids in chunks([row._obj.pk for row in present]):
+                snapshots = dict([(snapshot.id, snapshot) for snapshot in
+                        account_snapshots(m_models.Account.objects.filter(
+                        id__in=ids))])
+                for row in present:
+                    if row._obj.pk in snapshots:
+                        for attr in SNAPSHOT_ATTRS:
+                            row._related[attr] = getattr(
+                                    snapshots[row._obj.pk], attr)
+        return rows
+
+
+class Row(object):
+    '''
+    A report object with its planned relations loaded: foreign keys as
+    Rows, to-many relations as RelatedRows.  Anything else is looked up on
+    the object.
+    '''
+    def __init__(self, obj):
+        self._obj = obj
+        self._related = {}
+
+    def __getattr__(self, name):
+        if name in ('_obj', '_related'):
+            raise AttributeError(name)
+        if name in self._related:
+            return self._related[name]
+        return getattr(self._obj, name)
+
+    def __unicode__(self):
+        return unicode(self._obj)
+
+    def __str__(self):
+        return str(self._obj)
+
+
+class RelatedRows(list):
+    '''
+    The loaded objects of one to-many relation of a Row, standing in for
+    the related manager: all() and count() work from the list, and
+    argument-free manager methods like members.active() are answered for
+    every owner at once with one query over ids, the ids of all the
+    objects loaded for the relation, remembered in queries.
+    '''
+    def __init__(self, owner, name, model, rows, ids, queries):
+        super(RelatedRows, self).__init__(rows)
+        self.owner = owner
+        self.name = name
+        self.model = model
+        self.ids = ids
+        self.queries = queries
+
+    def all(self):
+        return self
+
+    def count(self):
+        return len(self)
+
+    def __getattr__(self, name):
+        if name[:1] == '_':
+            raise AttributeError(name)
+        method = getattr(self.model._default_manager, name)
+        def filtered():
+            if name not in self.queries:
+                self.queries[name] = None
+                result = method()
+                if isinstance(result, QuerySet):
+                    ids = set()
+                    for chunk in chunks(self.ids):
+                        ids.update(result.filter(pk__in=chunk).values_list(
+                                'pk', flat=True))
+                    self.queries[name] = ids
+            if self.queries[name] is None:
+                # not a queryset: ask the object's own related manager
+                return getattr(getattr(self.owner, self.name), name)()
+            return RelatedRows(self.owner, self.name, self.model, 
+                    [row for row in self if row._obj.pk in 
+                     self.queries[name]], self.ids, self.queries)
+        return filtered
+
+
+class ReportPlan(object):
+    ''' what to load for a list report over model with the given paths '''
+    def __init__(self, model, paths):
+        self.root = PlanNode(model)
+        for path in paths:
+            self.root.add(path)
+
+    def models(self):
+        '''
+        the models whose tables the report's rows are read from, or None
+        if that isn't known
+        '''
+        return self.root.models()
+
+    def queryset(self, objects):
+        ''' objects with the plan's foreign keys selected '''
+        return objects.select_related(*self.root.select_related())
+
+    def rows(self, objects):
+        '''
+        Yields a Row for each of objects, loaded a chunk at a time.  Uses
+        QuerySet.iterator(), so only the current chunk stays in memory.
+        '''
+        for chunk in chunks(self.queryset(objects).iterator()):
+            for row in self.root.wrap(chunk):
+                yield row
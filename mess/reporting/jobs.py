@@ -0,0 +1,171 @@
+'''
+Background report jobs.
+
+Some reports take longer than a web request may run.  A report view
+decorated with @background can be asked for with ?background=1: instead
+of running, it queues a ReportJob and redirects to the job's page, which
+shows its progress.  report_worker.py runs the queued jobs in a few
+processes of its own, calling the same view with a request like the
+original one, and stores the response in a file to be served when it's
+done.  The queue is the reporting_reportjob table; no other service is
+involved.
+'''
+import datetime
+import os
+import re
+import time
+import traceback
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sites.models import Site
+from django.core.urlresolvers import resolve, set_script_prefix
+from django.http import HttpRequest, HttpResponseRedirect, QueryDict
+from django.utils.functional import wraps
+
+from mess.reporting.models import ReportJob
+
+# a running job writes its progress at most this often
+PROGRESS_SECONDS = 2
+
+def background(name):
+    '''
+    Lets a report view be run as a background job, named name (and the
+    report's desc, if any), by asking for it with ?background=1.
+    '''
+    def decorator(view):
+        def wrapper(request, *args, **kwargs):
+            if request.GET.has_key('background') and not hasattr(request,
+                                                                 'progress'):
+                job = enqueue(request, name)
+                return HttpResponseRedirect(job.get_absolute_url())
+            return view(request, *args, **kwargs)
+        wrapper.background = True
+        return wraps(view)(wrapper)
+    return decorator
+
+def enqueue(request, name):
+    ''' queues a job for the report request asks for '''
+    query = request.GET.copy()
+    del query['background']
+    if query.get('desc'):
+        name = '%s: %s' % (name, query['desc'])
+    url = request.path_info
+    if query:
+        url += '?' + query.urlencode()
+    return ReportJob.objects.create(name=name, url=url,
+            user=request.user.is_authenticated() and request.user or None,
+            script_name=request.META.get('SCRIPT_NAME', ''),
+            remote_addr=request.META.get('REMOTE_ADDR', ''))
+
+def track(request, rows, objects):
+    '''
+    rows, one for each of objects; when request is a background job's, its
+    progress counts them as they go by.
+    '''
+    progress = getattr(request, 'progress', None)
+    if progress is None:
+        return rows
+    return progress.track(rows, objects)
+
+
+class Progress(object):
+    ''' writes a running job's progress, at most every PROGRESS_SECONDS '''
+    def __init__(self, job):
+        self.job_id = job.id
+        self.written = 0
+
+    def update(self, message, force=False):
+        if force or time.time() - self.written >= PROGRESS_SECONDS:
+            self.written = time.time()
+            ReportJob.objects.filter(id=self.job_id).update(progress=message)
+
+    def track(self, rows, objects):
+        total = objects.count()
+        for count, row in enumerate(rows):
+            self.update('%s of %s rows' % (count, total))
+            yield row
+        self.update('%s of %s rows' % (total, total), force=True)
+
+
+def job_request(job):
+    ''' a GET request for job's report, as its user made it '''
+    path, query = (job.url.split('?', 1) + [''])[:2]
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = job.script_name + path
+    request.path_info = path
+    request.GET = QueryDict(query)
+    request.META = {
+        'SCRIPT_NAME': job.script_name,
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'REMOTE_ADDR': job.remote_addr,
+        'HTTP_HOST': Site.objects.get_current().domain,
+    }
+    request.user = job.user or AnonymousUser()
+    request.progress = Progress(job)
+    return request
+
+def claim_job():
+    ''' marks the oldest queued job running and returns it, or None '''
+    queued = ReportJob.objects.filter(status='queued').order_by('id')
+    for job_id in queued.values_list('id', flat=True)[:10]:
+        # another worker may get there first
+        if ReportJob.objects.filter(id=job_id, status='queued').update(
+                status='running', started=datetime.datetime.now(),
+                progress='Started'):
+            return ReportJob.objects.get(id=job_id)
+
+def run_job(job):
+    ''' runs a claimed job's report into its result file '''
+    try:
+        request = job_request(job)
+        view, args, kwargs = resolve(request.path_info)
+        if not getattr(view, 'background', False):
+            raise ValueError("%s can't run in the background" % job.url)
+        set_script_prefix(job.script_name or '/')
+        response = view(request, *args, **kwargs)
+        if response.status_code != 200:
+            raise ValueError('the report answered %s' % response.status_code)
+        if not os.path.isdir(settings.REPORT_JOB_DIR):
+            os.makedirs(settings.REPORT_JOB_DIR)
+        path = job.result_path()
+        result = open(path + '.part', 'wb')
+        try:
+            for chunk in response:
+                result.write(chunk)
+        finally:
+            result.close()
+        os.rename(path + '.part', path)
+    except Exception:
+        ReportJob.objects.filter(id=job.id).update(status='failed',
+                finished=datetime.datetime.now(),
+                error=traceback.format_exc())
+        return
+    filename = re.search(r'filename=([^;]+)',
+                         response.get('Content-Disposition', ''))
+    ReportJob.objects.filter(id=job.id).update(status='done',
+            finished=datetime.datetime.now(), progress='Finished',
+            content_type=response['Content-Type'],
+            filename=filename and filename.group(1) or '')
+
+def fail_abandoned_jobs():
+    '''
+    fails the jobs left running by a worker that stopped; only call when
+    no worker is running
+    '''
+    return ReportJob.objects.filter(status='running').update(
+            status='failed', finished=datetime.datetime.now(),
+            error='The report worker stopped before the report finished.')
+
+def delete_old_jobs(days):
+    ''' deletes the jobs created more than days ago, and their results '''
+    old = ReportJob.objects.filter(created__lt=datetime.datetime.now() -
+                                   datetime.timedelta(days))
+    for job in old:
+        if os.path.exists(job.result_path()):
+            os.remove(job.result_path())
+    count = len(old)
+    old.delete()
+    return count
@@ -1,3 +1,58 @@
+import os
+
+from django.conf import settings
+from django.contrib.admin.models import LogEntry
+from django.contrib.auth.models import User
 from django.db import models
 
-# Create your models here.
+from mess.core import dataversion
+
+JOB_STATUS = (
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+)
+
+class ReportJob(models.Model):
+    '''
+    A report page run by report_worker.py instead of in the web request,
+    see mess.reporting.jobs.  url is the page's path and query string, 
+    e.g. /reporting/memberwork/?section=Exempt; the result is the page 
+    as it would have been served, kept in a file under REPORT_JOB_DIR.
+    '''
+    user = models.ForeignKey(User, null=True, blank=True)
+    name = models.CharField(max_length=255)
+    url = models.TextField()
+    # the request's, so the report links and permissions come out the same
+    script_name = models.CharField(max_length=255, blank=True)
+    remote_addr = models.CharField(max_length=64, blank=True)
+    status = models.CharField(max_length=10, choices=JOB_STATUS,
+                              default='queued', db_index=True)
+    progress = models.CharField(max_length=255, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    # download name from the report's Content-Disposition, if any
+    filename = models.CharField(max_length=100, blank=True)
+    error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.name, self.get_status_display())
+
+    @models.permalink
+    def get_absolute_url(self):
+        return ('report_job', [self.id])
+
+    def is_pending(self):
+        return self.status in ('queued', 'running')
+
+    def result_path(self):
+        return os.path.join(settings.REPORT_JOB_DIR, '%s.out' % self.id)
+
+    class Meta:
+        ordering = ['-created']
+
+# the Logs list report reads the admin log, see mess.core.dataversion
+dataversion.track(LogEntry)
@@ -0,0 +1,75 @@
+'''
+Cache of rendered list reports (reporting.views.list).
+
+The stock reports are fixed list URLs that get reloaded many times a day.
+A report's rendered rows are cached under its definition, the date, and
+the data versions (see mess.core.dataversion) of the tables it reads, so
+they're served until one of those tables changes or REPORT_CACHE_TIMEOUT
+runs out.  An index in the cache keeps the REPORT_CACHE_SIZE most recently
+used reports and drops the others.
+'''
+import datetime
+import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import get_models
+
+from mess.core import dataversion
+
+REPORT_CACHE_TIMEOUT = getattr(settings, 'REPORT_CACHE_TIMEOUT', 60 * 60)
+REPORT_CACHE_SIZE = getattr(settings, 'REPORT_CACHE_SIZE', 50)
+
+INDEX_KEY = 'reportcache:index'
+
+def lines(text):
+    return [line for line in text.split('\r\n') if line]
+
+def report_definition(object, include, filter, order_by, output):
+    '''
+    The report parameters with blank lines dropped, include as the list
+    view reads it, and filter lines sorted, since their order doesn't
+    matter.  Later order_by lines replace earlier ones, so theirs does.
+    '''
+    if include not in ('All', 'Present'):
+        include = 'Active'
+    return (object, include, tuple(sorted(lines(filter))),
+            tuple(lines(order_by)), tuple(lines(output)))
+
+def query_models(objects):
+    '''
+    The models whose tables a queryset's SQL reads, including its filters,
+    ordering and subqueries.  Raises whatever the queryset raises when it
+    can't be compiled.
+    '''
+    sql = unicode(objects.query)
+    return set([model for model in get_models(include_auto_created=True)
+                if connection.ops.quote_name(model._meta.db_table) in sql])
+
+def report_key(definition, models):
+    ''' the cache key for a report definition reading models' tables '''
+    key = repr((definition, datetime.date.today(),
+                dataversion.versions(models)))
+    return 'reportcache:%s' % md5.md5(key).hexdigest()
+
+def get_report(key):
+    ''' the report cached under key, or None '''
+    report = cache.get(key)
+    if report is not None:
+        touch(key)
+    return report
+
+def set_report(key, report):
+    ''' caches report under key, dropping the least recently used ones '''
+    cache.set(key, report, REPORT_CACHE_TIMEOUT)
+    touch(key)
+
+def touch(key):
+    ''' marks key most recently used in the index '''
+    index = [other for other in cache.get(INDEX_KEY, []) if other != key]
+    index.append(key)
+    if len(index) > REPORT_CACHE_SIZE:
+        cache.delete_many(index[:-REPORT_CACHE_SIZE])
+        index = index[-REPORT_CACHE_SIZE:]
+    cache.set(INDEX_KEY, index, REPORT_CACHE_TIMEOUT)
@@ -11,6 +11,11 @@ urlpatterns = patterns('mess.reporting.views',
     url(r'^trans_summary/$', 'trans_summary', name='trans_summary'),
     url(r'^hours_balance_changes/$', 'hours_balance_changes', name='hours_balance_changes'),
     url(r'^turnout/$', 'turnout', name='turnout'),
+    url(r'^perf/$', 'perf', name='perf'),
+    url(r'^jobs/$', 'report_jobs', name='report_jobs'),
+    url(r'^jobs/(?P<id>\d+)/$', 'report_job', name='report_job'),
+    url(r'^jobs/(?P<id>\d+)/result/$', 'report_job_result', 
+        name='report_job_result'),
 
     # everything below here is partly unused or deprecated
     url(r'^trans_list/$', 'transaction_list_report', name='trans_list'),
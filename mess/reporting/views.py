@@ -1,13 +1,24 @@
+from cStringIO import StringIO
 from datetime import date, timedelta
+import bisect
+import csv
 import datetime
+import os
 import time
 
+from django.conf import settings
 from django.contrib.admin.models import LogEntry
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.template import RequestContext
-from django.shortcuts import render_to_response
-from django.http import HttpResponse
+from django.shortcuts import get_object_or_404, render_to_response
+from django.core.servers.basehttp import FileWrapper
+from django.http import HttpResponse, Http404
 from django.template.loader import get_template
 from django.template import Template, Context
+from django.utils.dateformat import DateFormat
+from django.utils.encoding import force_unicode
+from django.utils.formats import localize
 from django.utils.http import urlencode
 from django.utils.safestring import mark_safe
 from django.core.urlresolvers import reverse
@@ -15,6 +26,8 @@ from django.db.models import Q
 from django.db.models.aggregates import Sum, Max
 
 from mess.accounting import models as a_models
+from mess.core import dataversion
+from mess.core.middleware import recent_requests
 from mess.accounting.models import Transaction
 from mess.membership import models as m_models
 from mess.scheduling import models as s_models
@@ -22,6 +35,10 @@ from mess.scheduling.views import old_rotations
 #from mess.accounting.models import get_credit_choices, get_debit_choices
 #from mess.accounting.models import get_trans_total
 from mess.reporting import forms
+from mess.reporting import results
+from mess.reporting.jobs import background, track
+from mess.reporting.models import ReportJob
+from mess.reporting.compiler import ReportPlan, template_paths
 
 from mess.utils.search import list_usernames_from_fullname
 
@@ -65,11 +82,19 @@ def anomalies(request):
     report = '<h1>Anomalies Report (%d blips)</h1>\n' % blips + report
     return HttpResponse(report)
 
+# reports that can take longer than a web request may run; the reports
+# page also offers to run them as background jobs
+SLOW_REPORTS = ['Transaction Summary', 'Purchases Per Account Last 90 Days',
+                'One-time Equity Transfer', 'Member Work Dashboard']
+
 def reports(request):
     # each named category can have various reports, each with a name and url
     past90d = datetime.date.today() - datetime.timedelta(90)
     report_categories = [{'name':cat_name, 'reports':
-            [{'name':rpt_name, 'url':url} for rpt_name, url in cat_rpts] 
+            [{'name':rpt_name, 'url':url, 'background': 
+              rpt_name in SLOW_REPORTS and
+              url + ('?' in url and '&' or '?') + 'background=1'}
+             for rpt_name, url in cat_rpts] 
             } for cat_name, cat_rpts in [
 
         ('Accounts',[
@@ -284,14 +309,76 @@ def reports(request):
             listrpt('Logs', 'General',
                 '',
                 'action_time\r\nuser\r\ncontent_type\r\nobject_id\r\nobject_repr\r\naction_flag\r\nchange_message'),
+            ('Page Performance', reverse('perf')),
+            ('Background Report Jobs', reverse('report_jobs')),
         ]),
         ]]
     return render_to_response('reporting/reports.html', locals(),
             context_instance=RequestContext(request))
 
+def percentile(values, percent):
+    ''' nearest-rank percentile of a sorted list '''
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+def perf(request):
+    ''' latency and query counts by view, from ProfilingMiddleware '''
+    by_view = {}
+    for record in recent_requests:
+        by_view.setdefault(record['view'], []).append(record)
+    views = []
+    for view, records in by_view.items():
+        seconds = sorted([r['seconds'] for r in records])
+        queries = sorted([r['queries'] for r in records])
+        views.append({
+            'view': view,
+            'requests': len(records),
+            'p50': percentile(seconds, 50),
+            'p95': percentile(seconds, 95),
+            'queries_p50': percentile(queries, 50),
+            'queries_p95': percentile(queries, 95),
+            'sql_seconds': sum([r['sql_seconds'] for r in records]) / 
+                           len(records),
+            'latest': records[-1],
+        })
+    views.sort(key=lambda v: v['p95'], reverse=True)
+    threshold = settings.PERF_QUERY_THRESHOLD
+    return render_to_response('reporting/perf.html', locals(),
+            context_instance=RequestContext(request))
+
+def report_jobs(request):
+    ''' the latest background report jobs '''
+    jobs = ReportJob.objects.select_related('user')[:50]
+    return render_to_response('reporting/jobs.html', locals(),
+            context_instance=RequestContext(request))
+
+def report_job(request, id):
+    ''' a background report job's progress, reloading until it's done '''
+    job = get_object_or_404(ReportJob, id=id)
+    if job.started:
+        elapsed = (job.finished or datetime.datetime.now()) - job.started
+        elapsed = elapsed.days * 86400 + elapsed.seconds
+    return render_to_response('reporting/job.html', locals(),
+            context_instance=RequestContext(request))
+
+def report_job_result(request, id):
+    ''' a finished background report, as the report page would serve it '''
+    job = get_object_or_404(ReportJob, id=id, status='done')
+    if not os.path.exists(job.result_path()):
+        raise Http404
+    response = HttpResponse(FileWrapper(open(job.result_path(), 'rb')),
+                            content_type=job.content_type)
+    response['Content-Length'] = os.path.getsize(job.result_path())
+    if job.filename:
+        response['Content-Disposition'] = ('attachment; filename=%s' % 
+                                           job.filename)
+    return response
+
 def listrpt(object, desc, filter, output, include='Active', order_by=''):
     return (desc, reverse('list')+'?'+urlencode(locals()))
 
+@background('List Report')
 def list(request):
     context = RequestContext(request)
     context['form'] = forms.ListFilterForm(request.GET)
@@ -340,6 +427,9 @@ def list(request):
         objects = [] 
         outputters = []
 
+    # one DISTINCT covers every filter line
+    distinct = False
+
     for filterline in context['filter'].split('\r\n'):
         if len(filterline) == 0:
             continue
@@ -352,7 +442,8 @@ def list(request):
             if filterq[-1] == '!':
                 objects = objects.exclude(**{str(filterq[:-1]):filterval})
             else:
-                objects = objects.filter(**{str(filterq):filterval}).distinct()
+                objects = objects.filter(**{str(filterq):filterval})
+                distinct = True
         except:
             context['errors'].append(filterline)
 
@@ -360,36 +451,127 @@ def list(request):
         if len(order_by_line) == 0:
             continue
         try:
-            objects = objects.order_by(order_by_line).distinct()
+            objects = objects.order_by(order_by_line)
+            distinct = True
         except:
             context['errors'].append(order_by_line)
+    if distinct:
+        objects = objects.distinct()
 
+    box = None
     for outfield in context['output'].split('\r\n'):
         if len(outfield) == 0:
             pass
         elif outfield[:4] == 'Box:':
-            y = ListOutputter(outfield[4:], blank_object)
-            context['textarea'] = [y.render(x).replace('<br>',',\r\n') 
-                                   for x in objects]
+            box = ListOutputter(outfield[4:], blank_object)
         else:
             outputters.append(ListOutputter(outfield, blank_object))
 
-    context['outputfieldnames'] = outputters
-    if request.GET.has_key('export'):
-        context['uri'] = request.build_absolute_uri()
-        context['result'] = [[y.render(x, export=True) 
-                              for y in outputters] for x in objects]
-        template = get_template('reporting/listexport.tsv')
-        context['totals'] = [y.total for y in outputters[1:]]
-        resp = HttpResponse(template.render(context), mimetype='application/vnd.ms-excel')
-        resp['Content-Disposition'] = 'attachment; filename=mess.tsv'
+    # load what the outputters will look up on every object up front
+    if outputters:
+        paths = []
+        for outputter in outputters + [box]:
+            if outputter is not None:
+                paths.extend(outputter.paths())
+        plan = ReportPlan(objects.model, paths)
+        rows = track(request, plan.rows(objects), objects)
+    else:
+        rows = iter(objects)
+
+    if request.GET.has_key('export') or request.GET.has_key('export_csv'):
+        for outputter in outputters:
+            outputter.prepare(objects)
+        if request.GET.has_key('export_csv'):
+            resp = HttpResponse(stream_csv(outputters, rows), 
+                                mimetype='text/csv')
+            resp['Content-Disposition'] = 'attachment; filename=mess.csv'
+        else:
+            resp = HttpResponse(stream_tsv(outputters, rows,
+                                request.build_absolute_uri()), 
+                                mimetype='application/vnd.ms-excel')
+            resp['Content-Disposition'] = 'attachment; filename=mess.tsv'
         return resp
+
+    # the rendered report is cached until a table it reads changes
+    key = None
+    models = None
+    if outputters:
+        models = plan.models()
+    if models is not None:
+        for outputter in outputters:
+            models.update(outputter.models())
+        try:
+            queried = results.query_models(objects)
+        except:
+            pass    # a bad order_by line; the report shows the error
+        else:
+            # users are saved on every login, so only key on them for 
+            # user columns, not for ordering by name
+            if User not in models:
+                queried.discard(User)
+            models.update(queried)
+            key = results.report_key(results.report_definition(*[
+                    context[name] for name in ('object', 'include', 
+                    'filter', 'order_by', 'output')]), models)
+    report = None
+    if key and not request.GET.has_key('refresh'):
+        report = results.get_report(key)
+    if report is None:
+        for outputter in outputters:
+            outputter.prepare(objects)
+        rows = [x for x in rows]
+        report = {'time': datetime.datetime.now(), 'textarea': None}
+        if box is not None:
+            box.prepare(objects)
+            report['textarea'] = [box.render(x).replace('<br>',',\r\n') 
+                                  for x in rows]
+        report['result'] = [[y.render(x) for y in outputters] for x in rows]
+        report['totals'] = [y.total for y in outputters[1:]]
+        report['outputfieldnames'] = [unicode(y) for y in outputters]
+        if key:
+            results.set_report(key, report)
     else:
-        context['result'] = [[y.render(x) 
-                              for y in outputters] for x in objects]
-        template = get_template('reporting/list.html')
-        context['totals'] = [y.total for y in outputters[1:]]
-        return HttpResponse(template.render(context))
+        context['cached'] = report['time']
+        context['refresh_url'] = request.get_full_path() + '&refresh=1'
+    for name in ('result', 'totals', 'textarea', 'outputfieldnames'):
+        context[name] = report[name]
+    template = get_template('reporting/list.html')
+    return HttpResponse(template.render(context))
+
+def export_text(value):
+    ''' a report value as the export templates would print it '''
+    return force_unicode(localize(value))
+
+def stream_tsv(outputters, rows, uri):
+    '''
+    Yields the list report as TSV, a row at a time: the date, the column 
+    names, the rows, totals and the report's address.  The outputters add
+    up their totals as the rows go by, so the totals line comes last.
+    '''
+    yield u'%s\n\n' % DateFormat(datetime.datetime.now()).format('F j, Y, P')
+    yield u''.join([export_text(y) + u'\t' for y in outputters]) + u'\n\n'
+    for x in rows:
+        yield u''.join([export_text(y.render(x, export=True)) + u'\t'
+                        for y in outputters]) + u'\n'
+    yield u'\nTotals:\t' + u''.join([(y.total and export_text(y.total) or u'')
+                                   + u'\t' for y in outputters[1:]])
+    yield u'\n\n%s\n' % uri
+
+def stream_csv(outputters, rows):
+    ''' Yields the list report as CSV: column names, rows, then totals '''
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    def line(values):
+        writer.writerow([value is not None and 
+                         export_text(value).encode('utf-8') or ''
+                         for value in values])
+        text = buffer.getvalue()
+        buffer.truncate(0)
+        return text
+    yield line(outputters)
+    for x in rows:
+        yield line([y.render(x, export=True) for y in outputters])
+    yield line(['Totals:'] + [y.total or '' for y in outputters[1:]])
 
 class ListOutputter:
     def __init__(self, field, blank_object, name=None):
@@ -414,9 +596,50 @@ class ListOutputter:
             self.fieldpath = self.field.split('.')
             self.render = self.render_by_getattr
 
+    def paths(self):
+        ''' the attribute paths this outputter looks up on each object '''
+        if hasattr(self, 'template'):
+            return template_paths(self.template)
+        if hasattr(self, 'fieldpath'):
+            return [tuple(self.fieldpath)]
+        return []
+
+    def models(self):
+        ''' the models this outputter reads besides the objects' own '''
+        if hasattr(self, 'tsumtype'):
+            # DailyTotals are worked out from transactions
+            return [Transaction]
+        return []
+
+    def prepare(self, objects):
+        ''' called with the report's objects before rendering any of them '''
+        if not hasattr(self, 'tsumtype'):
+            return
+        # only accounts and members have transactions to sum; DailyTotals 
+        # are by account
+        if objects.model is m_models.Account:
+            group_by = 'account'
+        elif objects.model is m_models.Member:
+            group_by = 'member'
+        else:
+            self.tsums = None
+            return
+        if group_by == 'account' and a_models.daily_totals_cover(
+                *self.daterange):
+            self.tsums = a_models.daily_type_totals('purchase', 
+                    *self.daterange + ('account',), account__in=objects,
+                    type=self.tsumtype)
+        else:
+            start, end = self.daterange
+            self.tsums = a_models.type_totals(Transaction.objects.filter(
+                    timestamp__gte=start, timestamp__lt=end, 
+                    purchase_type=self.tsumtype, 
+                    **{'%s__in' % group_by: objects}), 'purchase', group_by)
+
     def render_tsum(self, object, export=False):
-        ts = object.transaction_set.filter(timestamp__range=self.daterange,
-            purchase_type=self.tsumtype).aggregate(Sum('purchase_amount')).values()[0]
+        if self.tsums is None:
+            return 'error: '+self.field
+        ts = self.tsums.get((object.id, self.tsumtype), (None, 0))[0]
         if ts:
             self.total += ts
         return ts
@@ -458,6 +681,11 @@ class ListOutputter:
     def __unicode__(self):
         return self.name
 
+# the member work dashboard is cached per day and the data versions of the
+# tables it reads, see memberwork()
+MEMBERWORK_TIMEOUT = 60 * 60
+
+@background('Member Work')
 def memberwork(request):
     '''
     list of members, summarizing work status, grouped by work status
@@ -472,25 +700,39 @@ def memberwork(request):
                 for i in range(-int(18/freq),1)]
         weekbreaks[freq] = [datetime.datetime.combine(x, datetime.time.min) 
                             for x in dayz]
-    memberwork = []
-    distinctmembers = {}
-    proxypair = {}
-    for member in m_models.Member.objects.active().order_by('accounts'):
-        if member in distinctmembers: 
-            continue
-        distinctmembers[member] = True
-        mw = prepmemberwork(member, weekbreaks)
-        memberwork.append(mw)
+    # the date, since current LOAs and shifts change with it; the cycles 
+    # follow from it.  Not User, which is saved on every login: name 
+    # changes move Member's version on (see m_models.user_saved).
+    key = 'memberwork:%s:%s' % (datetime.date.today(), ':'.join([
+            str(version) for table, version in dataversion.versions([
+                m_models.Member, m_models.AccountMember, m_models.Account,
+                m_models.LeaveOfAbsence, s_models.Task, 
+                s_models.RecurRule, s_models.Job])]))
+    memberwork = cache.get(key)
+    if memberwork is None:
+        memberwork = []
+        distinctmembers = {}
+        for member in m_models.Member.objects.active().order_by('accounts'
+                ).select_related('user'):
+            if member.id in distinctmembers: 
+                continue
+            distinctmembers[member.id] = True
+            memberwork.append(member)
+        prepmemberwork(memberwork, weekbreaks)
 
         # If a proxy has a shift, and someone else in the account needs
         # a shift, match them up in a 'proxy shift pairs' section.
         # This way 'Need Shift' is only people who REALLY need a shift.
-        if mw.section == 'Proxy' and mw.shift:
-            proxypair[mw.get_primary_account()] = mw
-    for mw in memberwork:
-        if mw.section == 'Need Shift' and mw.get_primary_account() in proxypair:
-            mw.section = 'Proxy Shift Pairs'
-            proxypair[mw.get_primary_account()].section = 'Proxy Shift Pairs'
+        proxypair = {}
+        for mw in memberwork:
+            if mw.section == 'Proxy' and mw.shift:
+                proxypair[mw.primary_account_id] = mw
+        for mw in memberwork:
+            if (mw.section == 'Need Shift' and 
+                    mw.primary_account_id in proxypair):
+                mw.section = 'Proxy Shift Pairs'
+                proxypair[mw.primary_account_id].section = 'Proxy Shift Pairs'
+        cache.set(key, memberwork, MEMBERWORK_TIMEOUT)
 
     section_names = ['Regular Shift', 'Cashiers', 'Dancers', 'Committee', 
         'Exempt', 'No Workshift', 'LOA', 'Need Shift', 'Proxy Shift Pairs', 
@@ -503,40 +745,93 @@ def memberwork(request):
     return render_to_response('reporting/memberwork.html', locals(),
             context_instance=RequestContext(request))
 
-def prepmemberwork(member, weekbreaks):
-    # return this very member object, but just add things onto it.
-    shift = member.regular_shift()
-    if shift:
-        shift.rotletter = old_rotations(shift.time, shift.recur_rule.interval)
-    if shift and shift.recur_rule.interval == 6:
-        freq = 6
-    else:
-        freq = 4
-    member.shift = shift
-    member.freq = freq
-    member.cycletasks = [member.task_set.filter(time__range=(
-            weekbreaks[freq][i], weekbreaks[freq][i+1])) 
-            for i in range(len(weekbreaks[freq])-1)]
-    if member.accountmember_set.filter(shopper=False).count() == 0:
-        section = 'Proxy'
-    elif member.is_on_loa:
-        section = 'LOA'
-    elif member.work_status == 'e':
-        section = 'Exempt'
-    elif member.work_status == 'c':
-        section = 'Committee'
-    elif member.work_status == 'n':
-        section = 'No Workshift'
-    elif member.shift == None:
-        section = 'Need Shift'
-    elif member.shift.job.name == 'Cashier':
-        section = 'Cashiers'
-    elif 'Dancer' in member.shift.job.name:
-        section = 'Dancers'
-    else:
-        section = 'Regular Shift'
-    member.section = section
-    return member
+def cycle_indexes(weekbreaks, time):
+    '''
+    The cycles a task at time falls in: cycle i runs from weekbreaks[i] to
+    weekbreaks[i+1], both included, so a task on a break is in two.
+    '''
+    left = bisect.bisect_left(weekbreaks, time)
+    right = bisect.bisect_right(weekbreaks, time)
+    return range(max(left - 1, 0), min(right, len(weekbreaks) - 1))
+
+def prepmemberwork(members, weekbreaks):
+    '''
+    Adds shift, freq, cycletasks, section, loa, primary_account_id and the
+    accountmember_list and account_list to each of these members, with a
+    query for each kind of data rather than several per member.
+    '''
+    member_ids = [member.id for member in members]
+    tasks = s_models.Task.objects.filter(member__in=member_ids)
+    # like member.regular_shift()
+    shifts = {}
+    for shift in tasks.filter(time__gte=datetime.date.today(),
+            recur_rule__isnull=False).select_related('job', 'recur_rule'):
+        shifts.setdefault(shift.member_id, shift)
+    history = {}
+    for task in tasks.filter(time__range=(
+            min([breaks[0] for breaks in weekbreaks.values()]),
+            max([breaks[-1] for breaks in weekbreaks.values()]))):
+        history.setdefault(task.member_id, []).append(task)
+    links = {}
+    for link in m_models.AccountMember.objects.filter(member__in=member_ids
+            ).select_related('account'):
+        links.setdefault(link.member_id, []).append(link)
+    # like member.current_loa
+    loas = {}
+    for loa in m_models.LeaveOfAbsence.objects.current().filter(
+            member__in=member_ids).order_by('id'):
+        loas.setdefault(loa.member_id, loa)
+
+    for member in members:
+        shift = shifts.get(member.id)
+        if shift:
+            shift.rotletter = old_rotations(shift.time, 
+                                            shift.recur_rule.interval)
+        if shift and shift.recur_rule.interval == 6:
+            freq = 6
+        else:
+            freq = 4
+        member.shift = shift
+        member.freq = freq
+        member.cycletasks = [[] for i in range(len(weekbreaks[freq])-1)]
+        for task in history.get(member.id, []):
+            for i in cycle_indexes(weekbreaks[freq], task.time):
+                member.cycletasks[i].append(task)
+        member.loa = loas.get(member.id)
+        member.accountmember_list = links.get(member.id, [])
+        member.account_list = []
+        for link in member.accountmember_list:
+            if link.account not in member.account_list:
+                member.account_list.append(link.account)
+        member.account_list.sort(key=lambda account: account.name)
+        # like member.get_primary_account(), which gets Account's ordering
+        primary = ([account for account in member.account_list 
+                    if [link for link in member.accountmember_list 
+                        if link.account == account and not link.shopper]]
+                   + member.account_list + [None])[0]
+        member.primary_account_id = primary and primary.id
+
+        if not [link for link in member.accountmember_list 
+                if not link.shopper]:
+            section = 'Proxy'
+        elif member.loa:
+            section = 'LOA'
+        elif member.work_status == 'e':
+            section = 'Exempt'
+        elif member.work_status == 'c':
+            section = 'Committee'
+        elif member.work_status == 'n':
+            section = 'No Workshift'
+        elif member.shift == None:
+            section = 'Need Shift'
+        elif member.shift.job.name == 'Cashier':
+            section = 'Cashiers'
+        elif 'Dancer' in member.shift.job.name:
+            section = 'Dancers'
+        else:
+            section = 'Regular Shift'
+        member.section = section
+    return members
 
 
 def transaction_list_report(request):
@@ -597,6 +892,7 @@ def hours_balance_changes(request):
             context_instance=RequestContext(request))
 
 
+@background('Transaction Summary')
 def trans_summary(request):
     """View to summarize transactions by type."""
     storedays = a_models.StoreDay.objects.all().order_by('-start')
@@ -624,8 +920,9 @@ def trans_summary(request):
     list_each = form.cleaned_data.get('list_each')
     filter_type = form.cleaned_data.get('type')
     note = form.cleaned_data.get('note')
+    # from start until (not including) end, like the DailyTotals
     transactions = a_models.Transaction.objects.filter(
-                   timestamp__range=(start, end))
+                   timestamp__gte=start, timestamp__lt=end)
 
     if filter_type:
         transactions = transactions.filter(Q(purchase_type=filter_type) | 
@@ -637,21 +934,14 @@ def trans_summary(request):
     starting_total = a_models.total_balances_on(start)
     ending_total = a_models.total_balances_on(end)
 
-    purchases_by_type = []
-    purchases_total = 0
-    for (code, type) in a_models.PURCHASE_CHOICES:
-        total_by_type = transactions.filter(purchase_type=code).aggregate(
-                        Sum('purchase_amount')).values()[0]
-        purchases_by_type.append({'type':type, 'total':total_by_type})
-        purchases_total += total_by_type or 0
-
-    payments_by_type = []
-    payments_total = 0
-    for (code, type) in a_models.PAYMENT_CHOICES:
-        total_by_type = transactions.filter(payment_type=code).aggregate(
-                        Sum('payment_amount')).values()[0]
-        payments_by_type.append({'type':type, 'total':total_by_type})
-        payments_total += total_by_type or 0
+    if not (filter_type or note) and a_models.daily_totals_cover(start, end):
+        summary = a_models.TransactionSummary(days=(start, end))
+    else:
+        summary = a_models.TransactionSummary(transactions)
+    purchases_by_type = summary.purchases_by_type()
+    purchases_total = summary.purchases_total
+    payments_by_type = summary.payments_by_type()
+    payments_total = summary.payments_total
 
     # accounting gibberish for Dan
     start_plus_purchases = starting_total + purchases_total
@@ -710,6 +1000,7 @@ def equity(request):
     return render_to_response('reporting/equity.html', locals(),
             context_instance=RequestContext(request))
 
+@background('One-time Equity Transfer')
 def equity_transfer(request):
     ''' member equity, grouped by account'''
     all_equity_transactions = a_models.Transaction.objects.filter(purchase_type='O')
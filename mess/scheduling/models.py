@@ -1,13 +1,26 @@
+import calendar
 import datetime
+import md5
 from dateutil import rrule
 
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, models
+from django.db.backends.util import typecast_timestamp
+from django.db.models.aggregates import Max, Min
+from django.db.models.signals import post_save, post_delete
+from django.db.transaction import commit_on_success, set_dirty
 from django.template import loader, Context
 from django.utils.safestring import mark_safe
 
+from mess.core import dataversion
+
 today = datetime.date.today()
 todaytime = datetime.datetime(today.year, today.month, today.day)
 
+# recurring tasks are stored this far ahead, see recur_horizon()
+RECUR_HORIZON_DAYS = getattr(settings, 'RECUR_HORIZON_DAYS', 183)
+
 JOB_TYPES = (
     ('s','Staff'),
     ('p','Paid'),
@@ -90,13 +103,27 @@ class Exclusion(models.Model):
     recur_rule = models.ForeignKey(RecurRule)
 
 
+# the Task fields a recur_rule's occurrences share, see recur_copy()
+RECUR_FIELDS = ('job_id', 'time', 'hours', 'member_id', 'account_id')
+
 class TaskManager(models.Manager):
     'Custom manager to add extra methods'
     def unassigned(self):
         return self.filter(models.Q(member=None) | models.Q(account=None))
 
     def unassigned_future(self):
-        return self.unassigned().filter(time__gte=today)
+        ''' the open slots from today up to recur_horizon() '''
+        return self.open_slots(time__gte=open_slots_start())
+
+    def open_slots(self, **filters):
+        '''
+        The tasks in the OpenSlot index, filtered on OpenSlot's fields, 
+        e.g. open_slots(job=job, has_member=False).  Only stored tasks are
+        indexed: call store_open_slots() first for a window that may reach
+        past recur_horizon().
+        '''
+        return self.filter(**dict([('open_slot__%s' % field, value)
+                                   for field, value in filters.items()]))
 
     def dancer(self):
         return self.filter(job__name__istartswith='danc')
@@ -106,6 +133,18 @@ class TaskManager(models.Manager):
 
     def worked(self):
         return self.filter(hours_worked__gt=0)
+
+    def occurrences(self, start, end, **filters):
+        '''
+        Every task from start to end (datetimes, end excluded) matching 
+        filters (e.g. account=account), in Task order: the stored ones, plus
+        unsaved Tasks (id None) for recur_rule occurrences past the stored 
+        horizon.
+        '''
+        tasks = list(self.filter(time__gte=start, time__lt=end, **filters))
+        tasks.extend(unstored_occurrences(start, end, **filters))
+        tasks.sort(key=lambda task: (task.time, task.hours, task.job_id))
+        return tasks
    
 class Task(models.Model):
     """
@@ -128,6 +167,9 @@ class Task(models.Model):
     banked = models.BooleanField()
 
     recur_rule = models.ForeignKey(RecurRule, null=True, blank=True)
+    # this occurrence was changed on its own, so its recur_rule's later 
+    # occurrences aren't copied from it; see last_recur_tasks()
+    edited = models.BooleanField(editable=False)
 
     reminder_call = models.CharField(max_length=1, choices=REMINDER_CALL, null=True, default='n')
 
@@ -136,6 +178,67 @@ class Task(models.Model):
     class Meta:
         ordering = ['time', 'hours', 'job']
 
+    def __init__(self, *args, **kwargs):
+        super(Task, self).__init__(*args, **kwargs)
+        self._saved_member_id = self.member_id
+        self._saved_account_id = self.account_id
+        self._saved_time = self.time
+        self._saved_recur = self.recur_values()
+
+    def recur_values(self):
+        return (self.recur_rule_id,) + tuple([getattr(self, field) 
+                                              for field in RECUR_FIELDS])
+
+    def save(self, *args, **kwargs):
+        if (self.id and self.recur_rule_id and 
+                self.recur_rule_id == self._saved_recur[0] and 
+                self.recur_values() != self._saved_recur):
+            self.edited = True
+            if self.time != self._saved_time:
+                # or the rule would fill the time it moved from again
+                Exclusion.objects.get_or_create(date=self._saved_time, 
+                                                recur_rule=self.recur_rule)
+        created = self.id is None
+        super(Task, self).save(*args, **kwargs)
+        if created or self.member_id != self._saved_member_id or (
+                self.time >= open_slots_start()) != (
+                self._saved_time >= open_slots_start()):
+            self.touch_accounts()
+        self.update_open_slot()
+        self._saved_member_id = self.member_id
+        self._saved_account_id = self.account_id
+        self._saved_time = self.time
+        self._saved_recur = self.recur_values()
+
+    def delete(self, *args, **kwargs):
+        super(Task, self).delete(*args, **kwargs)
+        self.touch_accounts()
+
+    def update_open_slot(self):
+        ''' adds, updates or removes this task's OpenSlot row '''
+        if (self.time >= open_slots_start() and 
+                not (self.member_id and self.account_id)):
+            OpenSlot(task=self, job_id=self.job_id, time=self.time, 
+                     hours=self.hours, excused=self.excused, 
+                     has_member=bool(self.member_id), 
+                     has_account=bool(self.account_id)).save()
+        else:
+            OpenSlot.objects.filter(task=self.id).delete()
+
+    def touch_accounts(self):
+        '''
+        Account flags count members' shifts and their future ones ('NEEDS 
+        SHIFT'), so bump the accounts of the member gaining or losing this
+        task.  save() only calls it when the task is new, changes member or
+        moves across today.
+        '''
+        member_ids = set([self.member_id, self._saved_member_id]) - set([None])
+        if member_ids:
+            # imported here, membership.models imports this module
+            from mess.membership import models as m_models
+            m_models.touch_accounts(m_models.Account.objects.filter(
+                    accountmember__member__in=member_ids))
+
     def __unicode__(self):
         try:
             return u'%s, %s %sh, %s (%s)' % (self.job, 
@@ -175,30 +278,12 @@ class Task(models.Model):
 
     @property
     def workflag(self):
-        flag = ''
-        if self.excused:
-            flag += 'excused '
-        elif self.unexcused:
-            flag += 'unexcused '
-        if self.makeup:
-            flag += 'makeup '
-        if self.banked:
-            flag += 'banked '
-        return flag.strip()
-        # possible values: '', 'excused', 'excusedmakeup', 'excusedbanked', 'excusedmakeupbanked', 'unexcused', 'unexcusedmakeup', 'unexcusedbanked', 'unexcusedmakeupbanked', 'makeup', 'banked', 'makeupbanked'
+        return workflag(self.hours_worked, self.excused, self.makeup, 
+                        self.banked)
 
     @property
     def simple_workflag(self):
-        if 'unexcused' in self.workflag:
-            return 'unexcused'
-        elif ' ' in self.workflag:
-            return 'complex-workflag'
-        elif self.workflag != '':
-            return self.workflag
-        elif self.hours_worked:
-            return 'worked'
-        else:
-            return 'scheduled'
+        return simple_workflag(self.workflag, self.hours_worked)
 
     @property
     # this returns things like Y2 or EM3 or UB2
@@ -261,9 +346,9 @@ class Task(models.Model):
 
     def get_next_shift(self):
         if self.recur_rule:
-            future_tasks = self.recur_rule.task_set.filter(time__gt=self.time)
-            if future_tasks:
-                next_task = future_tasks.order_by('time')[0]
+            next_task = next_occurrence(self.time + datetime.timedelta(
+                    seconds=1), recur_rule=self.recur_rule_id)
+            if next_task:
                 return next_task.time
 
     def set_recur_rule(self, frequency, interval, until):
@@ -288,6 +373,8 @@ class Task(models.Model):
         for exclusion in exclusions:
             exclusion.recur_rule = recur_rule
         self.recur_rule = recur_rule
+        # the new rule's occurrences are copies of this one
+        self.edited = False
         self.save()
 
     def duplicate_recur_rule(self):
@@ -304,30 +391,10 @@ class Task(models.Model):
         self.save()
 
     def update_buffer(self):
-        """Update the 2-year date buffer."""
+        """Store this task's recur_rule up to the recur_horizon()."""
         if not self.recur_rule:
             return
-        frequency = getattr(rrule, 
-                self.recur_rule.get_frequency_display().upper())
-        today = datetime.datetime.today()
-        two_years_hence = today + datetime.timedelta(731)
-        until = self.recur_rule.until or two_years_hence
-        recur = rrule.rrule(frequency, dtstart=self.time, 
-                interval=self.recur_rule.interval, until=until)
-        recur_set = rrule.rruleset()
-        recur_set.rrule(recur)
-        for exclusion in self.recur_rule.exclusion_set.all():
-            recur_set.exdate(exclusion.date)
-        existing_tasks = Task.objects.filter(recur_rule=self.recur_rule)
-        existing_dates = [task.time for task in existing_tasks]
-        for task_date in recur_set:
-            # don't re-create existing tasks
-            if task_date in existing_dates:
-                continue
-            task = Task(job=self.job, time=task_date, hours=self.hours,
-                    member=self.member, account=self.account, 
-                    recur_rule=self.recur_rule)
-            task.save()
+        expand_recur_rules([self])
 
     def duplicate(self):
         new_task = Task(job=self.job, time=self.time, hours=self.hours)
@@ -362,28 +429,669 @@ class Task(models.Model):
                 return '%s months' % self.recur_rule.interval
 
 
+class OpenSlot(models.Model):
+    '''
+    Index of the tasks from today on that still need someone: one row per
+    stored Task missing a member or an account, with the fields switch and
+    signup lists search on.  Occurrences past recur_horizon() aren't 
+    stored, so aren't in it until store_open_slots() stores them.  Kept up by Task.save() and index_open_slots(),
+    and rebuilt nightly by rebuild_open_slots().
+    '''
+    task = models.OneToOneField(Task, primary_key=True, 
+                                related_name='open_slot')
+    job = models.ForeignKey(Job)
+    time = models.DateTimeField(db_index=True)
+    hours = models.DecimalField(max_digits=4, decimal_places=2)
+    excused = models.BooleanField()
+    has_member = models.BooleanField()
+    has_account = models.BooleanField()
+
+def open_slots_start():
+    return datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+
+FILL_OPEN_SLOTS_SQL = '''
+    INSERT INTO scheduling_openslot (task_id, job_id, time, hours, excused,
+                                     has_member, has_account)
+    SELECT id, job_id, time, hours, excused, 
+           member_id IS NOT NULL, account_id IS NOT NULL
+    FROM scheduling_task
+    WHERE time >= %s AND (member_id IS NULL OR account_id IS NULL)
+    '''
+
+def index_open_slots(task_ids):
+    '''
+    Redoes the OpenSlot rows of just these tasks from scheduling_task, for
+    bulk writes that don't go through Task.save().  Call inside a
+    transaction.
+    '''
+    task_ids = list(task_ids)
+    if not task_ids:
+        return
+    start = connection.ops.value_to_db_datetime(open_slots_start())
+    cursor = connection.cursor()
+    # chunks keep under sqlite's limit of 999 query parameters
+    for i in range(0, len(task_ids), 500):
+        ids = task_ids[i:i + 500]
+        marks = ', '.join(['%s'] * len(ids))
+        cursor.execute('DELETE FROM scheduling_openslot WHERE task_id IN (%s)'
+                       % marks, ids)
+        cursor.execute(FILL_OPEN_SLOTS_SQL + ' AND id IN (%s)' % marks,
+                       [start] + ids)
+    set_dirty()
+
+def fill_open_slots():
+    '''
+    Rebuilds the whole OpenSlot index from scheduling_task, dropping the
+    tasks that have slipped into the past.  Call inside a transaction.
+    '''
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM scheduling_openslot')
+    cursor.execute(FILL_OPEN_SLOTS_SQL, [
+            connection.ops.value_to_db_datetime(open_slots_start())])
+    set_dirty()
+
+def store_open_slots(end):
+    '''
+    Stores the recurring occurrences from recur_horizon() until end, if 
+    end is past it, so open_slots() up to end finds the open ones there too.
+    '''
+    horizon = recur_horizon()
+    if end > horizon:
+        store_occurrences(horizon, end)
+
+@commit_on_success
+def rebuild_open_slots():
+    ''' fill_open_slots() in its own transaction, for the nightly cron '''
+    fill_open_slots()
+
+def insert_tasks(tasks):
+    '''
+    Inserts new Tasks with one executemany instead of a save() each, then 
+    does save()'s account bookkeeping once for all of them.  The tasks are
+    recur_rule occurrences, found again by their rule and time.
+    '''
+    if not tasks:
+        return
+    fields = [f for f in Task._meta.local_fields if f.name != 'id']
+    cursor = connection.cursor()
+    cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+            connection.ops.quote_name(Task._meta.db_table),
+            ', '.join([connection.ops.quote_name(f.column) for f in fields]),
+            ', '.join(['%s'] * len(fields))),
+        [[f.get_db_prep_save(f.pre_save(task, True), connection=connection)
+          for f in fields] for task in tasks])
+    set_dirty()
+    dataversion.changed(Task)
+    days_changed([task.time for task in tasks])
+    accounts_changed([task.account_id for task in tasks])
+    index_open_slots(occurrence_ids(tasks))
+    member_ids = set([task.member_id for task in tasks]) - set([None])
+    if member_ids:
+        from mess.membership import models as m_models
+        m_models.touch_accounts(m_models.Account.objects.filter(
+                accountmember__member__in=member_ids))
+
+def occurrence_ids(tasks):
+    '''
+    The ids of the stored tasks at the recur_rule and time of one of tasks,
+    e.g. the ones insert_tasks() just wrote.  A copy another process wrote
+    at the same time is found too.
+    '''
+    keys = set([(task.recur_rule_id, task.time) for task in tasks])
+    rule_ids = list(set([rule_id for rule_id, time in keys]))
+    times = [time for rule_id, time in keys]
+    ids = []
+    # chunks keep under sqlite's limit of 999 query parameters
+    for i in range(0, len(rule_ids), 500):
+        for task_id, rule_id, time in Task.objects.filter(
+                recur_rule__in=rule_ids[i:i + 500], 
+                time__range=(min(times), max(times))).values_list(
+                'id', 'recur_rule', 'time'):
+            if (rule_id, time) in keys:
+                ids.append(task_id)
+    return ids
+
+TIMECARD_FIELDS = ('hours_worked', 'excused', 'makeup', 'banked',
+                   'reminder_call')
+
+@commit_on_success
+def update_timecards(entries):
+    '''
+    Saves timecard entries, a list of (task id, {field: value}) with fields
+    from TIMECARD_FIELDS.  Loads the tasks in one query and only writes
+    the ones whose values differ, with one UPDATE per distinct set of
+    values, then does save()'s bookkeeping once.  Returns (task, changed
+    field names) for each entry, in order; task is None if it's gone.
+    '''
+    tasks = Task.objects.in_bulk([task_id for task_id, values in entries])
+    results = []
+    batches = {}
+    for task_id, values in entries:
+        task = tasks.get(task_id)
+        if task is None:
+            results.append((None, []))
+            continue
+        changed = [field for field in TIMECARD_FIELDS if field in values
+                   and getattr(task, field) != values[field]]
+        results.append((task, changed))
+        if changed:
+            for field in changed:
+                setattr(task, field, values[field])
+            key = tuple([(field, values[field]) for field in changed])
+            batches.setdefault(key, []).append(task)
+    for key, batch in batches.items():
+        Task.objects.filter(id__in=[task.id for task in batch]).update(
+                **dict(key))
+        excused = dict(key).get('excused')
+        if excused is not None:
+            OpenSlot.objects.filter(task__in=[task.id for task in batch]
+                    ).update(excused=excused)
+    if batches:
+        set_dirty()
+        dataversion.changed(Task)
+    # reminder calls don't count toward work history or turnout
+    worked = [task for task, changed in results if changed and
+              set(changed) != set(['reminder_call'])]
+    days_changed([task.time for task in worked])
+    accounts_changed([task.account_id for task in worked])
+    return results
+
+@commit_on_success
+def release_shifts(member_ids, start, end=None, preview=False):
+    '''
+    Takes members off their shifts from start (a date, or today if
+    earlier) through end, or for good if end is None.  Each recur_rule
+    involved is split at start: its later tasks move to a copy of the rule,
+    so the old rule keeps the past, with the rule's later Exclusions.
+    Released tasks are left unassigned, and those inside an end date are
+    also taken off their rule for one-time fill.  Occurrences past the
+    recur_horizon() that are released, or that resume the shift after
+    end, are stored first.  Takes a few queries per rule, however many
+    tasks.  Returns counts of the tasks, released tasks and rules; with
+    preview, only counts.
+    '''
+    counts = {'tasks': 0, 'released': 0, 'rules': 0}
+    today = datetime.date.today()
+    if start < today:
+        start = today
+    if end and end < today:
+        return counts          # end date in past; don't mess with shifts.
+    start = datetime.datetime.combine(start, datetime.time.min)
+    # the shift carries on from resume under the copy of its rule
+    resume = start
+    if end:
+        resume = datetime.datetime.combine(end + datetime.timedelta(1),
+                                           datetime.time.min)
+    unstored = unstored_releases(member_ids, start, resume)
+    if preview:
+        rows = [(None, task.recur_rule_id, task.time, task.account_id) 
+                for task in unstored]
+    else:
+        insert_tasks(unstored)
+        rows = []
+    rows.extend(Task.objects.filter(member__in=member_ids, time__gte=start
+            ).values_list('id', 'recur_rule', 'time', 'account'))
+    if end:
+        released = [row for row in rows if row[2] < resume]
+    else:
+        released = rows
+    released_ids = set([row[0] for row in released])
+    # tasks released for one-time fill leave their rule anyway
+    moving = {}
+    for task_id, rule_id, time, account_id in rows:
+        if rule_id and not (end and task_id in released_ids):
+            moving.setdefault(rule_id, []).append(task_id)
+    rule_ids = set([row[1] for row in rows]) - set([None])
+    counts.update(tasks=len(rows), released=len(released),
+                  rules=len(rule_ids))
+    if preview or not rows:
+        return counts
+
+    for rule in RecurRule.objects.filter(id__in=moving.keys()):
+        new_rule = RecurRule(frequency=rule.frequency,
+                             interval=rule.interval, until=rule.until)
+        new_rule.save()
+        Task.objects.filter(id__in=moving[rule.id]).update(
+                recur_rule=new_rule)
+        for exclusion in rule.exclusion_set.filter(date__gte=start):
+            Exclusion.objects.create(date=exclusion.date, 
+                                     recur_rule=new_rule)
+    RecurRule.objects.filter(id__in=rule_ids).update(until=start)
+    release = dict(member=None, account=None)
+    if end:
+        release['recur_rule'] = None
+    Task.objects.filter(id__in=released_ids).update(**release)
+    set_dirty()
+    dataversion.changed(Task, RecurRule)
+    days_changed([row[2] for row in rows])
+    accounts_changed([row[3] for row in rows])
+    # moving tasks to another rule leaves their OpenSlot rows as they were
+    index_open_slots(released_ids)
+    from mess.membership import models as m_models
+    m_models.touch_accounts(m_models.Account.objects.filter(
+            accountmember__member__in=member_ids))
+    return counts
+
+def unstored_releases(member_ids, start, resume):
+    '''
+    For release_shifts(): the members' occurrences from start to resume
+    that are only worked out so far, and for each of their recur_rules,
+    the first occurrence from resume on if that isn't stored either.
+    Unsaved Tasks, as from unstored_occurrences().
+    '''
+    tasks = unstored_occurrences(start, resume, member__in=member_ids)
+    stored = set(Task.objects.filter(member__in=member_ids, 
+            time__gte=resume, recur_rule__isnull=False).values_list(
+            'recur_rule', flat=True))
+    for task in last_recur_tasks(start, member__in=member_ids):
+        if task.recur_rule_id in stored:
+            continue
+        task = next_occurrence(resume, recur_rule=task.recur_rule_id)
+        if task and task.id is None and task.member_id in member_ids:
+            tasks.append(task)
+    return tasks
+
+def workflag(hours_worked, excused, makeup, banked):
+    ''' Task.workflag, for when there's only the task's values '''
+    flag = ''
+    if excused:
+        flag += 'excused '
+    elif hours_worked == 0:     # unexcused
+        flag += 'unexcused '
+    if makeup:
+        flag += 'makeup '
+    if banked:
+        flag += 'banked '
+    return flag.strip()
+    # possible values: '', 'excused', 'excusedmakeup', 'excusedbanked', 'excusedmakeupbanked', 'unexcused', 'unexcusedmakeup', 'unexcusedbanked', 'unexcusedmakeupbanked', 'makeup', 'banked', 'makeupbanked'
+
+def simple_workflag(workflag, hours_worked):
+    ''' Task.simple_workflag, from the task's workflag '''
+    if 'unexcused' in workflag:
+        return 'unexcused'
+    elif ' ' in workflag:
+        return 'complex-workflag'
+    elif workflag != '':
+        return workflag
+    elif hours_worked:
+        return 'worked'
+    else:
+        return 'scheduled'
+
+def qualified_job_ids(skill_ids):
+    ''' the ids of the Jobs that require no skills beyond skill_ids '''
+    required = dict([(job_id, set()) for job_id in 
+                     Job.objects.values_list('id', flat=True)])
+    for job_id, skill_id in Job.skills_required.through.objects.values_list(
+            'job', 'skill'):
+        required[job_id].add(skill_id)
+    return [job_id for job_id, skills in required.items() 
+            if skills <= set(skill_ids)]
+
+def load_related(tasks):
+    '''
+    Sets job, recur_rule, member (with its user and a phone_list) and 
+    account on tasks, saved or not, with one query each instead of one 
+    per task.
+    '''
+    from mess.membership import models as m_models
+    def ids(field):
+        return set([getattr(task, field) for task in tasks]) - set([None])
+    jobs = Job.objects.in_bulk(ids('job_id'))
+    rules = RecurRule.objects.in_bulk(ids('recur_rule_id'))
+    members = dict([(member.id, member) for member in 
+            m_models.Member.objects.filter(id__in=ids('member_id')
+            ).select_related('user')])
+    accounts = m_models.Account.objects.in_bulk(ids('account_id'))
+    for member in members.values():
+        member.phone_list = []
+    for phone in m_models.Phone.objects.filter(member__in=members.keys()
+            ).order_by('id'):
+        members[phone.member_id].phone_list.append(phone)
+    for task in tasks:
+        task.job = jobs[task.job_id]
+        if task.recur_rule_id:
+            task.recur_rule = rules[task.recur_rule_id]
+        if task.member_id:
+            task.member = members[task.member_id]
+        if task.account_id:
+            task.account = accounts[task.account_id]
+    return tasks
+
+# the rotation board, cached by scheduling.views.rotation_board
+ROTATION_TIMEOUT = 60 * 60
+
+def rotation_key(dates):
+    '''
+    The cache key of the rotation board showing the tasks on dates: the
+    date, the data versions of those dates (see day_versions()) and of the
+    rules and jobs the board's unstored tasks are worked out from (see
+    mess.core.dataversion), so a change to them in any process means a new
+    board, and changes to tasks on other dates don't.  Members' names and
+    phones on it can be up to ROTATION_TIMEOUT old.
+    '''
+    key = repr((datetime.date.today(), sorted(day_versions(dates).items()),
+                dataversion.versions([RecurRule, Exclusion, Job])))
+    return 'rotation:%s' % md5.md5(key).hexdigest()
+
+def recur_horizon():
+    '''
+    How far ahead recurring tasks are stored.  Later occurrences are only
+    worked out when asked for, see TaskManager.occurrences().
+    '''
+    return datetime.datetime.combine(datetime.date.today() + 
+            datetime.timedelta(RECUR_HORIZON_DAYS), datetime.time.min)
+
+def recur_set(task, until, exclusions=()):
+    '''
+    The rruleset of task's recur_rule, starting at task.time and ending at
+    until or the rule's own until, whichever is first, minus exclusions.
+    '''
+    rule = task.recur_rule
+    if rule.until and rule.until < until:
+        until = rule.until
+    times = rrule.rruleset()
+    times.rrule(rrule.rrule(getattr(rrule, rule.get_frequency_display().upper()),
+            dtstart=task.time, interval=rule.interval, until=until))
+    for date in exclusions:
+        times.exdate(date)
+    return times
+
+def exclusion_dates(rule_ids):
+    exclusions = {}
+    for rule_id, date in Exclusion.objects.filter(recur_rule__in=rule_ids
+            ).values_list('recur_rule', 'date'):
+        exclusions.setdefault(rule_id, []).append(date)
+    return exclusions
+
+def recur_copy(task, time):
+    ''' an unsaved occurrence of task's recur_rule at time '''
+    return Task(job_id=task.job_id, time=time, hours=task.hours, 
+                member_id=task.member_id, account_id=task.account_id, 
+                recur_rule=task.recur_rule)
+
+@commit_on_success
+def expand_recur_rules(tasks):
+    '''
+    Stores the missing occurrences of each task's recur_rule, from the 
+    task's time until recur_horizon().  Skips Exclusions.  Existing 
+    occurrences and exclusions are read in one query each, for any number
+    of rules.  Returns how many tasks were created.
+    '''
+    tasks = [task for task in tasks if task.recur_rule_id]
+    rule_ids = [task.recur_rule_id for task in tasks]
+    existing = set(Task.objects.filter(recur_rule__in=rule_ids).values_list(
+            'recur_rule', 'time'))
+    exclusions = exclusion_dates(rule_ids)
+    horizon = recur_horizon()
+    new_tasks = []
+    for task in tasks:
+        rule_id = task.recur_rule_id
+        for time in recur_set(task, horizon, exclusions.get(rule_id, [])):
+            if (rule_id, time) in existing:
+                continue
+            existing.add((rule_id, time))
+            new_tasks.append(recur_copy(task, time))
+    insert_tasks(new_tasks)
+    return len(new_tasks)
+
+def last_recur_tasks(after=None, **filters):
+    '''
+    The latest task stored up to recur_horizon() of each recur_rule that 
+    hasn't ended before after (default now), or its first if it starts 
+    later, with its recur_rule.  Tasks edited on their own are passed over,
+    unless a rule has no others.  Only those matching filters (Task 
+    lookups, e.g. account=account) are returned, though each is its rule's
+    latest of all.
+    '''
+    after = after or datetime.datetime.now()
+    horizon = recur_horizon()
+    tasks = Task.objects.filter(recur_rule__isnull=False).filter(
+            models.Q(recur_rule__until__isnull=True) |
+            models.Q(recur_rule__until__gte=after)).order_by()
+    if filters:
+        tasks = tasks.filter(recur_rule__in=Task.objects.filter(**filters
+                ).filter(recur_rule__isnull=False).values('recur_rule'))
+    latest = {}
+    for edited in (False, True):
+        candidates = tasks.filter(edited=edited)
+        found = dict(candidates.filter(time__lte=horizon).values_list(
+                'recur_rule').annotate(Max('time')))
+        for rule, time in candidates.filter(time__gt=horizon).values_list(
+                'recur_rule').annotate(Min('time')):
+            found.setdefault(rule, time)
+        for rule, time in found.items():
+            latest.setdefault(rule, (time, edited))
+    last_tasks = []
+    for task in Task.objects.filter(recur_rule__in=latest.keys(),
+            time__in=set([time for time, edited in latest.values()]), 
+            **filters).select_related('recur_rule'):
+        if latest[task.recur_rule_id] == (task.time, task.edited):
+            last_tasks.append(task)
+    return last_tasks
+
+def extend_recur_rules():
+    '''
+    Extends every current recur_rule to recur_horizon(), following its
+    latest task.  For the nightly cron.
+    '''
+    return expand_recur_rules(last_recur_tasks())
+
+def unstored_occurrences(start, end, **filters):
+    '''
+    Unsaved Tasks for the occurrences of every recur_rule from start to 
+    end (datetimes, end excluded) that follow its last task before the
+    horizon and haven't been stored since (past the horizon only the tasks
+    someone changed are stored).  Each is a copy of that last task: same 
+    job, hours and assignment; see last_recur_tasks().  filters, Task lookups on the last task, 
+    pick the rules.
+    '''
+    last_tasks = [task for task in last_recur_tasks(start, **filters) 
+                  if task.time < end]
+    rule_ids = [task.recur_rule_id for task in last_tasks]
+    stored = set(Task.objects.filter(recur_rule__in=rule_ids, 
+            time__gte=start, time__lt=end).values_list('recur_rule', 'time'))
+    exclusions = exclusion_dates(rule_ids)
+    tasks = []
+    for task in last_tasks:
+        rule_id = task.recur_rule_id
+        times = recur_set(task, end, exclusions.get(rule_id, []))
+        for time in times.between(max(start, task.time), end, inc=True):
+            if (task.time < time < end and time >= start and
+                    (rule_id, time) not in stored):
+                tasks.append(recur_copy(task, time))
+    return tasks
+
+def next_occurrence(after, **filters):
+    '''
+    The first task at or after after (a datetime) matching filters, stored
+    or not, looking up to RECUR_HORIZON_DAYS past the stored horizon; or 
+    None.
+    '''
+    horizon = recur_horizon()
+    stored = Task.objects.filter(time__gte=after, **filters)[:1]
+    if stored and stored[0].time < horizon:
+        return stored[0]
+    start = max(after, horizon)
+    tasks = Task.objects.occurrences(start, start + datetime.timedelta(
+            RECUR_HORIZON_DAYS), **filters)
+    if tasks:
+        return tasks[0]
+    if stored:
+        return stored[0]
+
+@commit_on_success
+def store_occurrences(start, end):
+    '''
+    Stores the occurrences from start to end that were only worked out so
+    far, so they can be edited.
+    '''
+    insert_tasks(unstored_occurrences(start, end))
+
+TURNOUT_KINDS = ('slots', 'yes', 'unexcused', 'unfilled', 'excused', 
+                 'makeup', 'banked')
+TURNOUT_SQL = '''
+    SELECT time, job_id, 
+        SUM(CASE WHEN NOT excused THEN 1 ELSE 0 END),
+        SUM(CASE WHEN NOT excused AND member_id IS NOT NULL 
+                 AND hours_worked > 0 THEN 1 ELSE 0 END),
+        SUM(CASE WHEN NOT excused AND member_id IS NOT NULL 
+                 AND hours_worked = 0 THEN 1 ELSE 0 END),
+        SUM(CASE WHEN NOT excused AND member_id IS NULL THEN 1 ELSE 0 END),
+        SUM(CASE WHEN excused AND member_id IS NOT NULL THEN 1 ELSE 0 END),
+        SUM(CASE WHEN makeup THEN 1 ELSE 0 END),
+        SUM(CASE WHEN banked THEN 1 ELSE 0 END)
+    FROM scheduling_task
+    WHERE time >= %s AND time <= %s
+    GROUP BY time, job_id
+    '''
+# closed days' turnout is cached this long, or until a task on them changes
+TURNOUT_TIMEOUT = 60 * 60 * 24 * 7
+
+def turnout_key(date, version):
+    ''' version is the date's data version, see day_versions() '''
+    return 'turnout:%s:%s' % (date, version)
+
+def day_name(date):
+    ''' the data version name of the tasks on date, see mess.core.dataversion '''
+    return '%s:%s' % (Task._meta.db_table, date)
+
+def days_changed(times):
+    ''' marks the days of tasks at times changed, see day_versions() '''
+    dataversion.changed_names(*set([day_name(date) for time in times 
+                                    for date in turnout_dates(time)]))
+
+def day_versions(dates):
+    '''
+    {date: data version} for dates, moved on when a task on the date (or 
+    at midnight after it, see turnout_dates()) is saved, deleted or 
+    written in bulk here.  Unlike the Task table's version, one date's 
+    doesn't move when tasks on other dates change.
+    '''
+    versions = dataversion.name_versions([day_name(date) for date in dates])
+    return dict([(date, versions[day_name(date)]) for date in dates])
+
+def account_name(account_id):
+    ''' the data version name of account_id's tasks '''
+    return '%s:account:%s' % (Task._meta.db_table, account_id)
+
+def accounts_changed(account_ids):
+    ''' marks the tasks of the accounts changed, see account_version() '''
+    dataversion.changed_names(*[account_name(account_id) for account_id in 
+                                set(account_ids) - set([None])])
+
+def account_version(account_id):
+    '''
+    The data version of account_id's tasks, moved on like day_versions(),
+    for Account.workhist.  Changing a task's timecard doesn't change the 
+    account's flags, so it doesn't bump the account's sync_version.
+    '''
+    return dataversion.name_versions([account_name(account_id)]
+            ).values()[0]
+
+def task_changed(sender, instance, **kwargs):
+    days_changed(set([instance.time, instance._saved_time]) - set([None]))
+    accounts_changed([instance.account_id, instance._saved_account_id])
+
+post_save.connect(task_changed, sender=Task, 
+                  dispatch_uid='mess.scheduling.models.task_changed')
+post_delete.connect(task_changed, sender=Task, 
+                    dispatch_uid='mess.scheduling.models.task_changed')
+
+def turnout_dates(time):
+    '''
+    The days a task at time counts for: its own, and the day before when 
+    it's at midnight, as in calc_turnout's time__range.
+    '''
+    dates = [time.date()]
+    if time.time() == datetime.time(0):
+        dates.append(time.date() - datetime.timedelta(1))
+    return dates
+
+def new_turnout(date):
+    day = dict([(kind, 0) for kind in TURNOUT_KINDS])
+    day['date'] = date
+    day['jobs'] = {}
+    return day
+
+def add_turnout(total, counts):
+    for kind in TURNOUT_KINDS:
+        total[kind] += counts[kind]
+
+def calc_turnouts(start, end):
+    '''
+    The turnout of each day from start until end (dates, end excluded), 
+    with each day's counts by job id under 'jobs', from one grouped query.
+    '''
+    days = dict([(date, new_turnout(date)) for date in daterange(start, end)])
+    if not days:
+        return []
+    cursor = connection.cursor()
+    cursor.execute(TURNOUT_SQL, [
+            connection.ops.value_to_db_datetime(
+                datetime.datetime.combine(date, datetime.time(0)))
+            for date in (start, end)])
+    for row in cursor.fetchall():
+        time, job_id = row[:2]
+        if isinstance(time, basestring):
+            time = typecast_timestamp(time)
+        counts = dict(zip(TURNOUT_KINDS, [int(count) for count in row[2:]]))
+        for date in turnout_dates(time):
+            day = days.get(date)
+            # 9:00am tasks are usually non-shift meeting attendance, etc.
+            if day is None or (time.hour, time.minute, time.second,
+                               time.microsecond) == (9, 0, 0, 0):
+                continue
+            add_turnout(day, counts)
+            add_turnout(day['jobs'].setdefault(job_id, new_turnout(date)), 
+                        counts)
+    return [days[date] for date in sorted(days)]
+
 def turnout(start, end=None):
-    ''' #189: break down shifts based on yes/excused/unexcused, etc. '''
+    '''
+    #189: break down shifts based on yes/excused/unexcused, etc.  Returns
+    the turnout of each day from start until end (default one day) and 
+    their totals, overall, by job and by weekday.  Days before today are
+    cached until a task on them changes.
+    '''
     if end is None:
         end = start + datetime.timedelta(1)
-    days = [calc_turnout(date) for date in daterange(start, end)]
-    # I hereby apologize to whoever has to read the following line of code
-    totals = dict( [ (desc, sum([ x[desc] for x in days])) 
-             for desc in days[0].keys() if desc != 'date' ] )
-    return {'days':days, 'totals':totals}
+    dates = list(daterange(start, end))
+    closed = [date for date in dates if date < datetime.date.today()]
+    keys = dict([(date, turnout_key(date, version)) for date, version in 
+                 day_versions(closed).items()])
+    cached = cache.get_many(keys.values())
+    missing = [date for date in dates if keys.get(date) not in cached]
+    by_date = dict([(day['date'], day) for day in cached.values()])
+    if missing:
+        for day in calc_turnouts(missing[0], missing[-1] + 
+                                 datetime.timedelta(1)):
+            by_date.setdefault(day['date'], day)
+        cache.set_many(dict([(keys[date], by_date[date]) 
+                             for date in missing if date in keys]), 
+                       TURNOUT_TIMEOUT)
+    days = [by_date[date] for date in dates]
+    totals = new_turnout(None)
+    weekdays = [new_turnout(None) for weekday in range(7)]
+    jobs = {}
+    for day in days:
+        add_turnout(totals, day)
+        add_turnout(weekdays[day['date'].weekday()], day)
+        for job_id, counts in day['jobs'].items():
+            add_turnout(jobs.setdefault(job_id, new_turnout(None)), counts)
+    for weekday, counts in enumerate(weekdays):
+        counts['weekday'] = calendar.day_name[weekday]
+    job_names = Job.objects.in_bulk(jobs.keys())
+    for job_id, counts in jobs.items():
+        counts['job'] = job_names.get(job_id)
+    return {'days': days, 'totals': totals, 
+            'weekdays': [counts for counts in weekdays if counts['slots']],
+            'jobs': sorted(jobs.values(), key=lambda counts: 
+                           unicode(counts['job']))}
 
 def calc_turnout(date):
-    tasks = Task.objects.filter(time__range=(date, date+datetime.timedelta(1)))
-    # exclude 9:00am tasks, which are usually non-shift meeting attendance, etc.
-    tasks = tasks.exclude(time=datetime.datetime.combine(date, datetime.time(9)))
-    return {'date': date,
-            'slots': tasks.filter(excused=False).count(),
-            'yes': tasks.filter(excused=False, member__isnull=False, hours_worked__gt=0).count(),
-            'unexcused': tasks.filter(excused=False, member__isnull=False, hours_worked=0).count(),
-            'unfilled': tasks.filter(excused=False, member__isnull=True).count(),
-            'excused': tasks.filter(excused=True, member__isnull=False).count(),
-            'makeup': tasks.filter(makeup=True).count(),
-            'banked': tasks.filter(banked=True).count()}
+    ''' the turnout of one day, see turnout() '''
+    return calc_turnouts(date, date + datetime.timedelta(1))[0]
 
 # this is duplicated in membership/models.  duplicated to avoid circular imports.
 def daterange(start, end):
@@ -405,6 +1113,10 @@ class Timecard(models.Model):
         work = self.end - self.start
         return u"%s hrs of %s" % (work.seconds / 3600, self.task.job)
 
+# the tables the rotation board and cached reports read, see 
+# mess.core.dataversion
+dataversion.track(Skill, Job, RecurRule, Exclusion, Task, Timecard)
+
 #class RecurringShift(models.Model):
 #    """
 #    A recurring shift is members typical workshift made up of a series of tasks
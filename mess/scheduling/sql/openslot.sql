@@ -0,0 +1,2 @@
+-- switch and signup lists look up open slots by job, date and hours
+CREATE INDEX scheduling_openslot_job_time_hours ON scheduling_openslot (job_id, time, hours);
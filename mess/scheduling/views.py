@@ -1,8 +1,8 @@
-import datetime, time, calendar
+import bisect, datetime, time, calendar
 from dateutil.relativedelta import relativedelta
 
 #from django.conf import settings
-#from django.core.cache import cache
+from django.core.cache import cache
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect, Http404
@@ -39,8 +39,10 @@ def myschedule(request):
         shift.account = account
         shift.makeup = True
         shift.save()
-    account_shifts = account.task_set.filter(
-                     time__range=(today,today+datetime.timedelta(180)))
+    midnight = datetime.datetime.combine(datetime.date.today(), 
+                                         datetime.time.min)
+    account_shifts = models.Task.objects.occurrences(midnight,
+                     midnight + datetime.timedelta(181), account=account)
     my_shift = member.regular_shift()
     if my_shift:
         similar_assigned = models.Task.objects.filter(job=my_shift.job,
@@ -48,7 +50,9 @@ def myschedule(request):
                            time__range=(today,today+datetime.timedelta(42)),
                            hours=my_shift.hours,
                            member__isnull=False)
-    unassigned = models.Task.objects.filter(member__isnull=True,
+    models.store_open_slots(datetime.datetime.combine(
+            today + datetime.timedelta(21), datetime.time.min))
+    unassigned = models.Task.objects.open_slots(has_member=False,
                  excused=False,
                  time__range=(today,today+datetime.timedelta(20)))
 
@@ -64,18 +68,19 @@ def unassigned_days(firstday, lastday):
     """
     days = {}
     format = "%m/%d/%Y"
-    tasks = models.Task.objects.unassigned().filter(
-            time__gte = firstday,
-            time__lte = lastday
-    )
-    for task in tasks:
-        datestr = task.time.strftime(format)
+    end = lastday + datetime.timedelta(seconds=1)
+    # upcoming days come from the OpenSlot index, earlier ones from Task
+    split = min(max(firstday, models.open_slots_start()), end)
+    times = list(models.Task.objects.unassigned().filter(
+            time__gte=firstday, time__lt=split).values_list('time', flat=True))
+    times.extend(models.OpenSlot.objects.filter(time__gte=split, time__lt=end
+            ).values_list('time', flat=True))
+    times.extend([task.time for task in 
+                  models.unstored_occurrences(firstday, end)
+                  if not (task.member_id and task.account_id)])
+    for time in times:
+        datestr = time.strftime(format)
         days[datestr] = days.get(datestr, 0) + 1
-    #for task in models.Task.recurring.unassigned():
-    #    occur_times = task.get_occur_times(firstday, lastday)
-    #    for occur_time in occur_times:
-    #        datestr = occur_time.strftime(format)
-    #        days[datestr] = days.get(datestr, 0) + 1
     return days
     
 def unassigned_for_month(request, month):
@@ -116,9 +121,19 @@ def schedule(request, date=None):
     add_task_form = forms.TaskForm(instance=models.Task(time=add_time), 
             prefix='add')
     add_recur_form = forms.RecurForm(prefix='recur-add')
-    tasks = models.Task.objects.filter(time__year=date.year).filter(
-            time__month=date.month).filter(time__day=date.day).order_by(
-            'time', 'hours', 'job', '-recur_rule')
+    day_end = date + datetime.timedelta(1)
+    if request.method == 'POST':
+        # recurring tasks past the stored horizon need ids to be edited
+        models.store_occurrences(date, day_end)
+    tasks = list(models.Task.objects.filter(time__year=date.year).filter(
+            time__month=date.month).filter(time__day=date.day))
+    # and are worked out from their rules to be shown
+    tasks.extend(models.unstored_occurrences(date, day_end))
+    models.load_related(tasks)
+    # ordered the same with and without them, so the POSTed task-index 
+    # still points at the task that was shown
+    tasks.sort(key=lambda task: (task.time, task.hours, task.job.name,
+                                 -(task.recur_rule_id or 0)))
     prepared_tasks = []
     for index, task in enumerate(tasks):
         task.form = forms.TaskForm(instance=task, prefix=str(index))
@@ -147,6 +162,10 @@ def schedule(request, date=None):
                             time__gt=task.time)
                     for future_task in future_tasks:
                         future_task.delete()
+                    # or the rule would carry on from its earlier tasks
+                    task.recur_rule.until = task.time - datetime.timedelta(
+                            seconds=1)
+                    task.recur_rule.save()
                 task.delete()
                 return HttpResponseRedirect(reverse('scheduling-schedule', 
                         args=[date.date()]))
@@ -188,6 +207,20 @@ def schedule(request, date=None):
     template = loader.get_template('scheduling/schedule.html')
     return HttpResponse(template.render(context))
 
+TIMECARD_LABELS = {
+    'hours_worked': 'hours worked',
+    'excused': 'shift status',
+    'makeup': 'makeup',
+    'banked': 'banked',
+    'reminder_call': 'reminder call',
+}
+
+def timecard_changes(results):
+    ''' {task id: what changed} from update_timecards' results '''
+    return dict([(task.id, ', '.join([TIMECARD_LABELS[field] 
+                                      for field in changed]))
+                 for task, changed in results if task])
+
 # filter for date
 @login_required
 def timecard(request, date=None):
@@ -220,29 +253,34 @@ def timecard(request, date=None):
     if request.method == 'POST':
       formset = TimecardFormSet(request.POST)
 
-      for n in range(0, formset.total_form_count()):
-        form = formset.forms[n]
-
+      entries = []
+      for form in formset.forms:
         if (form.is_valid()):
-          task = models.Task.objects.get(id=form.cleaned_data['id'])
-          task.hours_worked=form.cleaned_data['hours_worked']
-
-          task.excused = (form.cleaned_data['shift_status']=='excused')
-          task.makeup = form.cleaned_data['makeup']
-          task.banked = form.cleaned_data['banked']
-          task.reminder_call = form.cleaned_data['reminder_call']
-          task.save()
-
+          entries.append((form.cleaned_data['id'], {
+            'hours_worked': form.cleaned_data['hours_worked'],
+            'excused': form.cleaned_data['shift_status'] == 'excused',
+            'makeup': form.cleaned_data['makeup'],
+            'banked': form.cleaned_data['banked'],
+            'reminder_call': form.cleaned_data['reminder_call'],
+          }))
         else:
           ''' 
           Even if we don't validate, we still save the reminder call value, as
           reminder calls take place a day before the timecard is ready to be submitted.
           '''
-          task = models.Task.objects.get(id=request.POST['form-' + str(n) + '-id'])
-          task.reminder_call = request.POST['form-' + str(n) + '-reminder_call']
-          task.save()
-
-      if (not formset.errors):
+          reminder_call = form['reminder_call'].data
+          task_id = form['id'].data
+          # the id is a hidden field, but a tampered or truncated post 
+          # can still send junk: skip the form rather than fail the page
+          if (reminder_call in dict(models.REMINDER_CALL) and task_id 
+              and task_id.isdigit()):
+            entries.append((int(task_id), {'reminder_call': reminder_call}))
+
+      changes = timecard_changes(models.update_timecards(entries))
+      # formset.errors is a list of each form's errors, so it's never 
+      # empty; ask the formset instead
+      if formset.is_valid():
+        request.session['timecard_changes'] = changes
         return HttpResponseRedirect(reverse('scheduling-timecard', args=[date.date()]))
     else:
       num_tasks = unicode(len(tasks))
@@ -283,6 +321,16 @@ def timecard(request, date=None):
     for i in range(len(formset.forms)):
       formset.forms[i].instance = tasks[i]  
 
+    # what the last submit changed, so staff can check it took
+    if request.method != 'POST':
+      changes = request.session.pop('timecard_changes', None)
+    if changes:
+      for form in formset.forms:
+        form.changes = changes.get(form.instance.id)
+      context['changes'] = changes
+      context['changed_count'] = len([c for c in changes.values() if c])
+      context['unchanged_count'] = len([c for c in changes.values() if not c])
+
     context['formset'] = formset
     context['date'] = date
     a_day = datetime.timedelta(days=1)
@@ -310,26 +358,30 @@ def old_rotations(date, interval=None):
 def rotation(request):
     """
     Print listings of shifts according to rotation cycles.
-    We'll assume a shift is permanent if it's scheduled 10 rotations ahead.
+    We'll assume a shift is permanent if it's scheduled 7 rotations ahead.
     We try to match each 4-week shift to an 'ideal' slot on week of 1990-01-01.
     I'm hard-coding pagebreaks because page-break-inside:avoid; doesn't work.
     """ 
     context = RequestContext(request)
-    horizon = 10
+    context['rotationtables'] = rotation_board()
+    template = loader.get_template('scheduling/rotation.html')
+    return HttpResponse(template.render(context))
+
+def rotation_board():
+    """
+    The rotation tables, from one pass over the tasks on the board's dates
+    (stored, or worked out from their recur_rules) and the ideal shifts.
+    Cached until a task on those dates, a rule or a job changes.
+    """
     rotationtables = []
 
     # get four-week rotations, idealizing them
     for weekday in range(0,7):
         table = {'freq':4, 'weekday':weekday, 'cycles':[], 
-                 'dayname':calendar.day_name[weekday], 'pagebreakafter':True}
-        table['idealdate'] = idealdate = datetime.date(1990, 1, 1+weekday)
-        table['ideals'] = models.Task.objects.filter(time__range=(
-                datetime.datetime.combine(idealdate, datetime.time.min),
-                datetime.datetime.combine(idealdate, datetime.time.max)))
+                 'dayname':calendar.day_name[weekday], 'pagebreakafter':True,
+                 'idealdate':datetime.date(1990, 1, 1+weekday)}
         for cycle in range(4):
-            column = cyclecolumn(4, weekday, cycle)
-            idealize(column['shifts'], table['ideals'])
-            table['cycles'].append(column)
+            table['cycles'].append(cyclecolumn(4, weekday, cycle))
         rotationtables.append(table)
 
     # get six-week cashier rotations
@@ -339,52 +391,85 @@ def rotation(request):
         if weekday in [2,4,6]:
             table['pagebreakafter'] = True
         for cycle in range(6):
-            table['cycles'].append(cyclecolumn(6, weekday, cycle, cashieronly=True))
+            table['cycles'].append(cyclecolumn(6, weekday, cycle, 
+                                               cashieronly=True))
         rotationtables.append(table)
 
     # get dancer shifts, idealizing them
     table = {'freq':4, 'dayname':'Dancer (by Sunday)', 
-             'dancer':True, 'cycles':[]}
-    table['idealdate'] = idealdate = datetime.date(1990, 1, 8)
-    table['ideals'] = models.Task.objects.filter(time__range=(
-                datetime.datetime.combine(idealdate, datetime.time.min),
-                datetime.datetime.combine(idealdate, datetime.time.max)))
+             'dancer':True, 'cycles':[], 'idealdate':datetime.date(1990, 1, 8)}
     for cycle in range(4):
-        column = cyclecolumn(4, 6, cycle, getdancers=True)
-        idealize(column['shifts'], table['ideals'])
-        table['cycles'].append(column)
+        table['cycles'].append(cyclecolumn(4, 6, cycle, getdancers=True))
     rotationtables.append(table)
 
-    context['rotationtables'] = rotationtables
-    template = loader.get_template('scheduling/rotation.html')
-    return HttpResponse(template.render(context))
+    columns = [column for table in rotationtables 
+               for column in table['cycles']]
+    lastdates = [column['lastdate'] for column in columns]
+    idealdates = list(models.daterange(datetime.date(1990, 1, 1),
+                                       datetime.date(1990, 1, 9)))
+    key = models.rotation_key(lastdates + idealdates)
+    board = cache.get(key)
+    if board is not None:
+        return board
+
+    # fill in the columns' shifts from the tasks on their last dates
+    tasks = models.load_related(models.Task.objects.occurrences(
+            datetime.datetime.combine(min(lastdates), datetime.time.min),
+            datetime.datetime.combine(max(lastdates), datetime.time.max)))
+    tasks.sort(key=lambda task: (task.time, task.job.name))
+    by_date = {}
+    for task in tasks:
+        rule = task.recur_rule
+        if rule and rule.frequency == 'w':
+            by_date.setdefault((task.time.date(), rule.interval), 
+                               []).append(task)
+    for column in columns:
+        shifts = by_date.get((column['lastdate'], column['freq']), [])
+        if column['getdancers']:
+            shifts = [task for task in shifts 
+                      if 'dancer' in task.job.name.lower()]
+        else:
+            shifts = [task for task in shifts 
+                      if 'dancer' not in task.job.name.lower()]
+        if column['cashieronly']:
+            shifts = [task for task in shifts if task.job.name == 'Cashier']
+        column['shifts'] = shifts
+
+    ideals = {}
+    for task in models.Task.objects.filter(time__range=(
+            datetime.datetime.combine(idealdates[0], datetime.time.min), 
+            datetime.datetime.combine(idealdates[-1], datetime.time.max))
+            ).select_related('job'):
+        ideals.setdefault(task.time.date(), []).append(task)
+    for table in rotationtables:
+        if 'idealdate' in table:
+            table['ideals'] = ideals.get(table['idealdate'], [])
+            for column in table['cycles']:
+                idealize(column['shifts'], table['ideals'])
+
+    cache.set(key, rotationtables, models.ROTATION_TIMEOUT)
+    return rotationtables
 
 def cyclecolumn(freq, weekday, cycle, getdancers=False, cashieronly=False):
+    """
+    The dates of one rotation column; rotation_board() fills in 'shifts',
+    the weekly shifts of this freq on the last date.
+    """
     horizon = 7
     cycle_begin = datetime.datetime(2009,1,26)
     today = datetime.date.today()
     first = cycle_begin + datetime.timedelta(days=weekday+7*cycle)
     while first.date() < today:
         first += datetime.timedelta(days=7*freq)
-    column = {}
+    column = {'freq': freq, 'getdancers': getdancers, 
+              'cashieronly': cashieronly}
     column['dates'] = [first + datetime.timedelta(days=7*freq*i)
         for i in range(horizon)]
     if freq == 4:
         column['letter'] = 'ABCD'[cycle]
     elif freq == 6:
         column['letter'] = 'EFGHIJ'[cycle]
-    lastdate = (column['dates'][-1]).date()
-    shifts = models.Task.objects.filter(time__range=(
-              datetime.datetime.combine(lastdate, datetime.time.min),
-              datetime.datetime.combine(lastdate, datetime.time.max)),
-              recur_rule__interval=freq, recur_rule__frequency='w',)
-    if getdancers:
-        shifts = shifts.filter(job__name__icontains='dancer')
-    else:
-        shifts = shifts.exclude(job__name__icontains='dancer')
-    if cashieronly:
-        shifts = shifts.filter(job__name='Cashier')
-    column['shifts'] = shifts.order_by('time','job')
+    column['lastdate'] = (column['dates'][-1]).date()
     return column
 
 def idealize(actualshifts, idealshifts):
@@ -397,7 +482,9 @@ def idealize(actualshifts, idealshifts):
           ideal(9am)---actual(10am)       None------actual(3pm)
           ideal(9am)-----None          ideal(2pm)---actual(3pm)
        but still match:     ideal(9am)---actual(3pm)
-    To approximate this, we do several passes with increasing tolerance. 
+    To approximate this, we do several passes with increasing tolerance.
+    Each pass only looks at the same job's actual shifts that are within 
+    the tolerance, found by bisecting their times.
     """
     for ideal in idealshifts:
         try:
@@ -408,22 +495,34 @@ def idealize(actualshifts, idealshifts):
             ideal.actualizeddatetime = datetime.datetime.combine(
                     actualshifts[0].time.date(), 
                     ideal.time.time())
+    if not actualshifts:
+        return
+    by_job = {}
+    for actual in actualshifts:
+        by_job.setdefault(actual.job_id, []).append(actual)
+    for shifts in by_job.values():
+        # stable, so shifts at the same time keep their order
+        shifts.sort(key=lambda actual: actual.time)
+    times = dict([(job_id, [actual.time for actual in shifts])
+                  for job_id, shifts in by_job.items()])
     for tolerance_hours in [0, 1, 4, 16]:
         tolerance = datetime.timedelta(hours=tolerance_hours)
         for ideal in idealshifts:
             if ideal.actuals[-1]:   # already matched on better tolerance
                 continue
-            for actual in actualshifts:
+            shifts = by_job.get(ideal.job_id, [])
+            first = bisect.bisect_left(times.get(ideal.job_id, []), 
+                                       ideal.actualizeddatetime - tolerance)
+            for actual in shifts[first:]:
+                if actual.time > ideal.actualizeddatetime + tolerance:
+                    break
                 if hasattr(actual, 'idealized'):
                     continue
-                if actual.job != ideal.job:
-                    continue
-                timediff = abs(ideal.actualizeddatetime - actual.time)
-                if timediff <= tolerance:
-                    ideal.actuals[-1] = actual
-                    actual.idealized = True
-                    actual.timediff = timediff.seconds
-                    break
+                ideal.actuals[-1] = actual
+                actual.idealized = True
+                actual.timediff = abs(ideal.actualizeddatetime - 
+                                      actual.time).seconds
+                break
 
 def jobs(request):
     context = {
@@ -546,13 +645,14 @@ def switch(request):
     earliest_date = original.time - datetime.timedelta(14)
     if earliest_date < earliest_switch:
         earliest_date = earliest_switch
-    possible_switches = models.Task.objects.filter(
+    models.store_open_slots(original.time + datetime.timedelta(14))
+    possible_switches = models.Task.objects.open_slots(
                 time__range=(earliest_date, original.time + datetime.timedelta(14)),
                 hours=original.hours, 
                 excused=False,
                 job=original.job, 
-                account__isnull=True, 
-                member__isnull=True,
+                has_account=False, 
+                has_member=False,
                 )
     form.fields['task'].queryset = possible_switches
     return render_to_response('scheduling/switch.html', locals(),
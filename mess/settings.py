@@ -65,6 +65,8 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'mess.core.middleware.ProfilingMiddleware',
+    'mess.core.middleware.DataVersionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -118,8 +120,38 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 LOGIN_URL = PROJECT_URL
 LOGIN_REDIRECT_URL = PROJECT_URL
 
+# Account frozen_flags are cached here and rebuilt nightly by
+# 'cron_nightly.py --maintenance'.
+# The rebuild only reaches the web server with a shared backend, e.g.
+# 'memcached://127.0.0.1:11211/' or 'db://cache_table' in settings_local.
 CACHE_BACKEND = 'locmem://'
 
+# Recurring shifts are stored this many days ahead ('cron_nightly.py
+# --maintenance' keeps them topped up); the schedule pages work out later ones from the rules.
+RECUR_HORIZON_DAYS = 183
+
+# ProfilingMiddleware settings.  Requests running more than 
+# PERF_QUERY_THRESHOLD queries are logged with their call sites; 
+# reporting/perf shows the last PERF_RING_SIZE requests.
+PERF_LOG_FILE = os.path.join(PROJECT_ROOT, 'perf.log')
+PERF_QUERY_THRESHOLD = 100
+PERF_RING_SIZE = 1000
+
+# The list report (reporting/list) keeps up to REPORT_CACHE_SIZE rendered
+# results in the cache, each until a table it reads changes or
+# REPORT_CACHE_TIMEOUT seconds pass.
+REPORT_CACHE_TIMEOUT = 60 * 60
+REPORT_CACHE_SIZE = 50
+
+# Slow reports can run in the background (reporting/jobs), in at most
+# REPORT_WORKERS processes of report_worker.py at REPORT_WORKER_NICE, so
+# they can't crowd out the registers.  Results are kept as files in
+# REPORT_JOB_DIR for REPORT_JOB_DAYS days.
+REPORT_WORKERS = 2
+REPORT_WORKER_NICE = 10
+REPORT_JOB_DIR = os.path.join(PROJECT_ROOT, 'report_jobs')
+REPORT_JOB_DAYS = 7
+
 # Default to clearing everything at browser close.
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 
@@ -148,11 +180,21 @@ AUTHENTICATION_BACKENDS = (
 # Uncomment for email testing
 #EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# cron_nightly.py sends reminder emails this many at a time
+REMINDER_BATCH_SIZE = 50
+
 ## mess project constants below ##
 
 GOTOFORUM_SECRET = 'The real secret should be specified under settings_local.py'
 IS4C_SECRET = 'fakesecret'
 
+# The IS4C changed_since feed hands out a version IS4C_SYNC_LAG seconds 
+# behind the newest, so changes committed by a longer transaction aren't 
+# skipped.  'cron_nightly.py --maintenance' prunes its change log of all 
+# but tombstones after SYNC_VERSION_DAYS.
+IS4C_SYNC_LAG = 10 * 60
+SYNC_VERSION_DAYS = 7
+
 try:
     from settings_local import *
 except ImportError:
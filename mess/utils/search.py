@@ -1,6 +1,5 @@
-from django.db.models import Q
-
 from mess.membership.models import Member, Account, Address, Phone
+from mess.membership import searchindex
 
 from django.contrib.auth.models import User
 
@@ -30,7 +29,8 @@ def search_for_accounts(string):
     
     dict = {'primary_key': 'name'}
     """
-    list = Account.objects.filter(name__icontains=string)
+    list = searchindex.search_objects(Account.objects.all(), string, 
+                                      fields=['name'])
     return create_dictionary(list)
 
 def search_for_address(string):
@@ -39,7 +39,12 @@ def search_for_address(string):
     
     dict = {'primary_key': 'name'}
     """
-    list = Address.objects.filter(address_1__icontains=string)
+    members = searchindex.search(searchindex.MEMBER, string, ['address'])
+    list = [address for chunk in searchindex.chunks(members) 
+            for address in Address.objects.filter(member__in=chunk)
+            if searchindex.matches('address', searchindex.address_values(
+                address.address1, address.address2, address.city, 
+                address.postal_code), string)]
     return create_dictionary(list)
 
 def search_for_email(string):
@@ -47,7 +52,9 @@ def search_for_email(string):
     
     dict = {'primary_key': 'name'}
     """
-    list = User.objects.filter(email__icontains=string)
+    members = searchindex.search(searchindex.MEMBER, string, ['email'])
+    list = [user for chunk in searchindex.chunks(members)
+            for user in User.objects.filter(member__in=chunk)]
     return create_dictionary(list)
 
 def search_for_phone(string):
@@ -55,9 +62,10 @@ def search_for_phone(string):
     
     dict = {'primary_key': 'name'}
     """
-    # ext is an interger.  How can I search it as a string?
-    #list = Phone.objects.filter(number__contains=string, ext__contains=string)
-    list = Phone.objects.filter(number__contains=string)
+    members = searchindex.search(searchindex.MEMBER, string, ['phone'])
+    list = [phone for chunk in searchindex.chunks(members)
+            for phone in Phone.objects.filter(member__in=chunk)
+            if searchindex.matches('phone', [phone.number], string)]
     return create_dictionary(list)
 
 def search_for_people(string):
@@ -65,8 +73,8 @@ def search_for_people(string):
     
     dict = {'primary_key': 'name'}
     """
-    list = Member.objects.filter(Q(user__first_name__icontains=string)
-                                | Q(user__last_name__icontains=string))
+    list = searchindex.search_objects(Member.objects.all(), string, 
+                                      fields=['name'])
     return create_dictionary(list)
 
 def search_for_members(string):
@@ -74,8 +82,8 @@ def search_for_members(string):
     
     dict = {'primary_key': 'name'}
     """
-    list = Member.objects.filter(Q(user__first_name__icontains=string)
-                                | Q(user__last_name__icontains=string))
+    list = searchindex.search_objects(Member.objects.all(), string, 
+                                      fields=['name'])
     return create_dictionary(list)
 
 def search_for_string(search, string):